@@ -22,6 +22,10 @@ def add_cmdline_args(parser):
     agent.add_argument('--init_model', type=str, default=None,
                        help='Load dict/features/weights/opts from this file')
     agent.add_argument('--log_file', type=str, default=None)
+    agent.add_argument('--token_cache', type=str, default=None,
+                       help='sqlite file caching the tokenized documents, '
+                            'questions and answers, so that they are only '
+                            'tokenized once across epochs and runs')
 
     # Model details
     agent.add_argument('--fix_embeddings', type='bool', default=True)
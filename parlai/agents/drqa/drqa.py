@@ -35,7 +35,8 @@ from parlai.core.agents import Agent
 from parlai.core.dict import DictionaryAgent
 from parlai.core.build_data import modelzoo_path
 from . import config
-from .utils import build_feature_dict, vectorize, batchify, normalize_text
+from .utils import build_feature_dict, vectorize, batchify
+from .utils import TokenCache, embedding_store
 from .model import DocReaderModel
 
 
@@ -62,13 +63,11 @@ class SimpleDictionaryAgent(DictionaryAgent):
         if (self.opt['pretrained_words'] and self.opt.get('embedding_file') and
                 not self.opt.get('trained', False)):
             print('[ Indexing words with embeddings... ]')
-            self.embedding_words = set()
             self.opt['embedding_file'] = modelzoo_path(
                 self.opt.get('datapath'), self.opt['embedding_file'])
-            with open(self.opt['embedding_file']) as f:
-                for line in f:
-                    w = normalize_text(line.rstrip().split(' ')[0])
-                    self.embedding_words.add(w)
+            self.embedding_words = set(
+                embedding_store(self.opt['embedding_file']).tokens()
+            )
             print('[ Num words in set = %d ]' %
                   len(self.embedding_words))
         else:
@@ -119,6 +118,7 @@ class DrqaAgent(Agent):
             self.word_dict = shared['word_dict']
             self.model = shared['model']
             self.feature_dict = shared['feature_dict']
+            self.tokenizer = shared['tokenizer']
         else:
             # set up model
             self.word_dict = DrqaAgent.dictionary_class()(opt)
@@ -133,6 +133,11 @@ class DrqaAgent(Agent):
                 print('[ Using CUDA (GPU %d) ]' % opt['gpu'])
                 torch.cuda.set_device(opt['gpu'])
                 self.model.cuda()
+            if self.opt.get('token_cache'):
+                self.tokenizer = TokenCache(self.opt['token_cache'],
+                                            self.word_dict)
+            else:
+                self.tokenizer = self.word_dict
 
         # Set up params/logging/dicts
         self.id = self.__class__.__name__
@@ -165,6 +170,7 @@ class DrqaAgent(Agent):
         shared['word_dict'] = self.word_dict
         shared['model'] = self.model
         shared['feature_dict'] = self.feature_dict
+        shared['tokenizer'] = self.tokenizer
         return shared
 
     def observe(self, observation):
@@ -256,6 +262,8 @@ class DrqaAgent(Agent):
         """Save the parameters of the agent to a file."""
         fname = self.opt.get('model_file', None) if fname is None else fname
         if fname:
+            if isinstance(self.tokenizer, TokenCache):
+                self.tokenizer.commit()
             print("[ saving model: " + fname + " ]")
             self.opt['trained'] = True
             self.model.save(fname)
@@ -263,6 +271,11 @@ class DrqaAgent(Agent):
             with open(fname + '.opt', 'w') as handle:
                 json.dump(self.opt, handle)
 
+    def shutdown(self):
+        if isinstance(self.tokenizer, TokenCache):
+            self.tokenizer.commit()
+        super().shutdown()
+
     # --------------------------------------------------------------------------
     # Helper functions.
     # --------------------------------------------------------------------------
@@ -291,8 +304,8 @@ class DrqaAgent(Agent):
             )
 
         document = ' '.join(paragraphs)
-        inputs['document'], doc_spans = self.word_dict.span_tokenize(document)
-        inputs['question'] = self.word_dict.tokenize(question)
+        inputs['document'], doc_spans = self.tokenizer.span_tokenize(document)
+        inputs['question'] = self.tokenizer.tokenize(question)
         inputs['target'] = None
 
         # Find targets (if labels provided).
@@ -302,11 +315,11 @@ class DrqaAgent(Agent):
                 # randomly sort labels and keep the first match
                 labels_with_inds = list(zip(ex['labels'], ex['answer_starts']))
                 random.shuffle(labels_with_inds)
+                span_starts = [x[0] for x in doc_spans]
                 for ans, ch_idx in labels_with_inds:
                     # try to find an answer_start matching a tokenized answer
-                    start_idx = bisect.bisect_left(
-                        list(x[0] for x in doc_spans), ch_idx)
-                    end_idx = start_idx + len(self.word_dict.tokenize(ans)) - 1
+                    start_idx = bisect.bisect_left(span_starts, ch_idx)
+                    end_idx = start_idx + len(self.tokenizer.tokenize(ans)) - 1
                     if end_idx < len(doc_spans):
                         inputs['target'] = (start_idx, end_idx)
                         break
@@ -326,14 +339,19 @@ class DrqaAgent(Agent):
         """Find the start/end token span for all labels in document.
         Return a random one for training.
         """
-        def _positions(d, l):
-            for i in range(len(d)):
-                for j in range(i, min(len(d) - 1, i + len(l))):
-                    if l == d[i:j + 1]:
-                        yield(i, j)
+        # only look for matches where the first token of a label occurs
+        positions = {}
+        for i, w in enumerate(document):
+            positions.setdefault(w, []).append(i)
         targets = []
         for label in labels:
-            targets.extend(_positions(document, self.word_dict.tokenize(label)))
+            l = self.tokenizer.tokenize(label)
+            if len(l) == 0:
+                continue
+            for i in positions.get(l[0], []):
+                # spans ending on the last token of the document are skipped
+                if i + len(l) < len(document) and document[i:i + len(l)] == l:
+                    targets.append((i, i + len(l) - 1))
         if len(targets) == 0:
             return
         return targets[np.random.choice(len(targets))]
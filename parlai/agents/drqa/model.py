@@ -8,11 +8,10 @@
 import torch
 import torch.optim as optim
 import torch.nn.functional as F
-import numpy as np
 import logging
 
 from torch.autograd import Variable
-from .utils import load_embeddings, AverageMeter
+from .utils import load_embeddings, decode_spans, AverageMeter
 from .rnn_reader import RnnDocReader
 
 logger = logging.getLogger('DrQA')
@@ -130,26 +129,23 @@ class DocReaderModel(object):
             inputs = [Variable(e, volatile=True) for e in ex[:5]]
 
         # Run forward
-        score_s, score_e = self.network(*inputs)
+        with torch.no_grad():
+            score_s, score_e = self.network(*inputs)
 
-        # Transfer to CPU/normal tensors for numpy ops
-        score_s = score_s.data.cpu()
-        score_e = score_e.data.cpu()
+            # Get argmax text spans for the whole batch
+            s_idx, e_idx, scores = decode_spans(
+                score_s.data, score_e.data, self.opt['max_len']
+            )
+        s_idx = s_idx.tolist()
+        e_idx = e_idx.tolist()
 
-        # Get argmax text spans
         text = ex[-2]
         spans = ex[-1]
         predictions = []
-        pred_scores = []
-        max_len = self.opt['max_len'] or score_s.size(1)
-        for i in range(score_s.size(0)):
-            scores = torch.ger(score_s[i], score_e[i])
-            scores.triu_().tril_(max_len - 1)
-            scores = scores.numpy()
-            s_idx, e_idx = np.unravel_index(np.argmax(scores), scores.shape)
-            s_offset, e_offset = spans[i][s_idx][0], spans[i][e_idx][1]
+        for i in range(len(text)):
+            s_offset, e_offset = spans[i][s_idx[i]][0], spans[i][e_idx[i]][1]
             predictions.append(text[i][s_offset:e_offset])
-            pred_scores.append(np.max(scores))
+        pred_scores = scores.cpu().tolist()
 
         return predictions, pred_scores
 
@@ -5,11 +5,16 @@
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree. An additional grant
 # of patent rights can be found in the PATENTS file in the same directory.
+import hashlib
+import numpy as np
+import sqlite3
 import torch
 import unicodedata
-from collections import Counter
 
 from parlai.core.build_data import modelzoo_path
+from parlai.core.embedding_store import (
+    EmbeddingStore, load_store, read_text_vectors, copy_embeddings
+)
 
 
 # ------------------------------------------------------------------------------
@@ -21,6 +26,20 @@ def normalize_text(text):
     return unicodedata.normalize('NFD', text)
 
 
+def embedding_store(embedding_file):
+    """Return the memory-mapped store of a text embedding file.
+
+    The file is converted the first time, with its words normalized.
+    """
+    path = embedding_file + '.nfd.emb'
+    if not EmbeddingStore.exists(path):
+        print('[ Converting embeddings to %s ]' % path)
+        EmbeddingStore.build(
+            path, read_text_vectors(embedding_file, normalize_text)
+        )
+    return load_store(path)
+
+
 def load_embeddings(opt, word_dict):
     """Initialize embeddings from file of pretrained vectors."""
     embeddings = torch.Tensor(len(word_dict), opt['embedding_dim'])
@@ -30,15 +49,11 @@ def load_embeddings(opt, word_dict):
     # Fill in embeddings
     if not opt.get('embedding_file'):
         raise RuntimeError('Tried to load embeddings with no embedding file.')
-    with open(opt['embedding_file']) as f:
-        for line in f:
-            parsed = line.rstrip().split(' ')
-            if len(parsed) > 2:
-                assert(len(parsed) == opt['embedding_dim'] + 1)
-                w = normalize_text(parsed[0])
-                if w in word_dict:
-                    vec = torch.Tensor([float(i) for i in parsed[1:]])
-                    embeddings[word_dict[w]].copy_(vec)
+    store = embedding_store(opt['embedding_file'])
+    if store.dim != opt['embedding_dim']:
+        raise RuntimeError('Embedding file has dimension %d, expected %d.' %
+                           (store.dim, opt['embedding_dim']))
+    copy_embeddings(embeddings, word_dict, store)
 
     # Zero NULL token
     embeddings[word_dict['__NULL__']].fill_(0)
@@ -73,38 +88,48 @@ def vectorize(opt, ex, word_dict, feature_dict):
     question = torch.LongTensor([word_dict[w] for w in ex['question']])
 
     # Create extra features vector
-    features = torch.zeros(len(ex['document']), len(feature_dict))
-
-    # f_{exact_match}
-    if opt['use_in_question']:
-        q_words_cased = set([w for w in ex['question']])
-        q_words_uncased = set([w.lower() for w in ex['question']])
-        for i in range(len(ex['document'])):
-            if ex['document'][i] in q_words_cased:
-                features[i][feature_dict['in_question']] = 1.0
-            if ex['document'][i].lower() in q_words_uncased:
-                features[i][feature_dict['in_question_uncased']] = 1.0
-
-    # f_{tf}
-    if opt['use_tf']:
-        counter = Counter([w.lower() for w in ex['document']])
-        l = len(ex['document'])
-        for i, w in enumerate(ex['document']):
-            features[i][feature_dict['tf']] = counter[w.lower()] * 1.0 / l
-
-    if opt['use_time'] > 0:
+    doc_len = len(ex['document'])
+    features = np.zeros((doc_len, len(feature_dict)), dtype=np.float32)
+
+    if doc_len > 0 and (opt['use_in_question'] or opt['use_tf']):
+        # give each distinct token of the example an id, so that the features
+        # below work on id arrays instead of strings
+        n_q = len(ex['question'])
+        tokens = ex['document'] + ex['question']
+        cased = np.unique(tokens, return_inverse=True)[1]
+        uncased = np.unique([w.lower() for w in tokens],
+                            return_inverse=True)[1]
+
+        # f_{exact_match}
+        if opt['use_in_question']:
+            features[:, feature_dict['in_question']] = np.isin(
+                cased[:doc_len], cased[doc_len:])
+            features[:, feature_dict['in_question_uncased']] = np.isin(
+                uncased[:doc_len], uncased[doc_len:])
+
+        # f_{tf}
+        if opt['use_tf']:
+            counts = np.bincount(uncased[:doc_len],
+                                 minlength=len(tokens) - n_q)
+            features[:, feature_dict['tf']] = (
+                counts[uncased[:doc_len]] * 1.0 / doc_len)
+
+    if opt['use_time'] > 0 and doc_len > 0:
         # Counting from the end, each (full-stop terminated) sentence gets
-        # its own time identitfier.
-        sent_idx = 0
-
-        def _full_stop(w):
-            return w in {'.', '?', '!'}
-        for i, w in reversed(list(enumerate(ex['document']))):
-            sent_idx = sent_idx + 1 if _full_stop(w) else max(sent_idx, 1)
-            if sent_idx < opt['use_time']:
-                features[i][feature_dict['time=T%d' % sent_idx]] = 1.0
-            else:
-                features[i][feature_dict['time>=T%d' % opt['use_time']]] = 1.0
+        # its own time identitfier: the last token is in sentence 1, and
+        # every full stop before it starts a new sentence.
+        full_stops = np.array([w in {'.', '?', '!'} for w in ex['document']])
+        stops_after = np.cumsum(full_stops[::-1])[::-1]
+        sent_idx = 1 + stops_after - full_stops[-1]
+        time_cols = np.array(
+            [feature_dict['time=T%d' % (i + 1)]
+             for i in range(opt['use_time'] - 1)] +
+            [feature_dict['time>=T%d' % opt['use_time']]]
+        )
+        features[np.arange(doc_len),
+                 time_cols[np.minimum(sent_idx, opt['use_time']) - 1]] = 1.0
+
+    features = torch.from_numpy(features)
 
     # Maybe return without target
     if ex['target'] is None:
@@ -133,7 +158,7 @@ def batchify(batch, null=0, cuda=False):
     # Batch documents and features
     max_length = max([d.size(0) for d in docs])
     x1 = torch.LongTensor(len(docs), max_length).fill_(null)
-    x1_mask = torch.ByteTensor(len(docs), max_length).fill_(1)
+    x1_mask = torch.ones(len(docs), max_length, dtype=torch.bool)
     x1_f = torch.zeros(len(docs), max_length, features[0].size(1))
     for i, d in enumerate(docs):
         x1[i, :d.size(0)].copy_(d)
@@ -143,7 +168,7 @@ def batchify(batch, null=0, cuda=False):
     # Batch questions
     max_length = max([q.size(0) for q in questions])
     x2 = torch.LongTensor(len(questions), max_length).fill_(null)
-    x2_mask = torch.ByteTensor(len(questions), max_length).fill_(1)
+    x2_mask = torch.ones(len(questions), max_length, dtype=torch.bool)
     for i, q in enumerate(questions):
         x2[i, :q.size(0)].copy_(q)
         x2_mask[i, :q.size(0)].fill_(0)
@@ -170,6 +195,107 @@ def batchify(batch, null=0, cuda=False):
     raise RuntimeError('Wrong number of inputs per batch')
 
 
+def decode_spans(score_s, score_e, max_len=None):
+    """Find the best answer span of every example in a batch.
+
+    Maximizes score_s[i] * score_e[j] over i <= j < i + max_len, using the
+    max of score_e over the window following each start instead of scoring
+    every (start, end) pair. Scores must be non-negative.
+    Returns the start and end indices and the score of each best span.
+    """
+    length = score_s.size(1)
+    max_len = min(max_len or length, length)
+    # windowed max of the end scores: best_e[:, i] = max(score_e[:, i:i+L])
+    padded = torch.cat(
+        [score_e, score_e.new_zeros(score_e.size(0), max_len - 1)], 1
+    )
+    best_e, offsets = padded.unfold(1, max_len, 1).max(2)
+    scores, s_idx = (score_s * best_e).max(1)
+    e_idx = s_idx + offsets.gather(1, s_idx.unsqueeze(1)).squeeze(1)
+    return s_idx, e_idx, scores
+
+
+# ------------------------------------------------------------------------------
+# Tokenization cache.
+# ------------------------------------------------------------------------------
+
+
+class TokenCache(object):
+    """Tokenize texts with a dictionary, caching the results on disk.
+
+    Texts are keyed by a hash of the text and of the tokenizer settings.
+    Tokens are stored joined by a separator character, and character spans
+    as int32 arrays, in a sqlite database.
+    """
+
+    SEP = '\x1f'
+
+    def __init__(self, path, word_dict, commit_every=1000):
+        self.word_dict = word_dict
+        self.commit_every = commit_every
+        self.num_pending = 0
+        self.settings = '{}\t{}\t{}\t'.format(
+            word_dict.tokenizer, word_dict.lower,
+            getattr(word_dict, 'max_ngram_size', -1)
+        )
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS tokens '
+                          '(key BLOB PRIMARY KEY, tokens TEXT, spans BLOB);')
+
+    def _key(self, kind, text):
+        return hashlib.sha1(
+            (self.settings + kind + '\t' + text).encode('utf-8')
+        ).digest()
+
+    def _get(self, key):
+        return self.conn.execute(
+            'SELECT tokens, spans FROM tokens WHERE key = ?', (key,)
+        ).fetchone()
+
+    def _put(self, key, tokens, spans=None):
+        if spans is not None:
+            spans = np.array(spans, dtype=np.int32).tobytes()
+        self.conn.execute('INSERT OR REPLACE INTO tokens VALUES (?, ?, ?)',
+                          (key, self.SEP.join(tokens), spans))
+        self.num_pending += 1
+        if self.num_pending >= self.commit_every:
+            self.commit()
+
+    def _split(self, tokens):
+        return tokens.split(self.SEP) if tokens else []
+
+    def tokenize(self, text):
+        """Return the tokens of text."""
+        key = self._key('tokenize', text)
+        row = self._get(key)
+        if row is not None:
+            return self._split(row[0])
+        tokens = self.word_dict.tokenize(text)
+        self._put(key, tokens)
+        return tokens
+
+    def span_tokenize(self, text):
+        """Return the tokens of text and their character spans."""
+        key = self._key('span_tokenize', text)
+        row = self._get(key)
+        if row is not None:
+            spans = np.frombuffer(row[1], dtype=np.int32).reshape(-1, 2)
+            return self._split(row[0]), spans.tolist()
+        tokens, spans = self.word_dict.span_tokenize(text)
+        self._put(key, tokens, spans)
+        return tokens, spans
+
+    def commit(self):
+        """Write the newly tokenized texts to disk."""
+        if self.num_pending > 0:
+            self.conn.commit()
+            self.num_pending = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+
 # ------------------------------------------------------------------------------
 # General logging utilities.
 # ------------------------------------------------------------------------------
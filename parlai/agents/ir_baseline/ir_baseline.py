@@ -26,6 +26,8 @@ import math
 from collections.abc import Sequence
 import heapq
 
+import numpy as np
+
 from parlai.core.agents import Agent
 from parlai.core.dict import DictionaryAgent
 
@@ -40,6 +42,7 @@ class MaxPriorityQueue(Sequence):
         """
         self.capacity = max_size
         self.lst = []
+        self.sorted = None
 
     def add(self, item, priority=None):
         """Add element to the queue, with a separate priority if desired.
@@ -53,6 +56,7 @@ class MaxPriorityQueue(Sequence):
         """
         if priority is None:
             priority = item
+        self.sorted = None
         if len(self.lst) < self.capacity:
             heapq.heappush(self.lst, (priority, item))
         elif priority > self.lst[0][0]:
@@ -65,7 +69,10 @@ class MaxPriorityQueue(Sequence):
 
         :returns: item stored at the specified index.
         """
-        return sorted(self.lst)[key][1]
+        if self.sorted is None:
+            # sort once until the next add
+            self.sorted = sorted(self.lst)
+        return self.sorted[key][1]
 
     def __len__(self):
         """Return length of priority queue."""
@@ -91,6 +98,13 @@ stopwords = {
 }
 
 
+def tokenize(text, dictionary=None):
+    """Split text into lower-cased tokens, as score_match does."""
+    if not dictionary:
+        return text.lower().split(' ')
+    return [w for w in dictionary.tokenize(text.lower())]
+
+
 def score_match(query_rep, text, length_penalty, dictionary=None, debug=False):
     """Calculate the score match between the query representation the text.
 
@@ -104,10 +118,7 @@ def score_match(query_rep, text, length_penalty, dictionary=None, debug=False):
     """
     if text == "":
         return 0
-    if not dictionary:
-        words = text.lower().split(' ')
-    else:
-        words = [w for w in dictionary.tokenize(text.lower())]
+    words = tokenize(text, dictionary)
     score = 0
     rw = query_rep['words']
     used = {}
@@ -152,6 +163,64 @@ def rank_candidates(query_rep, cands, length_penalty, dictionary=None):
         return res
 
 
+class CandidateIndex(object):
+    """Inverted index over a fixed list of candidates.
+
+    Candidates are tokenized once, and each query only visits the candidates
+    containing one of its words. Scores match score_match, and ties are
+    broken by the candidate string.
+    """
+
+    def __init__(self, cands, dictionary=None):
+        """Build the index.
+
+        :param cands: list of candidate strings.
+        :param dictionary: optional dictionary to use to tokenize candidates
+        """
+        self.cands = list(cands)
+        postings = {}
+        self.norms = np.zeros(len(self.cands))
+        for i, c in enumerate(self.cands):
+            if c == "":
+                continue
+            words = set(tokenize(c, dictionary))
+            for w in words:
+                postings.setdefault(w, []).append(i)
+            self.norms[i] = math.sqrt(len(words))
+        self.postings = {w: np.array(ids) for w, ids in postings.items()}
+        # position of each candidate in sorted order, to break ties
+        self.string_rank = np.empty(len(self.cands), dtype=np.int64)
+        self.string_rank[sorted(range(len(self.cands)),
+                                key=self.cands.__getitem__)] = (
+            np.arange(len(self.cands)))
+
+    def rank(self, query_rep, length_penalty, k=100):
+        """Rank candidates given representation of query.
+
+        :param query_rep: base query representation to match text again.
+        :param length_penalty: scores are divided by the norm taken to this
+                               power
+        :param k: number of candidates to return
+
+        :returns: list of the k best candidate strings in score-ranked order
+        """
+        scores = np.zeros(len(self.cands))
+        for w, weight in query_rep['words'].items():
+            ids = self.postings.get(w)
+            if ids is not None:
+                scores[ids] += weight
+        norms = np.power(self.norms * query_rep['norm'], length_penalty)
+        np.divide(scores, norms, out=scores, where=norms > 1)
+
+        if len(scores) > k:
+            threshold = np.partition(scores, -k)[-k]
+            ids = np.where(scores >= threshold)[0]
+        else:
+            ids = np.arange(len(scores))
+        order = np.lexsort((self.string_rank[ids], scores[ids]))[::-1][:k]
+        return [self.cands[i] for i in ids[order]]
+
+
 class IrBaselineAgent(Agent):
     """Information Retrieval baseline."""
 
@@ -179,9 +248,24 @@ class IrBaselineAgent(Agent):
         self.opt = opt
         self.history = []
         self.episodeDone = True
-        if opt.get('label_candidates_file'):
+        if shared and 'cand_index' in shared:
+            self.label_candidates = shared['label_candidates']
+            self.cand_index = shared['cand_index']
+        elif opt.get('label_candidates_file'):
             f = open(opt.get('label_candidates_file'))
             self.label_candidates = f.read().split('\n')
+            # the candidates are fixed, so index them once
+            self.cand_index = CandidateIndex(
+                self.label_candidates, self.dictionary
+            )
+
+    def share(self):
+        """Share the candidate index."""
+        shared = super().share()
+        if hasattr(self, 'cand_index'):
+            shared['label_candidates'] = self.label_candidates
+            shared['cand_index'] = self.cand_index
+        return shared
 
     def reset(self):
         """Reset agent properties."""
@@ -221,9 +305,14 @@ class IrBaselineAgent(Agent):
             left_idx = max(0, len(self.history) - hist_sz)
             text = ' '.join(self.history[left_idx:len(self.history)])
             rep = self.build_query_representation(text)
-            reply['text_candidates'] = (
-                rank_candidates(rep, cands,
-                                self.length_penalty, self.dictionary))
+            if hasattr(self, 'cand_index'):
+                reply['text_candidates'] = self.cand_index.rank(
+                    rep, self.length_penalty
+                )
+            else:
+                reply['text_candidates'] = (
+                    rank_candidates(rep, cands,
+                                    self.length_penalty, self.dictionary))
             reply['text'] = reply['text_candidates'][0]
         else:
             reply['text'] = "I don't know."
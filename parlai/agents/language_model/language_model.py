@@ -8,9 +8,10 @@
 
 from parlai.core.agents import Agent
 from parlai.core.dict import DictionaryAgent
-from parlai.core.utils import PaddingUtils, round_sigfigs
+from parlai.core.utils import PaddingUtils, padded_tensor, round_sigfigs
 from parlai.core.thread_utils import SharedTable
 from .modules import RNNModel
+from .token_stream import TokenStream
 
 import torch
 from torch.autograd import Variable
@@ -19,6 +20,7 @@ import torch.nn as nn
 import os
 import math
 import json
+import random
 
 
 class LanguageModelAgent(Agent):
@@ -64,6 +66,11 @@ class LanguageModelAgent(Agent):
                            help='truncate predictions')
         agent.add_argument('-rf', '--report-freq', type=float, default=0.1,
                            help='report frequency of prediction during eval')
+        agent.add_argument('--eval-bucket-ratio', type=float, default=0.5,
+                           help='during eval, split each batch into buckets of '
+                           'similar length: a new bucket starts with the first '
+                           'example shorter than this fraction of the longest '
+                           'one in the bucket. 0 disables bucketing')
         agent.add_argument('-pt', '--person-tokens', type='bool', default=True,
                            help='append person1 and person2 tokens to text')
         # learning rate parameters
@@ -176,8 +183,10 @@ class LanguageModelAgent(Agent):
             if self.use_cuda:
                 self.model.cuda()
 
-        self.next_observe = []
-        self.next_batch = []
+        # token ids waiting to fill a sequence, and sequences of
+        # seq_len + 1 tokens waiting to fill a batch
+        self.next_observe = TokenStream()
+        self.next_batch = TokenStream(width=opt['seq_len'] + 1)
 
         self.is_training = True
 
@@ -307,7 +316,7 @@ class LanguageModelAgent(Agent):
                     obs['text'] = 'PERSON1 ' + obs['text']
                 vec = self.parse(obs['text'])
                 vec.append(self.END_IDX)
-                self.next_observe += vec
+                self.next_observe.append(vec)
             if 'labels' in obs:
                 if self.use_person_tokens:
                     labels = [
@@ -318,7 +327,7 @@ class LanguageModelAgent(Agent):
                     obs['labels'] = tuple(labels)
                 vec = self.parse(obs['labels'][0])
                 vec.append(self.END_IDX)
-                self.next_observe += vec
+                self.next_observe.append(vec)
             if len(self.next_observe) < (seq_len + 1):
                 # not enough to return to make a batch
                 # we handle this case in vectorize
@@ -326,12 +335,10 @@ class LanguageModelAgent(Agent):
                 self.observation = {'labels': ''}
                 return self.observation
             else:
-                vecs_to_return = []
                 total = len(self.next_observe) // (seq_len + 1)
-                for _ in range(total):
-                    observe = self.next_observe[:(seq_len + 1)]
-                    self.next_observe = self.next_observe[(seq_len + 1):]
-                    vecs_to_return.append(observe)
+                vecs_to_return = self.next_observe.pop(
+                    total * (seq_len + 1)
+                ).view(total, seq_len + 1)
                 dict_to_return = {'text': '', 'labels': '', 'text2vec': vecs_to_return}
                 self.observation = dict_to_return
                 return dict_to_return
@@ -371,23 +378,16 @@ class LanguageModelAgent(Agent):
 
         # feed in inputs without end token
         output, hidden = self.model(data.transpose(0, 1), hidden)
-        self.hidden = self.repackage_hidden(hidden)
-        # feed in end tokens
-        output, hidden = self.model(Variable(self.ends[:bsz].view(1, bsz)), self.hidden)
-        self.hidden = self.repackage_hidden(hidden)
-        output_flat = output.view(-1, len(self.dict))
-        loss += self.criterion(output_flat, targets.select(1, 0).view(-1)).data
-
-        for i in range(1, targets.size(1)):
-            output, hidden = self.model(
-                targets.select(1, i - 1).view(1, bsz),
-                self.hidden,
-                no_pack=True
-            )
-            self.hidden = self.repackage_hidden(hidden)
-            output_flat = output.view(-1, len(self.dict))
-            loss += self.criterion(output_flat, targets.select(1, i).view(-1)).data
-
+        hidden = self.repackage_hidden(hidden)
+        # feed in the end token followed by all but the last target token, so
+        # that every output predicts the next target token
+        inputs = torch.cat([self.ends[:bsz].view(1, bsz),
+                            targets.t()[:-1]])
+        output, hidden = self.model(inputs, hidden, no_pack=True)
+        # padding positions are ignored by the criterion
+        loss += self.criterion(
+            output.view(-1, len(self.dict)), targets.t().contiguous().view(-1)
+        ).data
         return loss
 
     def get_predictions(self, data):
@@ -469,11 +469,10 @@ class LanguageModelAgent(Agent):
         else:
             self.model.eval()
             predictions = self.get_predictions(data)
-            bsz = data.size(0)
-            if bsz != self.batchsize:
-                self.hidden = self.model.init_hidden(bsz)
             if targets is not None:
-                loss = self.get_target_loss(data, self.hidden, targets)
+                loss = self.get_target_loss(
+                    data, self.model.init_hidden(data.size(0)), targets
+                )
                 self.metrics['loss'] += loss
                 self.metrics['num_tokens'] += sum(y_lens)
 
@@ -488,7 +487,7 @@ class LanguageModelAgent(Agent):
             for obs in observations:
                 if obs:
                     if 'text2vec' in obs:
-                        self.next_batch += obs['text2vec']
+                        self.next_batch.append(obs['text2vec'])
             if len(self.next_batch) <= self.batchsize:
                 return None, None, None, None, None
             else:
@@ -496,39 +495,73 @@ class LanguageModelAgent(Agent):
                 targets_list = []
                 # total is the number of batches
                 total = len(self.next_batch) // self.batchsize
-                for _ in range(total):
-                    batch = self.next_batch[:self.batchsize]
-                    self.next_batch = self.next_batch[self.batchsize:]
-
-                    source = torch.LongTensor(batch).t().contiguous()
-                    data = Variable(source[:seq_len])
-                    targets = Variable(source[1:])
+                # one [total, seq_len + 1, bsz] tensor, which every batch is
+                # a view of
+                source = self.next_batch.pop(total * self.batchsize).view(
+                    total, self.batchsize, seq_len + 1
+                ).transpose(1, 2).contiguous()
+                if self.use_cuda:
+                    source = source.cuda()
+                for i in range(total):
+                    data_list.append(source[i, :seq_len])
+                    targets_list.append(source[i, 1:])
+        else:
+            data_list, targets_list, labels, valid_inds, y_lens = (
+                self.vectorize_eval(observations)
+            )
+            if not data_list:
+                return None, None, None, None, None
 
-                    if self.use_cuda:
-                        data = data.cuda()
-                        targets = targets.cuda()
+        return data_list, targets_list, labels, valid_inds, y_lens
 
-                    data_list.append(data)
-                    targets_list.append(targets)
-        else:
-            # here we get valid examples and pad them with zeros
-            xs, ys, labels, valid_inds, _, y_lens = PaddingUtils.pad_text(
-                observations, self.dict, end_idx=self.END_IDX,
-                null_idx=self.NULL_IDX)
+    def vectorize_eval(self, observations):
+        """Convert eval observations into batches of similar length.
 
-            if self.use_cuda:
-                if xs is not None:
-                    xs = Variable(torch.LongTensor(xs)).cuda()
-                if ys is not None:
-                    ys = Variable(torch.LongTensor(ys)).cuda()
+        Valid examples are sorted by input length (needed for packing) and
+        split into buckets according to --eval-bucket-ratio. Returns one list
+        entry per bucket for each of the outputs of vectorize.
+        """
+        exs = []
+        some_labels_avail = any('labels' in obs or 'eval_labels' in obs
+                                for obs in observations)
+        for i, obs in enumerate(observations):
+            if 'text' not in obs or len(obs['text']) == 0:
+                continue
+            label = None
+            y = None
+            if some_labels_avail:
+                label = random.choice(
+                    obs.get('labels', obs.get('eval_labels', ['']))
+                )
+                y = self.parse(label) + [self.END_IDX]
+            exs.append((i, self.parse(obs['text']), y, label))
+        exs.sort(key=lambda ex: -len(ex[1]))
+
+        ratio = self.opt.get('eval_bucket_ratio', 0.5)
+        buckets = []
+        for ex in exs:
+            if not buckets or len(ex[1]) < ratio * len(buckets[-1][0][1]):
+                buckets.append([])
+            buckets[-1].append(ex)
+
+        data_list = []
+        targets_list = []
+        labels = []
+        valid_inds = []
+        y_lens = []
+        for bucket in buckets:
+            inds, xs, ys, bucket_labels = zip(*bucket)
+            data_list.append(
+                padded_tensor(xs, self.NULL_IDX, self.use_cuda)[0]
+            )
+            if some_labels_avail:
+                ys, lens = padded_tensor(ys, self.NULL_IDX, self.use_cuda)
             else:
-                if xs is not None:
-                    xs = Variable(torch.LongTensor(xs))
-                if ys is not None:
-                    ys = Variable(torch.LongTensor(ys))
-            data_list = [xs]
-            targets_list = [ys]
-
+                ys, lens = None, None
+            targets_list.append(ys)
+            labels.append(list(bucket_labels))
+            valid_inds.append(list(inds))
+            y_lens.append(lens)
         return data_list, targets_list, labels, valid_inds, y_lens
 
     def batch_act(self, observations):
@@ -554,35 +587,39 @@ class LanguageModelAgent(Agent):
             # not enough data to batch act yet, return empty responses
             return batch_reply
 
+        if not self.is_training:
+            # one batch per bucket of similar length
+            for i in range(len(data_list)):
+                _, _, predictions = self.predict(
+                    data_list[i], None, targets_list[i], self.is_training,
+                    y_lens[i]
+                )
+                # map predictions back to the right order
+                PaddingUtils.map_predictions(
+                    predictions.cpu(), valid_inds[i], batch_reply,
+                    observations, self.dict, self.END_IDX,
+                    report_freq=self.opt['report_freq'])
+            return self._remove_person_tokens(batch_reply)
+
         batch_reply = []
-        # during evaluation, len(data_list) is always 1
         # during training, len(dat_list) >= 0: vectorize returns a list
         #     containing all batches available at the time it is called
         for i in range(len(data_list)):
             temp_dicts = [{'id': self.getID()} for _ in range(len(observations))]
-            # ignore case when we do not return any valid indices
-            if data_list[i] is not None:
-                output, hidden, predictions = self.predict(
-                    data_list[i], self.hidden, targets_list[i],
-                    self.is_training, y_lens
-                )
-                self.hidden = self.repackage_hidden(hidden)
-
-                if predictions is not None:
-                    # map predictions back to the right order
-                    PaddingUtils.map_predictions(
-                        predictions.cpu(), valid_inds, temp_dicts, observations,
-                        self.dict, self.END_IDX, report_freq=self.opt['report_freq'])
-
+            output, hidden, predictions = self.predict(
+                data_list[i], self.hidden, targets_list[i],
+                self.is_training, y_lens
+            )
+            self.hidden = self.repackage_hidden(hidden)
             batch_reply += temp_dicts
+        return batch_reply
 
+    def _remove_person_tokens(self, batch_reply):
         # for prediction metrics computations, we get rid of PERSON1 and PERSON2 tokens
-        if not self.is_training:
-            for reply in batch_reply:
-                if 'text' in reply:
-                    reply['text'] = reply['text'].replace('PERSON1 ', '')
-                    reply['text'] = reply['text'].replace('PERSON2 ', '')
-
+        for reply in batch_reply:
+            if 'text' in reply:
+                reply['text'] = reply['text'].replace('PERSON1 ', '')
+                reply['text'] = reply['text'].replace('PERSON2 ', '')
         return batch_reply
 
     def act(self):
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+"""Token buffers for streaming language model data."""
+
+import numpy as np
+import torch
+
+
+class TokenStream(object):
+    """First-in first-out ring buffer of token ids, backed by a LongTensor.
+
+    Items are single tokens, or rows of ``width`` tokens if width is given.
+    Appending and popping copy only the items involved, so streaming n
+    tokens through the buffer costs O(n) no matter how it is chunked.
+    """
+
+    def __init__(self, width=None, capacity=1024):
+        self.item_shape = () if width is None else (width,)
+        self.buffer = torch.LongTensor(capacity, *self.item_shape)
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _grow(self, min_capacity):
+        capacity = max(min_capacity, 2 * self.buffer.size(0))
+        buffer = torch.LongTensor(capacity, *self.item_shape)
+        buffer[:self.size] = self._read(self.size)
+        self.buffer = buffer
+        self.start = 0
+
+    def _read(self, n):
+        """Return the first n items, as a view if they do not wrap around."""
+        capacity = self.buffer.size(0)
+        end = self.start + n
+        if end <= capacity:
+            return self.buffer[self.start:end]
+        return torch.cat([self.buffer[self.start:],
+                          self.buffer[:end - capacity]])
+
+    def append(self, items):
+        """Add a list or tensor of items at the end of the stream."""
+        if not torch.is_tensor(items):
+            items = torch.LongTensor(items)
+        items = items.view(-1, *self.item_shape)
+        n = items.size(0)
+        if self.size + n > self.buffer.size(0):
+            self._grow(self.size + n)
+        capacity = self.buffer.size(0)
+        end = (self.start + self.size) % capacity
+        first = min(n, capacity - end)
+        self.buffer[end:end + first] = items[:first]
+        self.buffer[:n - first] = items[first:]
+        self.size += n
+
+    def pop(self, n):
+        """Remove the first n items from the stream and return them."""
+        if n > self.size:
+            raise IndexError('cannot pop {} items from a stream of {}'.format(
+                n, self.size))
+        items = self._read(n).clone()
+        self.start = (self.start + n) % self.buffer.size(0)
+        self.size -= n
+        return items
+
+
+class PretokenizedCorpus(object):
+    """Language model batches from a corpus stored as a flat array of ids.
+
+    The corpus is split into ``bsz`` contiguous streams, as in the PyTorch
+    word_language_model example, and every batch is a ``[seq_len, bsz]``
+    window of the streams. Only the tokens of the current window are copied
+    into memory, so the corpus itself can stay memory-mapped.
+    """
+
+    def __init__(self, path, mmap=True):
+        self.tokens = np.load(path, mmap_mode='r' if mmap else None)
+
+    @staticmethod
+    def write(path, vecs, end_idx=None):
+        """Save the concatenation of token id lists to a .npy file.
+
+        If end_idx is given, it is appended after each list.
+        """
+        tokens = []
+        for vec in vecs:
+            tokens.extend(vec)
+            if end_idx is not None:
+                tokens.append(end_idx)
+        np.save(path, np.array(tokens, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def batches(self, bsz, seq_len):
+        """Yield (data, targets) pairs of ``[seq_len, bsz]`` LongTensors.
+
+        The targets are the data shifted by one token. The last pair may be
+        shorter than seq_len.
+        """
+        stream_len = len(self.tokens) // bsz
+        # a view of the (memory-mapped) tokens, one stream per row
+        streams = self.tokens[:stream_len * bsz].reshape(bsz, stream_len)
+        for i in range(0, stream_len - 1, seq_len):
+            length = min(seq_len, stream_len - 1 - i)
+            # copy the window of this batch, with one more token for targets
+            window = torch.from_numpy(
+                np.array(streams[:, i:i + length + 1].T, dtype=np.int64,
+                         order='C')
+            )
+            yield window[:-1], window[1:]
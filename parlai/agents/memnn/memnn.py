@@ -47,6 +47,11 @@ class MemnnAgent(TorchRankerAgent):
         arg_group.add_argument(
             '-pe', '--position-encoding', type='bool', default=False,
             help='use position encoding instead of bag of words embedding')
+        arg_group.add_argument(
+            '--mem-cache-size', type=int, default=0,
+            help='during evaluation, cache the embeddings of up to this many '
+                 'memories, so memories repeated across the turns of an '
+                 'episode are only embedded once')
         TorchRankerAgent.add_cmdline_args(argparser)
         MemnnAgent.dictionary_class().add_cmdline_args(argparser)
         return arg_group
@@ -8,14 +8,16 @@
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
-from functools import lru_cache
+from collections import OrderedDict
 
 
 def opt_to_kwargs(opt):
     """Get kwargs for seq2seq from opt."""
     kwargs = {}
-    for k in ['mem_size', 'time_features', 'position_encoding', 'hops']:
+    for k in ['mem_size', 'time_features', 'position_encoding', 'hops',
+              'mem_cache_size']:
         if k in opt:
             kwargs[k] = opt[k]
     return kwargs
@@ -27,7 +29,7 @@ class MemNN(nn.Module):
     def __init__(
         self, num_features, embedding_size, hops=1,
         mem_size=32, time_features=False, position_encoding=False,
-        dropout=0, padding_idx=0,
+        dropout=0, padding_idx=0, mem_cache_size=0,
     ):
         """Initialize memnn model.
 
@@ -66,6 +68,46 @@ class MemNN(nn.Module):
         self.answer_embedder = embedding()
         self.memory_hop = Hop(embedding_size)
 
+        # during evaluation, memories repeated across the turns of an episode
+        # are embedded once
+        self.mem_cache_size = mem_cache_size
+        self.mem_cache = OrderedDict()
+
+    def _embed_mems(self, mems):
+        """Embed memories for the input and output of the hops.
+
+        :param mems: (bsz x num_mems x seqlen) LongTensor memories
+
+        :returns: (bsz x num_mems x esz) input and output memory embeddings
+        """
+        if self.training or self.mem_cache_size <= 0:
+            # the weights change during training
+            self.mem_cache.clear()
+            return self.in_memory_lt(mems), self.out_memory_lt(mems)
+
+        bsz, num_mems, seqlen = mems.size()
+        flat = mems.view(-1, seqlen)
+        # position encoding depends on the padded length, so it's in the key
+        keys = [(seqlen,) + tuple(row) for row in flat.tolist()]
+        missing = OrderedDict()
+        for i, key in enumerate(keys):
+            if key in self.mem_cache:
+                self.mem_cache.move_to_end(key)
+            else:
+                missing.setdefault(key, i)
+        if missing:
+            rows = flat[list(missing.values())]
+            in_embs = self.in_memory_lt(rows)
+            out_embs = self.out_memory_lt(rows)
+            for key, in_emb, out_emb in zip(missing, in_embs, out_embs):
+                self.mem_cache[key] = (in_emb, out_emb)
+        in_embs = torch.stack([self.mem_cache[key][0] for key in keys])
+        out_embs = torch.stack([self.mem_cache[key][1] for key in keys])
+        while len(self.mem_cache) > self.mem_cache_size:
+            self.mem_cache.popitem(last=False)
+        return (in_embs.view(bsz, num_mems, -1),
+                out_embs.view(bsz, num_mems, -1))
+
     def _score(self, output, cands):
         if cands.dim() == 2:
             return torch.matmul(output, cands.t())
@@ -93,8 +135,8 @@ class MemNN(nn.Module):
         state = self.query_lt(xs)
         if mems is not None:
             # no memories available, `nomemnn` mode just uses query/ans embs
-            in_memory_embs = self.in_memory_lt(mems).transpose(1, 2)
-            out_memory_embs = self.out_memory_lt(mems)
+            in_memory_embs, out_memory_embs = self._embed_mems(mems)
+            in_memory_embs = in_memory_embs.transpose(1, 2)
 
             for _ in range(self.hops):
                 state = self.memory_hop(state, in_memory_embs, out_memory_embs)
@@ -128,60 +170,52 @@ class Embed(nn.Embedding):
         self.reduction = reduction
         super().__init__(*args, **kwargs)
 
-    def _reduce(self, embs, input):
-        # last dimension is embedding, do operation over dim before that
-        if self.reduction == 'sum':
-            return embs.sum(-2)
-        elif self.reduction == 'mean':
-            # this is more fair than mean(-2) since mean includes null tokens
-            sum = embs.sum(-2)
-            lens = input.ne(0).sum(-1).unsqueeze(-1).float()
-            return sum / lens
-        else:
-            raise RuntimeError(
-                'reduction method {} not supported'.format(self.reduction))
-
     def forward(self, input):
         """Return BOW embedding with PE reweighting if enabled.
 
-        :param input: (bsz x seqlen) LongTensor
+        Sequences are embedded with embedding bags, so the embeddings of the
+        individual tokens are never materialized. Position encoding weights
+        are l_kj = (1 - j / J) - (k / d) (1 - 2j / J) for token j and
+        dimension k, so the encoding is the sum of a bag weighted by
+        (1 - j / J) and a bag weighted by -(1 - 2j / J) scaled by k / d.
 
-        :returns: (bsz x esz) FloatTensor
+        :param input: (bsz x seqlen) or (bsz x num_mems x seqlen) LongTensor
+
+        :returns: (bsz x esz) or (bsz x num_mems x esz) FloatTensor
         """
-        embs = super().forward(input)
+        seqlen = input.size(-1)
+        flat = input.contiguous().view(-1, seqlen)
         if self.position_encoding:
-            if embs.dim() == 3:
-                num_mems, seqlen, embdim = embs.size()
-                pe = self.position_matrix(seqlen, embdim, embs.is_cuda)
-                for i in range(num_mems):
-                    embs[i] *= pe
-            else:
-                bsz, num_mems, seqlen, embdim = embs.size()
-                pe = self.position_matrix(seqlen, embdim, embs.is_cuda)
-                for i in range(num_mems):
-                    embs[:, i] *= pe
-        return self._reduce(embs, input)
-
-    @staticmethod
-    @lru_cache(maxsize=128)
-    def position_matrix(J, d, use_cuda):
-        """Build matrix of position encoding coeffiencents.
-
-        See https://papers.nips.cc/paper/5846-end-to-end-memory-networks,
-        section 4.1 Model Details: Sentence Representation.
-
-        :param J: number of words in the sequence
-        :param d: dimension of the embedding
+            j = torch.arange(1, seqlen + 1, dtype=self.weight.dtype,
+                             device=self.weight.device) / seqlen
+            k = torch.arange(1, self.embedding_dim + 1,
+                             dtype=self.weight.dtype,
+                             device=self.weight.device) / self.embedding_dim
+            embs = F.embedding_bag(
+                flat, self.weight, mode='sum', padding_idx=self.padding_idx,
+                per_sample_weights=(1 - j).expand_as(flat).contiguous()
+            )
+            embs = embs + k * F.embedding_bag(
+                flat, self.weight, mode='sum', padding_idx=self.padding_idx,
+                per_sample_weights=(2 * j - 1).expand_as(flat).contiguous()
+            )
+        else:
+            embs = F.embedding_bag(flat, self.weight, mode='sum',
+                                   padding_idx=self.padding_idx)
+        embs = self._reduce(embs, flat)
+        return embs.view(*input.size()[:-1], self.embedding_dim)
 
-        :returns: Position Encoding matrix
-        """
-        m = torch.Tensor(J, d)
-        for k in range(1, d + 1):
-            for j in range(1, J + 1):
-                m[j - 1, k - 1] = (1 - j / J) - (k / d) * (1 - 2 * j / J)
-        if use_cuda:
-            m = m.cuda()
-        return m
+    def _reduce(self, embs, input):
+        # embs are already summed over the sequence
+        if self.reduction == 'sum':
+            return embs
+        elif self.reduction == 'mean':
+            # this is more fair than mean(-2) since mean includes null tokens
+            lens = input.ne(0).sum(-1).unsqueeze(-1).float().clamp(min=1)
+            return embs / lens
+        else:
+            raise RuntimeError(
+                'reduction method {} not supported'.format(self.reduction))
 
 
 class Hop(nn.Module):
@@ -11,7 +11,7 @@ NOTE: this model only works for eval, it assumes all training is already done.
 """
 
 from parlai.core.agents import Agent
-from parlai.core.agents import create_agent
+from parlai.core.agents import create_agent, create_agent_from_shared
 import regex
 
 
@@ -21,13 +21,17 @@ class RetrieverReaderAgent(Agent):
         super().__init__(opt)
         self.id = 'RetrieverReaderAgent'
 
-        # Create retriever
-        retriever_opt = {'model_file': opt['retriever_model_file']}
-        self.retriever = create_agent(retriever_opt)
+        if shared:
+            self.retriever = create_agent_from_shared(shared['retriever'])
+            self.reader = create_agent_from_shared(shared['reader'])
+        else:
+            # Create retriever
+            retriever_opt = {'model_file': opt['retriever_model_file']}
+            self.retriever = create_agent(retriever_opt)
 
-        # Create reader
-        reader_opt = {'model_file': opt['reader_model_file']}
-        self.reader = create_agent(reader_opt)
+            # Create reader
+            reader_opt = {'model_file': opt['reader_model_file']}
+            self.reader = create_agent(reader_opt)
 
     @staticmethod
     def add_cmdline_args(argparser):
@@ -40,8 +44,18 @@ class RetrieverReaderAgent(Agent):
         agent.add_argument('--split-paragraphs', type='bool', default=True,
                            help='Whether to split the retrieved passages into '
                            'paragraphs')
+        agent.add_argument('--reader-batchsize', type=int, default=64,
+                           help='how many paragraphs the reader reads at once. '
+                           'Paragraphs of similar length are batched '
+                           'together.')
         return agent
 
+    def share(self):
+        shared = super().share()
+        shared['retriever'] = self.retriever.share()
+        shared['reader'] = self.reader.share()
+        return shared
+
     def observe(self, obs):
         self.retriever.observe(obs)
         self.observation = obs
@@ -69,33 +83,103 @@ class RetrieverReaderAgent(Agent):
             docs.append(' '.join(curr))
         return docs
 
-    def act(self):
-        act_retriever = self.retriever.act()
-        obs = self.observation
-        obs['episode_done'] = True
+    def _paragraphs(self, act_retriever):
+        """Return the paragraphs of the passages retrieved for one question."""
         retrieved_txt = act_retriever.get('text', '')
         cands = act_retriever.get('text_candidates', [])
         if len(cands) > 0:
             retrieved_txts = cands[:self.opt['num_retrieved']]
         else:
             retrieved_txts = [retrieved_txt]
-        text = obs['text']
-        reader_acts = []
-        retrieved_txts = [r for r in retrieved_txts if r != '']
+        paragraphs = []
         for ret_txt in retrieved_txts:
+            if ret_txt == '':
+                continue
             if self.opt.get('split_paragraphs', False):
-                paragraphs = self._split_doc(ret_txt)
+                paragraphs.extend(self._split_doc(ret_txt))
             else:
-                paragraphs = [ret_txt]
-            for para in paragraphs:
-                obs['text'] = para + '\n' + text
-                self.reader.observe(obs)
-                act_reader = self.reader.act()
+                paragraphs.append(ret_txt)
+        return paragraphs
+
+    def _read(self, observations):
+        """Read all observations with the reader, in batches of similar length.
+
+        Returns the reader replies in the order of the observations.
+        """
+        order = sorted(range(len(observations)),
+                       key=lambda i: len(observations[i]['text']))
+        bsz = max(1, self.opt.get('reader_batchsize', 64))
+        replies = [None] * len(observations)
+        for start in range(0, len(order), bsz):
+            chunk = order[start:start + bsz]
+            chunk_replies = _batch_act(
+                self.reader, [observations[i] for i in chunk]
+            )
+            for i, reply in zip(chunk, chunk_replies):
+                replies[i] = reply
+        return replies
+
+    def _answer(self, observations, acts_retriever):
+        """Answer each question with the best span found by the reader in
+        any paragraph retrieved for it, reading all paragraphs together.
+        """
+        replies = [{'id': self.getID()} for _ in observations]
+
+        # every paragraph of every question becomes one reader observation
+        owners = []
+        paragraphs = []
+        reader_obs = []
+        for i, (obs, act_retriever) in enumerate(zip(observations,
+                                                     acts_retriever)):
+            for para in self._paragraphs(act_retriever):
+                owners.append(i)
+                paragraphs.append(para)
+                reader_obs.append(dict(obs, text=para + '\n' + obs['text'],
+                                       episode_done=True))
+
+        # keep the highest scoring answer of each question
+        best_scores = {}
+        for i, para, act_reader in zip(owners, paragraphs,
+                                       self._read(reader_obs)):
+            if 'candidate_scores' not in act_reader:
+                continue
+            score = act_reader['candidate_scores'][0]
+            if i not in best_scores or score > best_scores[i]:
+                best_scores[i] = score
                 act_reader['paragraph'] = para
-                reader_acts.append(act_reader)
-        if len(reader_acts) > 0:
-            best_act = max(reader_acts, key=lambda x: x['candidate_scores'][0])
-        else:
-            best_act = {'id': self.getID()}
+                replies[i] = act_reader
+        return replies
+
+    def act(self):
+        obs = self.observation
+        if 'text' not in obs:
+            return {'id': self.getID()}
+        # the retriever has already observed obs
+        return self._answer([obs], [self.retriever.act()])[0]
+
+    def batch_act(self, observations):
+        """Answer a batch of questions, reading all of their retrieved
+        paragraphs together.
+        """
+        batch_reply = [{'id': self.getID()} for _ in observations]
+        valid_inds = [i for i, obs in enumerate(observations) if 'text' in obs]
+        if len(valid_inds) == 0:
+            return batch_reply
+        valid_obs = [observations[i] for i in valid_inds]
+        replies = self._answer(valid_obs, _batch_act(self.retriever, valid_obs))
+        for i, reply in zip(valid_inds, replies):
+            batch_reply[i] = reply
+        return batch_reply
+
 
-        return best_act
+def _batch_act(agent, observations):
+    """Return the replies of agent to observations, observing and acting once
+    per observation if the agent does not implement batch_act.
+    """
+    if hasattr(agent, 'batch_act'):
+        return agent.batch_act(observations)
+    replies = []
+    for obs in observations:
+        agent.observe(obs)
+        replies.append(agent.act())
+    return replies
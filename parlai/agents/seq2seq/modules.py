@@ -102,6 +102,19 @@ class Seq2seq(TorchGeneratorModel):
             numsoftmax=numsoftmax, shared_weight=shared_weight,
             padding_idx=padding_idx)
 
+    def decode_sampled(self, xs, ys, samples, log_q):
+        """Decode with teacher forcing, scoring only a sample of the vocabulary.
+
+        See OutputLayer.sampled_forward for a description of the arguments
+        and the returned scores.
+        """
+        self.longest_label = max(self.longest_label, ys.size(1))
+        encoder_states = self.encoder(xs)
+        bsz, seqlen = ys.size()
+        inputs = torch.cat([self._starts(bsz), ys.narrow(1, 0, seqlen - 1)], 1)
+        latent, _ = self.decoder(inputs, encoder_states)
+        return self.output.sampled_forward(latent, ys, samples, log_q)
+
     def reorder_encoder_states(self, encoder_states, indices):
         """Reorder encoder states according to a new set of indices."""
         enc_out, hidden, attn_mask = encoder_states
@@ -135,6 +148,20 @@ class Seq2seq(TorchGeneratorModel):
 
         return enc_out, hidden, attn_mask
 
+    def extend_encoder_states(self, encoder_states, xs):
+        """Continue encoding from the encoder states of the preceding tokens.
+
+        Only supported by unidirectional encoders, and not with local
+        attention, which attends to a fixed window of the encoder outputs.
+        """
+        if self.encoder.dirs > 1 or self.attn_type == 'local':
+            return None
+        enc_out, hidden, attn_mask = encoder_states
+        new_out, hidden, new_mask = self.encoder(xs, hidden)
+        enc_out = torch.cat([enc_out, new_out], 1)
+        attn_mask = torch.cat([attn_mask, new_mask], 1)
+        return enc_out, hidden, attn_mask
+
     def reorder_decoder_incremental_state(self, incremental_state, inds):
         if torch.is_tensor(incremental_state):
             # gru or vanilla rnn
@@ -207,10 +234,13 @@ class RNNEncoder(nn.Module):
         else:
             self.rnn = shared_rnn
 
-    def forward(self, xs):
+    def forward(self, xs, hidden=None):
         """Encode sequence.
 
         :param xs: (bsz x seqlen) LongTensor of input token indices
+        :param hidden: optional (batch-first) hidden state to continue encoding
+            from, e.g. the final hidden state from encoding the tokens which
+            precede xs. not supported with bidirectional encoders.
 
         :returns: encoder outputs, hidden state, attention mask
             encoder outputs are the output state at each step of the encoding.
@@ -218,6 +248,15 @@ class RNNEncoder(nn.Module):
             the attention mask is a mask of which input values are nonzero.
         """
         bsz = len(xs)
+        if hidden is not None:
+            if self.dirs > 1:
+                raise RuntimeError('Cannot continue encoding with a '
+                                   'bidirectional encoder.')
+            hidden = _transpose_hidden_state(hidden)
+            if isinstance(hidden, tuple):
+                hidden = tuple(x.contiguous() for x in hidden)
+            else:
+                hidden = hidden.contiguous()
 
         # embed input tokens
         xs = self.input_dropout(xs)
@@ -231,7 +270,7 @@ class RNNEncoder(nn.Module):
             # packing failed, don't pack then
             packed = False
 
-        encoder_output, hidden = self.rnn(xes)
+        encoder_output, hidden = self.rnn(xes, hidden)
         if packed:
             # total_length to make sure we give the proper length in the case
             # of multigpu settings.
@@ -457,6 +496,38 @@ class OutputLayer(nn.Module):
 
         return scores
 
+    def sampled_forward(self, input, targets, samples, log_q):
+        """Compute scores for the targets and a shared sample of other tokens.
+
+        Used to train with a sampled softmax: every score is corrected by
+        subtracting the log probability of sampling that token, and sampled
+        tokens which equal the target are masked out.
+
+        :param input:   (bsz x seq_len x hiddensize) tensor of states
+        :param targets: (bsz x seq_len) LongTensor of true tokens
+        :param samples: (num_sampled) LongTensor of sampled tokens
+        :param log_q:   (num_features) tensor with the log probability of
+                        sampling each token
+
+        :returns: (bsz x seqlen x 1 + num_sampled) scores. Index 0 of the last
+                  dimension is the score of the target, the rest are the
+                  scores of the sampled tokens.
+        """
+        if self.numsoftmax > 1:
+            raise RuntimeError('Sampled softmax does not support numsoftmax > 1')
+        e = self.dropout(self.o2e(input))
+        true_scores = (
+            (e * self.weight[targets]).sum(-1) +
+            self.bias[targets] - log_q[targets]
+        )
+        sample_scores = F.linear(
+            e, self.weight[samples], self.bias[samples] - log_q[samples]
+        )
+        # a sample which is the target should not count as a negative
+        hits = (targets.unsqueeze(-1) == samples).float()
+        sample_scores = sample_scores - hits * NEAR_INF
+        return torch.cat([true_scores.unsqueeze(-1), sample_scores], -1)
+
 
 class AttentionLayer(nn.Module):
     """Computes attention between hidden and encoder states.
@@ -11,6 +11,7 @@ from .modules import Seq2seq, opt_to_kwargs
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 import json
 
@@ -89,6 +90,16 @@ class Seq2seqAgent(TorchGeneratorAgent):
                                 'softmax (see arxiv.org/abs/1711.03953).')
         agent.add_argument('-idr', '--input-dropout', type=float, default=0.0,
                            help='Probability of replacing tokens with UNK in training.')
+        agent.add_argument('--sampled-softmax', type=int, default=0,
+                           help='If > 0, train with a sampled softmax which '
+                                'scores the targets against this many tokens '
+                                'sampled according to their dictionary '
+                                'frequency, instead of the full vocabulary. '
+                                'Evaluation always uses the full softmax.')
+        agent.add_argument('--sampled-softmax-power', type=float, default=0.75,
+                           hidden=True,
+                           help='Power applied to the token frequencies to '
+                                'get the sampling distribution.')
 
         super(cls, Seq2seqAgent).add_cmdline_args(argparser)
         Seq2seqAgent.dictionary_class().add_cmdline_args(argparser)
@@ -111,6 +122,71 @@ class Seq2seqAgent(TorchGeneratorAgent):
         """Set up model."""
         super().__init__(opt, shared)
         self.id = 'Seq2Seq'
+        self.sampled_softmax = opt.get('sampled_softmax', 0)
+        if self.sampled_softmax > 0:
+            if opt.get('numsoftmax', 1) > 1:
+                raise ValueError('--sampled-softmax does not support '
+                                 '--numsoftmax > 1')
+            if shared and 'sampling_log_probs' in shared:
+                self.sampling_log_probs = shared['sampling_log_probs']
+            else:
+                self.sampling_log_probs = self._sampling_log_probs(
+                    opt.get('sampled_softmax_power', 0.75)
+                )
+
+    def _sampling_log_probs(self, power):
+        """Return the log probability of sampling each token for the softmax.
+
+        Probabilities follow the dictionary frequencies raised to ``power``.
+        """
+        freqs = [self.dict.freq.get(self.dict[i], 0) for i in range(len(self.dict))]
+        # special tokens are stored with huge placeholder counts
+        real = [f for f in freqs if f < 999999998]
+        max_freq = max(real) if real else 1
+        freqs = [min(f, max_freq) + 1 for f in freqs]
+        # null and start tokens are never targets
+        freqs[self.NULL_IDX] = 0
+        freqs[self.START_IDX] = 0
+        probs = torch.Tensor(freqs).pow(power)
+        probs /= probs.sum()
+        if self.use_cuda:
+            probs = probs.cuda()
+        return probs.clamp(min=1e-20).log()
+
+    def share(self):
+        """Share the sampling distribution of the sampled softmax."""
+        shared = super().share()
+        if self.sampled_softmax > 0:
+            shared['sampling_log_probs'] = self.sampling_log_probs
+        return shared
+
+    def compute_loss(self, batch):
+        """Compute the training loss, using the sampled softmax if enabled."""
+        if self.sampled_softmax <= 0:
+            return super().compute_loss(batch)
+
+        ys = batch.label_vec
+        samples = torch.multinomial(
+            self.sampling_log_probs.exp(), self.sampled_softmax,
+            replacement=True
+        )
+        scores = self.model.decode_sampled(
+            batch.text_vec, ys, samples, self.sampling_log_probs
+        )
+        # the target is always at index 0 of the scores
+        zeros = ys.new_zeros(ys.size())
+        losses = F.cross_entropy(
+            scores.view(-1, scores.size(-1)), zeros.view(-1), reduction='none'
+        )
+        notnull = ys.ne(self.NULL_IDX).float()
+        loss = (losses * notnull.view(-1)).sum()
+
+        # predictions are only made among the sampled tokens
+        choice = scores.max(dim=-1)[1]
+        sampled_preds = samples[(choice - 1).clamp(min=0)]
+        is_target = (choice == 0).long()
+        preds = ys * is_target + sampled_preds * (1 - is_target)
+        return loss, preds
 
     def build_model(self, states=None):
         """Initialize model, override to change model setup."""
@@ -163,6 +239,11 @@ class Seq2seqAgent(TorchGeneratorAgent):
                 self.model.reorder_encoder_states = (
                     self.model.module.reorder_encoder_states
                 )
+                self.model.extend_encoder_states = (
+                    self.model.module.extend_encoder_states
+                )
+                self.model.decode_sample = self.model.module.decode_sample
+                self.model.decode_sampled = self.model.module.decode_sampled
 
         return self.model
 
@@ -32,20 +32,22 @@ class Starspace(nn.Module):
             self.lins = opt['lins']
 
     def forward(self, xs, ys=None, cands=None):
-        xs_enc = []
-        ys_enc = []
+        """Embed a batch of contexts, and their labels and candidates.
+
+        :param xs: (bsz, len) padded context token ids
+        :param ys: optional (bsz, len) padded label token ids
+        :param cands: optional (num_cands, len) padded candidate token ids,
+                      shared by the whole batch
+
+        :returns: the (bsz, esz) context embeddings, and the label and
+                  candidate embeddings (None if not given)
+        """
         xs_emb = self.encoder(xs)
         if self.lins > 0:
             xs_emb = self.lin(xs_emb)
-        if ys is not None:
-            # training includes the correct example first.
-            xs_enc.append(xs_emb)
-            ys_enc.append(self.encoder2(ys))
-        for c in cands:
-            xs_enc.append(xs_emb)
-            c_emb = self.encoder2(c)
-            ys_enc.append(c_emb)
-        return torch.cat(xs_enc), torch.cat(ys_enc)
+        ys_emb = self.encoder2(ys) if ys is not None else None
+        cands_emb = self.encoder2(cands) if cands is not None else None
+        return xs_emb, ys_emb, cands_emb
 
 
 class Encoder(nn.Module):
@@ -64,16 +66,15 @@ class Encoder(nn.Module):
             self.freqs = None
 
     def forward(self, xs):
+        """Embed each row of xs, ignoring padding (index 0)."""
         xs_emb = self.lt(xs)
+        mask = xs.ne(0).float()
         if self.freqs is not None:
             # tfidf embeddings
-            l = xs.size(1)
-            w = torch.Tensor(l)
-            for i in range(l):
-                w[i] = self.freqs[xs.data[0][i]]
-            w = w.mul(1 / w.norm())
-            xs_emb = xs_emb.squeeze(0).t().matmul(w.unsqueeze(1)).t()
+            w = self.freqs[xs] * mask
+            w = w / w.norm(dim=1, keepdim=True).clamp(min=1e-20)
+            xs_emb = (xs_emb * w.unsqueeze(2)).sum(1)
         else:
             # basic embeddings (faster)
-            xs_emb = xs_emb.mean(1)
+            xs_emb = xs_emb.sum(1) / mask.sum(1, keepdim=True).clamp(min=1)
         return xs_emb
@@ -12,16 +12,16 @@
 
 from parlai.core.agents import Agent
 from parlai.core.dict import DictionaryAgent
-from parlai.core.utils import maintain_dialog_history, load_cands
+from parlai.core.utils import maintain_dialog_history, load_cands, padded_tensor
 from parlai.core.torch_agent import TorchAgent
+from parlai.core.embedding_store import copy_embeddings
 from .modules import Starspace
 
 import torch
 from torch import optim
-import torch.nn as nn
+import torch.nn.functional as F
 from collections import deque
 
-import copy
 import os
 import random
 import json
@@ -43,6 +43,12 @@ class StarspaceAgent(Agent):
         'sgd': optim.SGD,
     }
 
+    # pretrained embeddings are set up the same way as in TorchAgent
+    _get_embpath = TorchAgent._get_embpath
+    _get_embtype = TorchAgent._get_embtype
+    _get_embstore = TorchAgent._get_embstore
+    _project_vec = TorchAgent._project_vec
+
     @staticmethod
     def dictionary_class():
         return DictionaryAgent
@@ -138,19 +144,12 @@ class StarspaceAgent(Agent):
                 self._init_embeddings()
             self.model.share_memory()
 
-        # set up modules
-        self.criterion = torch.nn.CosineEmbeddingLoss(
-            margin=opt['margin'], size_average=False
-        )
         self.reset()
         self.fixedCands = False
         self.fixedX = None
         if self.opt.get('fixed_candidates_file'):
             self.fixedCands_txt = load_cands(self.opt.get('fixed_candidates_file'))
-            fcs = []
-            for c in self.fixedCands_txt:
-                fcs.append(torch.LongTensor(self.parse(c)).unsqueeze(0))
-            self.fixedCands = fcs
+            self.fixedCands = self.pad([self.parse(c) for c in self.fixedCands_txt])
             print("[loaded candidates]")
 
     def _init_embeddings(self, log=True):
@@ -163,15 +162,8 @@ class StarspaceAgent(Agent):
         emb_type = self.opt.get('embedding_type', 'random')
         if emb_type == 'random':
             return
-        embs, name = TorchAgent._get_embtype(self, emb_type)
-        cnt = 0
-        for w, i in self.dict.tok2ind.items():
-            if w in embs.stoi:
-                vec = TorchAgent._project_vec(self,
-                                              embs.vectors[embs.stoi[w]],
-                                              weight.size(1))
-                weight.data[i] = vec
-                cnt += 1
+        store, name = self._get_embstore(emb_type)
+        cnt = copy_embeddings(weight, self.dict, store, self._project_vec)
         if log:
             print('Initialized embeddings for {} tokens ({}%) from {}.'
                   ''.format(cnt, round(cnt * 100 / len(self.dict), 1), name))
@@ -239,32 +231,21 @@ class StarspaceAgent(Agent):
         self.observation = obs
         return obs
 
-    def same(self, y1, y2):
-        if len(y1.squeeze(0)) != len(y2.squeeze(0)):
-            return False
-        if abs((y1.squeeze(0) - y2.squeeze(0)).sum().data.sum()) > 0.00001:
-            return False
-        return True
-
-    def get_negs(self, xs, ys):
-        negs = []
-        cache_sz = len(self.ys_cache) - 1
-        if cache_sz < 1:
-            return negs
-        k = self.opt['neg_samples']
-        for i in range(1, k * 3):
-            index = random.randint(0, cache_sz)
-            neg = self.ys_cache[index]
-            if not self.same(ys, neg):
-                negs.append(neg)
-                if len(negs) >= k:
-                    break
-        if self.opt['parrot_neg'] > 0:
-            utt = self.history['last_utterance']
-            if len(utt) > 2:
-                query = torch.LongTensor(utt).unsqueeze(0)
-                negs.append(query)
-        return negs
+    def pad(self, vecs):
+        """Pad lists of token indices into one (len(vecs), max_len) tensor."""
+        return padded_tensor(vecs, self.NULL_IDX)[0]
+
+    def get_negs(self):
+        """Sample one pool of negatives for the whole batch from the cache.
+
+        :returns: (k, len) padded tensor of negatives, or None if the cache
+                  holds too few labels
+        """
+        if len(self.ys_cache) < 2:
+            return None
+        k = min(self.opt['neg_samples'], len(self.ys_cache))
+        negs = random.sample(self.ys_cache, k)
+        return self.pad(negs)
 
     def dict_neighbors(self, word, useRHS=False):
         input = self.t2v(word)
@@ -272,108 +253,153 @@ class StarspaceAgent(Agent):
         q = W[input.data[0][0]]
         if useRHS:
             W = self.model.encoder2.lt.weight
-        score = torch.Tensor(W.size(0))
-        for i in range(W.size(0)):
-            score[i] = torch.nn.functional.cosine_similarity(q, W[i], dim=0).data[0]
-        val, ind = score.sort(descending=True)
-        for i in range(20):
-            print(
-                str(ind[i]) + " [" + str(val[i]) + "]: " +
-                self.v2t(torch.Tensor([ind[i]]))
-            )
+        score = F.cosine_similarity(q.unsqueeze(0), W, dim=1).detach()
+        val, ind = score.topk(min(20, W.size(0)))
+        for v, i in zip(val.tolist(), ind.tolist()):
+            print(str(i) + " [" + str(v) + "]: " + self.v2t([i]))
 
     def compute_metrics(self, loss, scores):
+        """Compute the metrics of one example.
+
+        :param loss: loss of the example
+        :param scores: score of the label, followed by those of its negatives
+        """
         metrics = {}
-        pos = scores[0]
-        cnt = 0
-        for i in range(1, len(scores)):
-            if scores[i] >= pos:
-                cnt += 1
-        metrics['mean_rank'] = cnt
+        metrics['mean_rank'] = (scores[1:] >= scores[0]).sum().item()
         metrics['loss'] = loss
         return metrics
 
-    def input_dropout(self, xs, ys, negs):
-        def dropout(x, rate):
-            xd = []
-            for i in x[0]:
-                if random.uniform(0, 1) > rate:
-                    xd.append(i)
-            if len(xd) == 0:
-                # pick one random thing to put in xd
-                xd.append(x[0][random.randint(0, x.size(1)-1)])
-            return torch.LongTensor(xd).unsqueeze(0)
+    def input_dropout(self, vecs):
+        """Drop tokens of each row, keeping at least one token per row."""
         rate = self.opt.get('input_dropout')
-        xs2 = dropout(xs, rate)
-        ys2 = dropout(ys, rate)
-        negs2 = []
-        for n in negs:
-            negs2.append(dropout(n, rate))
-        return xs2, ys2, negs2
-    
+        nonnull = vecs.ne(self.NULL_IDX)
+        keep = (torch.rand(vecs.size()) > rate) & nonnull
+        rows = []
+        for row, row_keep, row_nonnull in zip(vecs, keep, nonnull):
+            kept = row[row_keep]
+            if len(kept) == 0:
+                # pick one random thing to keep
+                tokens = row[row_nonnull]
+                kept = tokens[random.randint(0, len(tokens) - 1):][:1]
+            rows.append(kept.tolist())
+        return self.pad(rows)
+
     def predict(self, xs, ys=None, cands=None, cands_txt=None, obs=None):
         """Produce a prediction from our model.
 
         Update the model using the targets if available, otherwise rank
         candidates as well if they are available and param is set.
+
+        :returns: one reply per row of xs
         """
         is_training = ys is not None
         if is_training:
-            negs = self.get_negs(xs, ys)
-            if is_training and len(negs) > 0:
-                self.model.train()
-                self.optimizer.zero_grad()
-                if self.opt.get('input_dropout', 0) > 0:
-                    xs, ys, negs = self.input_dropout(xs, ys, negs)
-                xe, ye = self.model(xs, ys, negs)
-                if self.debugMode:
-                    # print example
-                    print("inp: " + self.v2t(xs.squeeze()))
-                    print("pos: " + self.v2t(ys.squeeze()))
-                    for c in negs:
-                        print("neg: " + self.v2t(c.squeeze()))
-                    print("---")
-                y = -torch.ones(xe.size(0))
-                y[0] = 1
-                loss = self.criterion(xe, ye, y)
-                loss.backward()
-                self.optimizer.step()
-                pred = nn.CosineSimilarity().forward(xe, ye)
-                metrics = self.compute_metrics(loss.item(), pred.data.squeeze())
-                return [{'metrics': metrics}]
-        else:
-            self.model.eval()
-            if cands is None or cands[0] is None:
-                # cannot predict without candidates.
-                if self.fixedCands:
-                    cands = [self.fixedCands]
-                    cands_txt = [self.fixedCands_txt]
-                else:
-                    return [{'text': 'I dunno.'}]
-                # test set prediction uses fixed candidates
-                if self.fixedX is None:
-                    xe, ye = self.model(xs, ys, self.fixedCands)
-                    self.fixedX = ye
+            negs = self.get_negs()
+            if negs is None:
+                return [{} for _ in range(xs.size(0))]
+            return self.train_step(xs, ys, negs)
+
+        return self.rank(xs, cands, cands_txt)
+
+    def rank(self, xs, cands, cands_txt):
+        """Rank the candidates of each example, scoring them all at once."""
+        self.model.eval()
+        with torch.no_grad():
+            # encode the candidates of the whole batch at once
+            all_cands = [c for cs in cands if cs is not None for c in cs]
+            xe, _, ce = self.model(
+                xs, cands=self.pad(all_cands) if all_cands else None
+            )
+            scores = []
+            start = 0
+            for i, cs in enumerate(cands):
+                if cs is not None:
+                    scores.append(
+                        F.cosine_similarity(
+                            ce[start:start + len(cs)], xe[i:i + 1]
+                        )
+                    )
+                    start += len(cs)
+                elif self.fixedCands is not False:
+                    # test set prediction uses fixed candidates
+                    if self.fixedX is None:
+                        # fixed candidate embeddings are cached
+                        self.fixedX = self.model.encoder2(self.fixedCands)
+                    scores.append(
+                        F.cosine_similarity(self.fixedX, xe[i:i + 1])
+                    )
+                    cands_txt[i] = self.fixedCands_txt
                 else:
-                    # fixed candidate embed vectors are cached, dont't recompute
-                    blah = torch.LongTensor([1])
-                    xe, ye = self.model(xs, ys, [blah])
-                    ye = self.fixedX
-            else:
-                # test set prediction uses candidates
-                xe, ye = self.model(xs, ys, cands[0])
-            pred = nn.CosineSimilarity().forward(xe, ye)
+                    scores.append(None)
+
+        replies = []
+        for score, ctxt in zip(scores, cands_txt):
+            if score is None:
+                # cannot predict without candidates.
+                replies.append({'text': 'I dunno.'})
+                continue
             # This is somewhat costly which we could avoid if we do not evalute ranking.
             # i.e. by only doing: val,ind = pred.max(0)
-            val, ind = pred.sort(descending=True)
+            _, ind = score.sort(descending=True)
+            tc = [ctxt[i] for i in ind[:100].tolist()]
             # predict the highest scoring candidate, and return it.
-            ypred = cands_txt[0][ind.data[0]]
-            tc = []
-            for i in range(min(100, ind.size(0))):
-                tc.append(cands_txt[0][ind.data[i]])
-            ret = [{'text': ypred, 'text_candidates': tc}]
-            return ret
-        return [{'id': self.getID()}]
+            replies.append({'text': tc[0], 'text_candidates': tc})
+        return replies
+
+    def train_step(self, xs, ys, negs):
+        """Update the model on a batch, against one shared pool of negatives.
+
+        All scores are computed with one matmul, and each example is trained
+        against every negative which differs from its label, with the loss of
+        torch.nn.CosineEmbeddingLoss.
+        """
+        self.model.train()
+        self.optimizer.zero_grad()
+        # the cached candidate embeddings are stale after an update
+        self.fixedX = None
+        if self.opt.get('input_dropout', 0) > 0:
+            xs = self.input_dropout(xs)
+            ys = self.input_dropout(ys)
+            negs = self.input_dropout(negs)
+        xe, ye, ne = self.model(xs, ys, negs)
+        if self.debugMode:
+            # print example
+            for x, y in zip(xs, ys):
+                print("inp: " + self.v2t(x[x.ne(self.NULL_IDX)].tolist()))
+                print("pos: " + self.v2t(y[y.ne(self.NULL_IDX)].tolist()))
+            for c in negs:
+                print("neg: " + self.v2t(c[c.ne(self.NULL_IDX)].tolist()))
+            print("---")
+        xe = F.normalize(xe, dim=1)
+        pos = (xe * F.normalize(ye, dim=1)).sum(1)
+        neg = xe.matmul(F.normalize(ne, dim=1).t())
+
+        # a negative which is the same as the label is not a negative
+        width = max(ys.size(1), negs.size(1))
+        ys_p = F.pad(ys, (0, width - ys.size(1)), value=self.NULL_IDX)
+        negs_p = F.pad(negs, (0, width - negs.size(1)), value=self.NULL_IDX)
+        neg_mask = (ys_p.unsqueeze(1) != negs_p.unsqueeze(0)).any(2).float()
+        if self.opt['parrot_neg'] > 0:
+            # include the query as a negative
+            parrot = (xe * F.normalize(self.model.encoder2(xs), dim=1)).sum(1)
+            neg = torch.cat([neg, parrot.unsqueeze(1)], 1)
+            parrot_mask = xs.ne(self.NULL_IDX).sum(1).gt(2).float()
+            neg_mask = torch.cat([neg_mask, parrot_mask.unsqueeze(1)], 1)
+
+        losses = ((1 - pos) +
+                  ((neg - self.opt['margin']).clamp(min=0) * neg_mask).sum(1))
+        losses.sum().backward()
+        self.optimizer.step()
+
+        replies = []
+        neg = neg.detach()
+        for i in range(xs.size(0)):
+            scores = torch.cat([pos[i:i + 1].detach(),
+                                neg[i][neg_mask[i].bool()]])
+            replies.append(
+                {'metrics': self.compute_metrics(losses[i].item(), scores)}
+            )
+        return replies
 
     def vectorize(self, observations):
         """Convert a list of observations into input & target tensors."""
@@ -386,25 +412,13 @@ class StarspaceAgent(Agent):
                                     enumerate(observations) if valid(ex)])
         except ValueError:
             # zero examples to process in this batch, so zip failed to unpack
-            return None, None, None, None
+            return None, None, None, None, None
 
         # `x` text is already tokenized and truncated
-        # sort by length so we can use pack_padded
-        parsed_x = [ex['text2vec'] for ex in exs]
-        x_lens = [len(x) for x in parsed_x]
-        ind_sorted = sorted(range(len(x_lens)), key=lambda k: -x_lens[k])
-
-        exs = [exs[k] for k in ind_sorted]
-        valid_inds = [valid_inds[k] for k in ind_sorted]
-        parsed_x = [parsed_x[k] for k in ind_sorted]
+        xs = self.pad([ex['text2vec'] for ex in exs])
 
         labels_avail = any(['labels' in ex for ex in exs])
 
-        max_x_len = max([len(x) for x in parsed_x])
-        for x in parsed_x:
-            x += [self.NULL_IDX] * (max_x_len - len(x))
-        xs = torch.LongTensor(parsed_x)
-
         # set up the target tensors
         ys = None
         labels = None
@@ -415,49 +429,50 @@ class StarspaceAgent(Agent):
             parsed_y = [deque(maxlen=self.truncate) for _ in labels]
             for dq, y in zip(parsed_y, labels):
                 dq.extendleft(reversed(self.parse(y)))
-            max_y_len = max(len(y) for y in parsed_y)
-            for y in parsed_y:
-                y += [self.NULL_IDX] * (max_y_len - len(y))
-            ys = torch.LongTensor(parsed_y)
+            ys = self.pad([list(y) for y in parsed_y])
 
         cands = []
         cands_txt = []
         if ys is None:
             # only build candidates in eval mode.
-            for o in observations:
+            for o in exs:
                 if o.get('label_candidates', False):
-                    cs = []
-                    ct = []
-                    for c in o['label_candidates']:
-                        cs.append(torch.LongTensor(self.parse(c)).unsqueeze(0))
-                        ct.append(c)
-                    cands.append(cs)
+                    ct = list(o['label_candidates'])
+                    cands.append([self.parse(c) for c in ct])
                     cands_txt.append(ct)
                 else:
                     cands.append(None)
                     cands_txt.append(None)
-        return xs, ys, cands, cands_txt
+        return xs, ys, cands, cands_txt, valid_inds
 
     def add_to_ys_cache(self, ys):
+        """Remember the labels of the batch as future negatives."""
         if ys is None or len(ys) == 0:
             return
-        if len(self.ys_cache) < self.ys_cache_sz:
-            self.ys_cache.append(copy.deepcopy(ys))
-        else:
-            ind = random.randint(0, self.ys_cache_sz - 1)
-            self.ys_cache[ind] = copy.deepcopy(ys)
+        for y in ys:
+            y = y[y.ne(self.NULL_IDX)].tolist()
+            if len(y) == 0:
+                continue
+            if len(self.ys_cache) < self.ys_cache_sz:
+                self.ys_cache.append(y)
+            else:
+                ind = random.randint(0, self.ys_cache_sz - 1)
+                self.ys_cache[ind] = y
 
     def batch_act(self, observations):
         batchsize = len(observations)
         # initialize a table of replies with this agent's id
+        batch_reply = [{'id': self.getID()} for _ in range(batchsize)]
         # convert the observations into batches of inputs and targets
         # valid_inds tells us the indices of all valid examples
         # e.g. for input [{}, {'text': 'hello'}, {}, {}], valid_inds is [1]
         # since the other three elements had no 'text' field
-        xs, ys, cands, cands_txt = self.vectorize(observations)
-        batch_reply = self.predict(xs, ys, cands, cands_txt, observations)
-        while len(batch_reply) < batchsize:
-            batch_reply.append({'id': self.getID()})
+        xs, ys, cands, cands_txt, valid_inds = self.vectorize(observations)
+        if xs is None:
+            return batch_reply
+        predictions = self.predict(xs, ys, cands, cands_txt, observations)
+        for i, reply in zip(valid_inds, predictions):
+            batch_reply[i].update(reply)
         self.add_to_ys_cache(ys)
         return batch_reply
 
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+"""Compare the scipy and torch tf-idf builders on the same document db.
+
+Times the count matrix and the tfidf weighting of both builders, and checks
+that they produce the same matrix.
+
+Example:
+    python -m parlai.agents.tfidf_retriever.benchmark_tfidf /path/to/docs.db
+"""
+
+import argparse
+import logging
+import math
+import time
+
+import scipy.sparse as sp
+
+from . import build_tfidf
+
+
+def benchmark(args):
+    """Build the tfidf matrix with both builders and return the timings."""
+    db_opts = {'db_path': args.db_path}
+    timings = {}
+
+    start = time.time()
+    cnts = build_tfidf.get_count_matrix(args, db_opts)
+    timings['scipy count'] = time.time() - start
+    start = time.time()
+    tfidf = build_tfidf.get_tfidf_matrix(cnts)
+    timings['scipy tfidf'] = time.time() - start
+
+    start = time.time()
+    cnts_t = build_tfidf.get_count_matrix_t(args, db_opts)
+    timings['torch count'] = time.time() - start
+    start = time.time()
+    tfidf_t = build_tfidf.get_tfidf_matrix_t(cnts_t)
+    timings['torch tfidf'] = time.time() - start
+
+    inds = tfidf_t._indices().numpy()
+    tfidf_t = sp.csr_matrix(
+        (tfidf_t._values().numpy(), (inds[0], inds[1])), shape=tfidf.shape
+    )
+    # terms in over half of the docs get an idf of 0, which only one of the
+    # builders stores explicitly
+    tfidf.eliminate_zeros()
+    tfidf_t.eliminate_zeros()
+    same_nnz = tfidf.nnz == tfidf_t.nnz
+    diff = abs(tfidf - tfidf_t)
+    max_diff = float(diff.max()) if diff.nnz else 0.0
+    return timings, same_nnz, max_diff
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('db_path', type=str, default=None,
+                        help='Path to sqlite db holding document texts')
+    parser.add_argument('--ngram', type=int, default=2,
+                        help=('Use up to N-size n-grams '
+                              '(e.g. 2 = unigrams + bigrams)'))
+    parser.add_argument('--hash-size', type=int, default=int(math.pow(2, 24)),
+                        help='Number of buckets to use for hashing ngrams')
+    parser.add_argument('--tokenizer', type=str, default='simple',
+                        help=("String option specifying tokenizer type to use "
+                              "(e.g. 'corenlp')"))
+    parser.add_argument('--num-workers', type=int, default=None,
+                        help='Number of CPU processes (for tokenizing, etc)')
+    args = parser.parse_args()
+    build_tfidf.logger.setLevel(logging.WARNING)
+
+    timings, same_nnz, max_diff = benchmark(args)
+    for name, secs in timings.items():
+        print('{:<12} {:8.3f}s'.format(name, secs))
+    print('same non-zeros: {}, max abs difference: {:.2e}'.format(
+        same_nnz, max_diff))
@@ -17,6 +17,7 @@ import argparse
 import os
 import math
 import logging
+import tempfile
 
 from multiprocessing import Pool as ProcessPool
 from multiprocessing.util import Finalize
@@ -47,7 +48,7 @@ def init(tokenizer_class, db_opts):
     global PROCESS_TOK, PROCESS_DB
     PROCESS_TOK = tokenizer_class()
     Finalize(PROCESS_TOK, PROCESS_TOK.shutdown, exitpriority=100)
-    PROCESS_DB = DocDB(**db_opts)
+    PROCESS_DB = DocDB(read_only=True, **db_opts)
     Finalize(PROCESS_DB, PROCESS_DB.close, exitpriority=100)
 
 
@@ -95,16 +96,30 @@ def sparse_log1p(sparse_t):
     return t
 
 
+def count_texts(ngram, hash_size, texts, doc_ids=None):
+    """Compute hashed ngram counts of texts.
+
+    Text i is counted in column doc_ids[i], or in column i if doc_ids is None.
+    Returns numpy (row, col, data) arrays of the counts in COO format.
+    """
+    if doc_ids is None:
+        doc_ids = range(len(texts))
+    row, data, lengths = [], [], []
+    for text in texts:
+        cur_row, _, cur_data = count_text(ngram, hash_size, None, text)
+        row.extend(cur_row)
+        data.extend(cur_data)
+        lengths.append(len(cur_row))
+    col = np.repeat(np.asarray(doc_ids, dtype=np.int64), lengths)
+    return (np.array(row, dtype=np.int64), col,
+            np.array(data, dtype=np.int32))
+
+
 def live_count_matrix(args, cands):
     global PROCESS_TOK
     if PROCESS_TOK is None:
         PROCESS_TOK = tokenizers.get_class(args.tokenizer)()
-    row, col, data = [], [], []
-    for i, c in enumerate(cands):
-        cur_row, cur_col, cur_data = count_text(args.ngram, args.hash_size, i, c)
-        row += cur_row
-        col += cur_col
-        data += cur_data
+    row, col, data = count_texts(args.ngram, args.hash_size, cands)
 
     data, row, col = truncate(data, row, col)
     count_matrix = sp.csr_matrix(
@@ -118,20 +133,26 @@ def live_count_matrix_t(args, cands):
     global PROCESS_TOK
     if PROCESS_TOK is None:
         PROCESS_TOK = tokenizers.get_class(args.tokenizer)()
-    row, col, data = [], [], []
-    for i, c in enumerate(cands):
-        cur_row, cur_col, cur_data = count_text(args.ngram, args.hash_size, i, c)
-        row += cur_row
-        col += cur_col
-        data += cur_data
+    row, col, data = count_texts(args.ngram, args.hash_size, cands)
 
     count_matrix = torch.sparse.FloatTensor(
-        torch.LongTensor([row, col]), torch.FloatTensor(data),
+        torch.from_numpy(np.stack([row, col])),
+        torch.from_numpy(data.astype(np.float32)),
         torch.Size([args.hash_size, len(cands)])
     ).coalesce()
     return count_matrix
 
 
+def get_delta_count_matrix(args, db_opts, doc_ids):
+    """Form the count matrix of only the docs in doc_ids.
+
+    M[i, j] = # times word i appears in document doc_ids[j].
+    """
+    with DocDB(**db_opts) as doc_db:
+        texts = [doc_db.get_doc_text(doc_id) for doc_id in doc_ids]
+    return live_count_matrix(args, texts)
+
+
 def count_text(ngram, hash_size, doc_id, text=None):
     """Compute hashed ngram counts of text."""
     row, col, data = [], [], []
@@ -163,7 +184,6 @@ def get_count_matrix_t(args, db_opts):
 
     M[i, j] = # times word i appears in document j.
     """
-    global MAX_SZ
     with DocDB(**db_opts) as doc_db:
         doc_ids = doc_db.get_doc_ids()
 
@@ -177,35 +197,47 @@ def get_count_matrix_t(args, db_opts):
 
     # Compute the count matrix in steps (to keep in memory)
     logger.info('Mapping...')
-    row, col, data = [], [], []
     step = max(int(len(doc_ids) / 10), 1)
     batches = [doc_ids[i:i + step] for i in range(0, len(doc_ids), step)]
-    _count = partial(count, args.ngram, args.hash_size)
-    for i, batch in enumerate(batches):
+    _count = partial(count_docs, args.ngram, args.hash_size)
+    chunks = []
+    for i, chunk in enumerate(workers.imap_unordered(_count, batches)):
         logger.info('-' * 25 + 'Batch %d/%d' % (i + 1, len(batches)) + '-' * 25)
-        for b_row, b_col, b_data in workers.imap_unordered(_count, batch):
-            row.extend(b_row)
-            col.extend(b_col)
-            data.extend(b_data)
+        chunks.append(chunk)
     workers.close()
     workers.join()
 
     logger.info('Creating sparse matrix...')
+    row, col, data = (np.concatenate([c[i] for c in chunks] or [[]])
+                      for i in range(3))
+    del chunks
     count_matrix = torch.sparse.FloatTensor(
-        torch.LongTensor([row, col]), torch.FloatTensor(data),
+        torch.from_numpy(np.stack([row, col]).astype(np.int64)),
+        torch.from_numpy(data.astype(np.float32)),
         torch.Size([args.hash_size, len(doc_ids) + 1])
     ).coalesce()
     return count_matrix
 
 
-def get_count_matrix(args, db_opts):
-    """Form a sparse word to document count matrix (inverted index).
+def count_docs(ngram, hash_size, doc_ids):
+    """Fetch a batch of documents and compute their hashed ngram counts.
 
-    M[i, j] = # times word i appears in document j.
+    Each document is counted in the column of its id. Returns numpy
+    (row, col, data) arrays of the counts in COO format.
+    """
+    texts = [fetch_text(doc_id) for doc_id in doc_ids]
+    return count_texts(ngram, hash_size, texts, doc_ids)
+
+
+def _spill_counts(args, db_opts, tmp_dir, chunk_size):
+    """Count the docs with a pool of workers, chunk_size docs at a time.
+
+    The counts of each chunk are spilled to tmp_dir as numpy arrays. Returns
+    the number of docs, the paths of the chunks in doc id order, and the
+    number of docs each hashed ngram appears in.
     """
-    global MAX_SZ
     with DocDB(**db_opts) as doc_db:
-        doc_ids = doc_db.get_doc_ids()
+        doc_ids = sorted(doc_db.get_doc_ids())
 
     # Setup worker pool
     tok_class = tokenizers.get_class(args.tokenizer)
@@ -215,36 +247,135 @@ def get_count_matrix(args, db_opts):
         initargs=(tok_class, db_opts)
     )
 
-    # Compute the count matrix in steps (to keep in memory)
     logger.info('Mapping...')
-    row, col, data = [], [], []
-    step = max(int(len(doc_ids) / 10), 1)
-    batches = [doc_ids[i:i + step] for i in range(0, len(doc_ids), step)]
-    _count = partial(count, args.ngram, args.hash_size)
-    for i, batch in enumerate(batches):
-        logger.info('-' * 25 + 'Batch %d/%d' % (i + 1, len(batches)) + '-' * 25)
-        for b_row, b_col, b_data in workers.imap_unordered(_count, batch):
-            row.extend(b_row)
-            col.extend(b_col)
-            data.extend(b_data)
-            if len(data) > MAX_SZ:
-                break
-        if len(data) > MAX_SZ:
-            logger.info('Reached max indexable size, breaking.')
-            break
+    batches = [doc_ids[i:i + chunk_size]
+               for i in range(0, len(doc_ids), chunk_size)]
+    _count = partial(count_docs, args.ngram, args.hash_size)
+    row_counts = np.zeros(args.hash_size, dtype=np.int64)
+    chunks = []
+    for i, (row, col, data) in enumerate(workers.imap(_count, batches)):
+        if (i + 1) % max(len(batches) // 10, 1) == 0:
+            logger.info('-' * 25 + 'Batch %d/%d' % (i + 1, len(batches)) +
+                        '-' * 25)
+        row_counts += np.bincount(row, minlength=args.hash_size)
+        chunk = os.path.join(tmp_dir, 'chunk%d.npz' % i)
+        np.savez(chunk, row=row, col=col, data=data)
+        chunks.append(chunk)
     workers.close()
     workers.join()
+    return len(doc_ids), chunks, row_counts
 
-    logger.info('Creating sparse matrix...')
-    data, row, col = truncate(data, row, col)
+
+def _merge_chunks(chunks, indptr, indices, data, transform=None):
+    """Merge spilled chunks of counts into the arrays of a CSR matrix.
+
+    A counting sort by row: the entries of each chunk are appended to their
+    rows, so as the chunks are in doc id order, the indices of each row end
+    up sorted. transform(row, col, counts) may filter the entries and turn
+    the counts into the values to store. Each chunk is removed once merged.
+    """
+    # next free position of each row
+    cursor = indptr[:-1].astype(np.int64)
+    for chunk in chunks:
+        with np.load(chunk) as arrays:
+            row, col, cnt = arrays['row'], arrays['col'], arrays['data']
+        os.remove(chunk)
+        if transform is not None:
+            row, col, cnt = transform(row, col, cnt)
+        order = np.argsort(row, kind='mergesort')
+        row, col, cnt = row[order], col[order], cnt[order]
+        rows, first, lengths = np.unique(
+            row, return_index=True, return_counts=True
+        )
+        pos = cursor[row] + np.arange(len(row)) - np.repeat(first, lengths)
+        indices[pos] = col
+        data[pos] = cnt
+        cursor[rows] += lengths
+
+
+def _index_dtype(nnz):
+    return np.int32 if nnz < 2 ** 31 else np.int64
+
+
+def get_count_matrix(args, db_opts, chunk_size=1000):
+    """Form a sparse word to document count matrix (inverted index).
+
+    M[i, j] = # times word i appears in document j.
+
+    Workers count chunk_size docs at a time, and each chunk of counts is
+    spilled to disk as numpy arrays (in args.tmp_dir if set). The chunks are
+    then merged with a counting sort by row straight into the arrays of the
+    final CSR matrix, so besides the matrix itself only one chunk is held in
+    memory and no counts need to be thrown out.
+    """
+    with tempfile.TemporaryDirectory(dir=getattr(args, 'tmp_dir', None)) \
+            as tmp_dir:
+        num_docs, chunks, row_counts = _spill_counts(
+            args, db_opts, tmp_dir, chunk_size
+        )
+
+        logger.info('Creating sparse matrix...')
+        nnz = int(row_counts.sum())
+        indptr = np.zeros(args.hash_size + 1, dtype=_index_dtype(nnz))
+        np.cumsum(row_counts, out=indptr[1:])
+        indices = np.empty(nnz, dtype=indptr.dtype)
+        data = np.empty(nnz, dtype=np.int32)
+        _merge_chunks(chunks, indptr, indices, data)
 
     count_matrix = sp.csr_matrix(
-        (data, (row, col)), shape=(args.hash_size, len(doc_ids) + 1)
+        (data, indices, indptr), shape=(args.hash_size, num_docs + 1)
     )
-    count_matrix.sum_duplicates()
+    count_matrix.sort_indices()
     return count_matrix
 
 
+def save_tfidf_matrix_mmap(args, db_opts, filename, metadata=None,
+                           chunk_size=1000):
+    """Build the tfidf matrix straight into the layout of save_sparse_csr_mmap.
+
+    Same as get_tfidf_matrix(get_count_matrix(...)), but the spilled chunks
+    of counts are merged into tfidf values in memory-mapped output arrays, so
+    neither matrix is ever held in memory. The doc freqs and the max score of
+    each term are saved in the metadata too.
+    """
+    with tempfile.TemporaryDirectory(dir=getattr(args, 'tmp_dir', None)) \
+            as tmp_dir:
+        # each doc counts a hashed ngram once, so these are the doc freqs
+        num_docs, chunks, freqs = _spill_counts(
+            args, db_opts, tmp_dir, chunk_size
+        )
+
+        logger.info('Making tfidf vectors...')
+        shape = (args.hash_size, num_docs + 1)
+        idfs = np.log((shape[1] - freqs + 0.5) / (freqs + 0.5))
+        idfs[idfs < 0] = 0
+        # terms with an idf of 0 have no nonzero tfidf values
+        row_counts = np.where(idfs > 0, freqs, 0)
+        nnz = int(row_counts.sum())
+        arrays = utils.open_sparse_csr_mmap(
+            filename, shape, nnz, np.float64, _index_dtype(nnz)
+        )
+        data, indices, indptr = arrays
+        indptr[0] = 0
+        np.cumsum(row_counts, out=indptr[1:])
+
+        def tfidf(row, col, cnt):
+            keep = idfs[row] > 0
+            row, col = row[keep], col[keep]
+            return row, col, np.log1p(cnt[keep]) * idfs[row]
+
+        _merge_chunks(chunks, indptr, indices, data, tfidf)
+
+    logger.info('Getting max score of each term...')
+    tfidf_matrix = sp.csr_matrix(
+        (data, indices, indptr), shape=shape, copy=False
+    )
+    metadata = dict(metadata or {})
+    metadata['doc_freqs'] = freqs
+    metadata['term_max'] = utils.max_per_row(tfidf_matrix)
+    utils.close_sparse_csr_mmap(filename, shape, arrays, metadata)
+
+
 # ------------------------------------------------------------------------------
 # Transform count matrix to different forms.
 # ------------------------------------------------------------------------------
@@ -263,8 +394,7 @@ def get_tfidf_matrix_t(cnts):
     idft[idft < 0] = 0
     tft = sparse_log1p(cnts)
     inds, vals = tft._indices(), tft._values()
-    for i, ind in enumerate(inds[0]):
-        vals[i] *= idft[ind]
+    vals.mul_(idft[inds[0]])
     tfidft = tft
     return tfidft
 
@@ -289,8 +419,8 @@ def get_tfidf_matrix(cnts):
 
 def get_doc_freqs_t(cnts):
     """Return word --> # of docs it appears in (torch version)."""
-    return torch.histc(cnts._indices()[0].float(), bins=cnts.size(0),
-                       min=0, max=cnts.size(0))
+    inds = cnts.coalesce()._indices()
+    return torch.bincount(inds[0], minlength=cnts.size(0)).float()
 
 
 def get_doc_freqs(cnts):
@@ -307,6 +437,21 @@ def get_doc_freqs(cnts):
 
 def run(args):
     # ParlAI version of run method, modified slightly
+    filename = args.out_dir
+    metadata = {
+        'tokenizer': args.tokenizer,
+        'hash_size': args.hash_size,
+        'ngram': args.ngram,
+    }
+
+    if getattr(args, 'mmap', False):
+        logging.info('Counting words...')
+        save_tfidf_matrix_mmap(
+            args, {'db_path': args.db_path}, filename, metadata
+        )
+        logger.info('Saved to %s' % filename)
+        return
+
     logging.info('Counting words...')
     count_matrix = get_count_matrix(args, {'db_path': args.db_path})
 
@@ -314,18 +459,13 @@ def run(args):
     tfidf = get_tfidf_matrix(count_matrix)
 
     logger.info('Getting word-doc frequencies...')
-    freqs = get_doc_freqs(count_matrix)
+    metadata['doc_freqs'] = get_doc_freqs(count_matrix)
 
-    filename = args.out_dir
+    logger.info('Getting max score of each term...')
+    tfidf.sort_indices()
+    metadata['term_max'] = utils.max_per_row(tfidf)
 
     logger.info('Saving to %s' % filename)
-    metadata = {
-        'doc_freqs': freqs,
-        'tokenizer': args.tokenizer,
-        'hash_size': args.hash_size,
-        'ngram': args.ngram,
-    }
-
     utils.save_sparse_csr(filename, tfidf, metadata)
 
 
@@ -346,6 +486,9 @@ if __name__ == '__main__':
                               "(e.g. 'corenlp')"))
     parser.add_argument('--num-workers', type=int, default=None,
                         help='Number of CPU processes (for tokenizing, etc)')
+    parser.add_argument('--tmp-dir', type=str, default=None,
+                        help='Directory for spilling word counts to disk '
+                             '(defaults to the system temp directory)')
     args = parser.parse_args()
 
     logging.info('Counting words...')
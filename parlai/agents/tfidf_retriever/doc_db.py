@@ -11,8 +11,13 @@ Adapted from Adam Fisch's work at github.com/facebookresearch/DrQA/
 """
 
 import sqlite3
+import threading
+from collections import OrderedDict
 from . import utils
 
+# sqlite's default limit on the number of parameters in one query
+MAX_VARIABLES = 999
+
 
 class DocDB(object):
     """Sqlite backed document storage.
@@ -20,9 +25,45 @@ class DocDB(object):
     Implements get_doc_text(doc_id).
     """
 
-    def __init__(self, db_path=None):
+    def __init__(self, db_path=None, cache_size=0, read_only=False,
+                 wal=False):
+        """
+        Args:
+            db_path: path to the sqlite database
+            cache_size: keep up to this many recently fetched docs in memory
+            read_only: open the database read-only
+            wal: switch the database to write-ahead logging, so readers don't
+              block on a writer
+        """
         self.path = db_path
-        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.cache_size = cache_size
+        self.read_only = read_only
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        # each thread gets its own connection, so readers don't serialize
+        self.local = threading.local()
+        self.connections = []
+        if wal and not read_only:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+
+    @property
+    def connection(self):
+        """Return the connection of the current thread."""
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            if self.read_only:
+                connection = sqlite3.connect(
+                    'file:{}?mode=ro'.format(self.path), uri=True,
+                    check_same_thread=False
+                )
+            else:
+                connection = sqlite3.connect(
+                    self.path, check_same_thread=False
+                )
+            self.local.connection = connection
+            with self.lock:
+                self.connections.append(connection)
+        return connection
 
     def __enter__(self):
         return self
@@ -35,8 +76,12 @@ class DocDB(object):
         return self.path
 
     def close(self):
-        """Close the connection to the database."""
-        self.connection.close()
+        """Close the connections to the database."""
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections.clear()
+        self.local = threading.local()
 
     def get_doc_ids(self):
         """Fetch all ids of docs stored in the db."""
@@ -46,27 +91,69 @@ class DocDB(object):
         cursor.close()
         return results
 
-    def get_doc_text(self, doc_id):
-        """Fetch the raw text of the doc for 'doc_id'."""
+    def get_doc_ids_after(self, doc_id):
+        """Fetch the ids of docs with an id greater than 'doc_id'."""
         cursor = self.connection.cursor()
-        cursor.execute(
-            "SELECT text FROM documents WHERE id = ?",
-            (utils.normalize(doc_id),)
-        )
-        result = cursor.fetchone()
+        cursor.execute("SELECT id FROM documents WHERE id > ?", (doc_id,))
+        results = [r[0] for r in cursor.fetchall()]
         cursor.close()
-        return result if result is None else result[0]
+        return results
+
+    def get_doc_text(self, doc_id):
+        """Fetch the raw text of the doc for 'doc_id'."""
+        return self.get_docs([doc_id], 'text')[0]
 
     def get_doc_value(self, doc_id):
         """Fetch the raw text of the doc for 'doc_id'."""
-        cursor = self.connection.cursor()
-        cursor.execute(
-            "SELECT value FROM documents WHERE id = ?",
-            (utils.normalize(doc_id),)
-        )
-        result = cursor.fetchone()
-        cursor.close()
-        return result if result is None else result[0]
+        return self.get_docs([doc_id], 'value')[0]
+
+    def get_docs(self, doc_ids, field='text'):
+        """Fetch the text or value of the docs for 'doc_ids' in one query.
+
+        Returns a list in the same order as doc_ids, with None for missing
+        docs. Docs in the cache are not fetched again; at most MAX_VARIABLES
+        ids are looked up per query.
+        """
+        if field not in ('text', 'value'):
+            raise ValueError('Unknown document field: {}'.format(field))
+        results = {}
+        missing = []
+        with self.lock:
+            for doc_id in doc_ids:
+                key = (field, doc_id)
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    results[doc_id] = self.cache[key]
+                elif doc_id not in results:
+                    results[doc_id] = None
+                    missing.append(doc_id)
+
+        if missing:
+            ids = {utils.normalize(doc_id): doc_id for doc_id in missing}
+            keys = list(ids)
+            cursor = self.connection.cursor()
+            for i in range(0, len(keys), MAX_VARIABLES):
+                chunk = keys[i:i + MAX_VARIABLES]
+                cursor.execute(
+                    "SELECT id, {} FROM documents WHERE id IN ({})".format(
+                        field, ','.join('?' * len(chunk))
+                    ),
+                    chunk
+                )
+                for key, doc in cursor.fetchall():
+                    results[ids[key]] = doc
+            cursor.close()
+
+            if self.cache_size > 0:
+                with self.lock:
+                    for doc_id in missing:
+                        # missing docs may still be added later
+                        if results[doc_id] is not None:
+                            self.cache[(field, doc_id)] = results[doc_id]
+                    while len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+
+        return [results[doc_id] for doc_id in doc_ids]
 
     def add(self, triples):
         cursor = self.connection.cursor()
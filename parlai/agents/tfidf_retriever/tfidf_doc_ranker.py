@@ -11,6 +11,7 @@ Adapted from Adam Fisch's work at github.com/facebookresearch/DrQA/
 """
 
 import logging
+import os
 import numpy as np
 import scipy.sparse as sp
 
@@ -22,22 +23,45 @@ from . import tokenizers
 
 logger = logging.getLogger(__name__)
 
+DELTA_SUFFIX = '.delta'
+
 
 class TfidfDocRanker(object):
     """Loads a pre-weighted inverted index of token/document terms.
     Scores new queries by taking sparse dot products.
     """
 
-    def __init__(self, tfidf_path=None, strict=True):
+    def __init__(self, tfidf_path=None, strict=True, mmap=False):
         """
         Args:
             tfidf_path: path to saved model file
             strict: fail on empty queries or continue (and return empty result)
+            mmap: memory-map the index instead of loading it into memory. an
+              .npz index is converted to the memory-mapped layout first.
         """
         # Load from disk
         logger.info('Loading %s' % tfidf_path)
-        matrix, metadata = utils.load_sparse_csr(tfidf_path)
+        has_npz = os.path.isfile(tfidf_path + '.npz')
+        if mmap and has_npz and not utils.has_sparse_csr_mmap(tfidf_path):
+            logger.info('Converting %s to a memory-mapped index' % tfidf_path)
+            matrix, metadata = utils.load_sparse_csr(tfidf_path)
+            if metadata.get('term_max') is None:
+                matrix.sort_indices()
+                metadata['term_max'] = utils.max_per_row(matrix)
+            utils.save_sparse_csr_mmap(tfidf_path, matrix, metadata)
+            del matrix, metadata
+        if (mmap or not has_npz) and utils.has_sparse_csr_mmap(tfidf_path):
+            # memory-mapped indices are saved with sorted rows
+            matrix, metadata = utils.load_sparse_csr_mmap(tfidf_path)
+        else:
+            matrix, metadata = utils.load_sparse_csr(tfidf_path)
+            matrix.sort_indices()
         self.doc_mat = matrix
+        # each row of doc_mat is the posting list of one hashed ngram; keep
+        # the highest score in each to bound what a term can contribute
+        self.term_max = metadata.get('term_max')
+        if self.term_max is None:
+            self.term_max = utils.max_per_row(matrix)
         self.ngrams = metadata['ngram']
         self.hash_size = metadata['hash_size']
         self.tokenizer = tokenizers.get_class(metadata['tokenizer'])()
@@ -46,6 +70,17 @@ class TfidfDocRanker(object):
         self.num_docs = self.doc_mat.shape[1] - 1
         self.strict = strict
 
+        # docs added after the index was built are kept in a delta segment
+        self.base_doc_freqs = self.doc_freqs
+        self.base_num_docs = self.num_docs
+        self.delta_path = tfidf_path + DELTA_SUFFIX
+        self.delta_counts = None
+        self.delta_ids = None
+        if os.path.isfile(self.delta_path + '.npz'):
+            logger.info('Loading delta %s' % self.delta_path)
+            counts, metadata = utils.load_sparse_csr(self.delta_path)
+            self._set_delta(counts, metadata['doc_ids'])
+
     def get_doc_index(self, doc_id):
         """Convert doc_id --> doc_index"""
         return self.doc_dict[0][doc_id] if self.doc_dict else doc_id
@@ -61,27 +96,266 @@ class TfidfDocRanker(object):
         matrix arg can be provided to be used instead of internal doc matrix.
         """
         spvec = self.text2spvec(query)
-        res = spvec * matrix if matrix is not None else spvec * self.doc_mat
+        if matrix is not None:
+            res = spvec * matrix
+            return self._top_k(res.data, res.indices, k)
+        if self.delta_ids is None:
+            return self.max_score_top_k(spvec, k)
+        base_spvec, delta_spvec = self._segment_spvecs(spvec)
+        doc_ids, doc_scores = self.max_score_top_k(base_spvec, k)
+        res = (delta_spvec * self.delta_tfs).tocsr()
+        return self._merge_top_k(
+            doc_ids, doc_scores, self.delta_ids[res.indices], res.data, k
+        )
+
+    def add_delta(self, counts, doc_ids):
+        """Index new docs without rebuilding the base tfidf matrix.
+
+        counts is the (hash_size x len(doc_ids)) ngram count matrix of the new
+        docs, with column j holding the counts of doc_ids[j]. The docs are
+        appended to the delta segment, which is queried alongside the base
+        matrix, and the doc frequencies are updated to include them.
+        """
+        if self.doc_dict:
+            raise RuntimeError('Delta segments need an index by int doc id.')
+        counts = sp.csr_matrix(counts)
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        if self.delta_ids is not None:
+            counts = sp.hstack([self.delta_counts, counts], format='csr')
+            doc_ids = np.concatenate([self.delta_ids, doc_ids])
+        self._set_delta(counts, doc_ids)
+
+    def save_delta(self):
+        """Save the delta segment next to the base index."""
+        if self.delta_ids is not None:
+            utils.save_sparse_csr(
+                self.delta_path, self.delta_counts, {'doc_ids': self.delta_ids}
+            )
+
+    def num_delta_docs(self):
+        """Return the number of docs in the delta segment."""
+        return 0 if self.delta_ids is None else len(self.delta_ids)
+
+    def max_doc_id(self):
+        """Return the highest doc id in the base or delta segments."""
+        max_id = self.base_num_docs
+        if self.delta_ids is not None and len(self.delta_ids) > 0:
+            max_id = max(max_id, int(self.delta_ids.max()))
+        return max_id
+
+    def _set_delta(self, counts, doc_ids):
+        self.delta_counts = counts.tocsr()
+        self.delta_counts.sum_duplicates()
+        self.delta_ids = np.asarray(doc_ids, dtype=np.int64)
+        self.delta_tfs = self.delta_counts.log1p()
+        self.doc_freqs = (self.base_doc_freqs +
+                          np.diff(self.delta_counts.indptr))
+        self.num_docs = self.base_num_docs + len(self.delta_ids)
+
+    @staticmethod
+    def _matrix_idfs(doc_freqs, num_cols):
+        """Idfs as weighted into the doc matrix by build_tfidf."""
+        idfs = np.log((num_cols - doc_freqs + 0.5) / (doc_freqs + 0.5))
+        idfs[idfs < 0] = 0
+        return idfs
+
+    def _segment_spvecs(self, spvecs):
+        """Weight query vectors for the base and the delta segment.
+
+        The base matrix is weighted by the idfs of the base docs, so each
+        query term is rescaled by the ratio of the idf over all docs to its
+        base idf, which gives the scores of a full rebuild. Terms whose base
+        idf was clipped to 0 stay 0 in the base until the next rebuild. The
+        delta holds log term frequencies, so its query terms are multiplied
+        by the idf over all docs.
+        """
+        terms = spvecs.indices
+        idfs = self._matrix_idfs(self.doc_freqs[terms], self.num_docs + 1)
+        base_idfs = self._matrix_idfs(
+            self.base_doc_freqs[terms], self.base_num_docs + 1
+        )
+        ratio = np.zeros_like(idfs)
+        np.divide(idfs, base_idfs, out=ratio, where=base_idfs > 0)
+        base_spvecs = spvecs.copy()
+        base_spvecs.data = spvecs.data * ratio
+        delta_spvecs = spvecs.copy()
+        delta_spvecs.data = spvecs.data * idfs
+        return base_spvecs, delta_spvecs
+
+    @classmethod
+    def _merge_top_k(cls, doc_ids, doc_scores, delta_ids, delta_scores, k):
+        """Merge the top k of the base with the scores of the delta."""
+        keep = delta_scores > 0
+        doc_ids = np.concatenate([doc_ids, delta_ids[keep]])
+        doc_scores = np.concatenate([doc_scores, delta_scores[keep]])
+        return cls._top_k(doc_scores, doc_ids, k)
 
-        if len(res.data) <= k:
-            o_sort = np.argsort(-res.data)
+    @staticmethod
+    def _top_k(scores, doc_ids, k):
+        """Return the doc ids and scores of the k best scores, best first."""
+        if len(scores) <= k:
+            o_sort = np.argsort(-scores)
         else:
-            o = np.argpartition(-res.data, k)[0:k]
-            o_sort = o[np.argsort(-res.data[o])]
+            o = np.argpartition(-scores, k)[0:k]
+            o_sort = o[np.argsort(-scores[o])]
+        return doc_ids[o_sort], scores[o_sort]
 
-        doc_scores = res.data[o_sort]
-        doc_ids = res.indices[o_sort]
-        return doc_ids, doc_scores
+    def max_score_top_k(self, spvec, k=1):
+        """Find the k docs with the highest dot product with spvec.
 
-    def batch_closest_docs(self, queries, k=1, num_workers=None):
-        """Process a batch of closest_docs requests multithreaded.
-        Note: we can use plain threads here as scipy is outside of the GIL.
+        Only reads the posting lists of the query terms, using MaxScore
+        pruning: terms are visited from the highest to the lowest bound on
+        their contribution to a doc's score. Once the remaining terms cannot
+        lift an unseen doc above the current k-th best score, their posting
+        lists are only probed for the docs already seen instead of being
+        merged in full. Only docs with a positive score are returned.
         """
-        with ThreadPool(num_workers) as threads:
-            closest_docs = partial(self.closest_docs, k=k)
-            results = threads.map(closest_docs, queries)
+        keep = spvec.data > 0
+        terms, weights = spvec.indices[keep], spvec.data[keep]
+        bounds = weights * self.term_max[terms]
+        order = np.argsort(-bounds, kind='mergesort')
+        terms, weights, bounds = terms[order], weights[order], bounds[order]
+        # remaining[i] is the most a doc can gain from terms i onwards
+        remaining = np.cumsum(bounds[::-1])[::-1]
+
+        indptr, indices, data = (self.doc_mat.indptr, self.doc_mat.indices,
+                                 self.doc_mat.data)
+        doc_ids = np.zeros(0, dtype=indices.dtype)
+        doc_scores = np.zeros(0)
+        threshold = 0
+        for i, (term, weight) in enumerate(zip(terms, weights)):
+            start, end = indptr[term], indptr[term + 1]
+            if start == end:
+                continue
+            post_ids, post_vals = indices[start:end], data[start:end]
+            if len(doc_ids) >= k and remaining[i] <= threshold:
+                # no unseen doc can make it into the top k anymore, so drop
+                # candidates which can't either and look up the rest
+                alive = doc_scores + remaining[i] > threshold
+                doc_ids, doc_scores = doc_ids[alive], doc_scores[alive]
+                pos = np.searchsorted(post_ids, doc_ids)
+                pos[pos == len(post_ids)] = 0
+                found = post_ids[pos] == doc_ids
+                doc_scores[found] += weight * post_vals[pos[found]]
+            else:
+                doc_ids, inverse = np.unique(
+                    np.concatenate([doc_ids, post_ids]), return_inverse=True
+                )
+                doc_scores = np.bincount(
+                    inverse, minlength=len(doc_ids),
+                    weights=np.concatenate([doc_scores, weight * post_vals]),
+                )
+            if len(doc_scores) >= k:
+                threshold = np.partition(doc_scores, -k)[-k]
+
+        o_sort = np.argsort(-doc_scores, kind='mergesort')[:k]
+        o_sort = o_sort[doc_scores[o_sort] > 0]
+        return doc_ids[o_sort], doc_scores[o_sort]
+
+    def batch_closest_docs(self, queries, k=1, num_workers=None,
+                           chunk_size=128, max_padded_width=1024,
+                           max_elements=2 ** 20):
+        """Closest docs for a batch of queries, using matrix products.
+
+        The query vectors are stacked into one sparse matrix, which is
+        multiplied with the doc matrix chunk_size rows at a time. Result rows
+        with at most max_padded_width matches are padded into blocks of at
+        most max_elements scores, and the top k of a whole block is found with
+        one argpartition. Longer rows, where a per-row argpartition dominates
+        the cost anyway, are handled one at a time. If num_workers > 1, chunks
+        are processed by that many threads (scipy and numpy release the GIL).
+        """
+        if len(queries) == 0:
+            return []
+        spvecs = sp.vstack([self.text2spvec(q) for q in queries], format='csr')
+        if self.delta_ids is not None:
+            spvecs, delta_spvecs = self._segment_spvecs(spvecs)
+        chunks = [spvecs[i:i + chunk_size]
+                  for i in range(0, len(queries), chunk_size)]
+        chunk_closest_docs = partial(
+            self._chunk_closest_docs, k=k, max_padded_width=max_padded_width,
+            max_elements=max_elements,
+        )
+        if len(chunks) == 1 or not num_workers or num_workers == 1:
+            chunk_results = [chunk_closest_docs(c) for c in chunks]
+        else:
+            with ThreadPool(num_workers) as threads:
+                chunk_results = threads.map(chunk_closest_docs, chunks)
+        results = [res for chunk in chunk_results for res in chunk]
+        if self.delta_ids is None:
+            return results
+
+        res = (delta_spvecs * self.delta_tfs).tocsr()
+        for row, (doc_ids, doc_scores) in enumerate(results):
+            start, end = res.indptr[row], res.indptr[row + 1]
+            results[row] = self._merge_top_k(
+                doc_ids, doc_scores, self.delta_ids[res.indices[start:end]],
+                res.data[start:end], k
+            )
         return results
 
+    def _chunk_closest_docs(self, spvecs, k=1, max_padded_width=1024,
+                            max_elements=2 ** 20):
+        """Return a (doc_ids, doc_scores) pair for each row of spvecs."""
+        res = (spvecs * self.doc_mat).tocsr()
+        lengths = np.diff(res.indptr)
+        results = [None] * res.shape[0]
+
+        for row in np.where(lengths > max_padded_width)[0]:
+            start, end = res.indptr[row], res.indptr[row + 1]
+            doc_ids, doc_scores = self._top_k(
+                res.data[start:end], res.indices[start:end], k
+            )
+            # like closest_docs, only return docs with a positive score
+            keep = doc_scores > 0
+            results[row] = (doc_ids[keep], doc_scores[keep])
+
+        # group the short rows from shortest to longest, so padding them to
+        # the longest row of their block wastes little space
+        short = np.where(lengths <= max_padded_width)[0]
+        short = short[np.argsort(lengths[short], kind='mergesort')]
+        start = 0
+        while start < len(short):
+            end = start + 1
+            while (end < len(short) and
+                   (end + 1 - start) * lengths[short[end]] <= max_elements):
+                end += 1
+            rows = short[start:end]
+            for row, result in zip(rows, self._block_top_k(res[rows], k)):
+                results[row] = result
+            start = end
+        return results
+
+    @staticmethod
+    def _block_top_k(res, k):
+        """Top k of each row of a CSR matrix, for all rows at once."""
+        rows = res.shape[0]
+        lengths = np.diff(res.indptr)
+        width = max(lengths.max(), 1)
+        # pad every row to the same width. scores are negated so argpartition
+        # puts the best first, and padding is +inf
+        row_ids = np.repeat(np.arange(rows), lengths)
+        cols = np.arange(res.nnz) - np.repeat(res.indptr[:-1], lengths)
+        neg_scores = np.full((rows, width), np.inf)
+        neg_scores[row_ids, cols] = -res.data
+        doc_ids = np.zeros((rows, width), dtype=res.indices.dtype)
+        doc_ids[row_ids, cols] = res.indices
+
+        if width > k:
+            top = np.argpartition(neg_scores, k - 1, axis=1)[:, :k]
+        else:
+            top = np.tile(np.arange(width), (rows, 1))
+        top_scores = np.take_along_axis(neg_scores, top, axis=1)
+        order = np.argsort(top_scores, axis=1, kind='mergesort')
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = -np.take_along_axis(top_scores, order, axis=1)
+        top_ids = np.take_along_axis(doc_ids, top, axis=1)
+
+        # like closest_docs, only return docs with a positive score
+        keep = top_scores > 0
+        return [(top_ids[i][keep[i]], top_scores[i][keep[i]])
+                for i in range(rows)]
+
     def parse(self, query):
         """Parse the query into tokens (either ngrams or tokens)."""
         tokens = self.tokenizer.tokenize(query)
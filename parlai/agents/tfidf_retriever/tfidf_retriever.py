@@ -19,9 +19,12 @@ except ImportError:
 from parlai.core.agents import Agent
 from parlai.core.utils import AttrDict
 from .doc_db import DocDB
-from .tfidf_doc_ranker import TfidfDocRanker
+from .tfidf_doc_ranker import TfidfDocRanker, DELTA_SUFFIX
 from .build_tfidf import run as build_tfidf
-from .build_tfidf import live_count_matrix, get_tfidf_matrix
+from .build_tfidf import (
+    live_count_matrix, get_tfidf_matrix, get_delta_count_matrix
+)
+from .utils import has_sparse_csr_mmap
 from numpy.random import choice
 from collections import deque
 import math
@@ -73,6 +76,31 @@ class TfidfRetrieverAgent(Agent):
             '--retriever-mode', choices=['keys', 'values'], default='values',
             help='Whether to retrieve the stored key or the stored value.'
         )
+        parser.add_argument(
+            '--retriever-mmap', type='bool', default=False,
+            help='Store the tfidf matrix as raw arrays which are memory-mapped '
+                 'read-only when loading, so the index loads quickly and is '
+                 'shared between processes. Existing .npz indices are '
+                 'converted on first load.')
+        parser.add_argument(
+            '--retriever-tmp-dir', type=str, default=None,
+            help='Directory where word counts are spilled to disk while '
+                 'building the tfidf matrix. Defaults to the system temp '
+                 'directory, which may be held in memory.')
+        parser.add_argument(
+            '--retriever-doc-cache-size', type=int, default=0,
+            help='Keep up to this many recently retrieved docs in memory, '
+                 'instead of reading them from the database every time.')
+        parser.add_argument(
+            '--retriever-incremental', type='bool', default=False,
+            help='Index docs added after the tfidf matrix was built in a '
+                 'separate delta segment, instead of rebuilding the whole '
+                 'matrix each time new docs are stored.')
+        parser.add_argument(
+            '--retriever-merge-ratio', type=float, default=0.1, hidden=True,
+            help='With --retriever-incremental, rebuild the whole tfidf '
+                 'matrix once the delta segment holds more than this '
+                 'fraction of the docs in the matrix.')
         parser.add_argument(
             '--remove-title', type='bool', default=False,
             help='Whether to remove the title from the retrieved passage')
@@ -108,6 +136,8 @@ class TfidfRetrieverAgent(Agent):
             'hash_size': opt['retriever_hashsize'],
             'tokenizer': opt['retriever_tokenizer'],
             'num_workers': opt['retriever_numworkers'],
+            'mmap': opt.get('retriever_mmap', False),
+            'tmp_dir': opt.get('retriever_tmp_dir'),
         })
 
         if not os.path.exists(self.db_path):
@@ -118,10 +148,17 @@ class TfidfRetrieverAgent(Agent):
             conn.commit()
             conn.close()
 
-        self.db = DocDB(db_path=opt['retriever_dbpath'])
-        if os.path.exists(self.tfidf_path + '.npz'):
+        self.db = DocDB(
+            db_path=opt['retriever_dbpath'],
+            cache_size=opt.get('retriever_doc_cache_size', 0)
+        )
+        if shared and 'ranker' in shared:
+            self.ranker = shared['ranker']
+        elif (os.path.exists(self.tfidf_path + '.npz') or
+                has_sparse_csr_mmap(self.tfidf_path)):
             self.ranker = TfidfDocRanker(
-                tfidf_path=opt['retriever_tfidfpath'], strict=False)
+                tfidf_path=opt['retriever_tfidfpath'], strict=False,
+                mmap=self.tfidf_args.mmap)
         self.ret_mode = opt['retriever_mode']
         self.cands_hash = {}  # cache for candidates
         self.triples_to_add = []  # in case we want to add more entries
@@ -131,6 +168,12 @@ class TfidfRetrieverAgent(Agent):
         self.include_labels = opt.get('include_labels', True)
         self.reset()
 
+    def share(self):
+        shared = super().share()
+        if hasattr(self, 'ranker'):
+            shared['ranker'] = self.ranker
+        return shared
+
     def reset(self):
         super().reset()
         self.episode_done = False
@@ -154,14 +197,53 @@ class TfidfRetrieverAgent(Agent):
             raise RuntimeError('Retrieve mode {} not yet supported.'.format(
                 self.ret_mode))
 
+    def docs2txt(self, docids):
+        """Look up the text of several docs with one database query."""
+        if not self.opt.get('index_by_int_id', True):
+            docids = [self.ranker.get_doc_id(docid) for docid in docids]
+        if self.ret_mode == 'keys':
+            return self.db.get_docs(docids, 'text')
+        elif self.ret_mode == 'values':
+            return self.db.get_docs(docids, 'value')
+        else:
+            raise RuntimeError('Retrieve mode {} not yet supported.'.format(
+                self.ret_mode))
+
     def rebuild(self):
         if len(self.triples_to_add) > 0:
             self.db.add(self.triples_to_add)
             self.triples_to_add.clear()
+            if (self.opt.get('retriever_incremental', False) and
+                    hasattr(self, 'ranker') and self.add_delta()):
+                return
             # rebuild tfidf
             build_tfidf(self.tfidf_args)
+            if os.path.exists(self.tfidf_path + DELTA_SUFFIX + '.npz'):
+                os.remove(self.tfidf_path + DELTA_SUFFIX + '.npz')
             self.ranker = TfidfDocRanker(
-                tfidf_path=self.tfidf_path, strict=False)
+                tfidf_path=self.tfidf_path, strict=False,
+                mmap=self.tfidf_args.mmap)
+
+    def add_delta(self):
+        """Index the newly stored docs in the delta segment of the ranker.
+
+        Returns False if the delta has grown past --retriever-merge-ratio, in
+        which case the whole tfidf matrix should be rebuilt instead.
+        """
+        new_ids = self.db.get_doc_ids_after(self.ranker.max_doc_id())
+        num_delta = self.ranker.num_delta_docs() + len(new_ids)
+        if num_delta > (self.opt.get('retriever_merge_ratio', 0.1) *
+                        self.ranker.base_num_docs):
+            return False
+        if new_ids:
+            self.ranker.add_delta(
+                get_delta_count_matrix(
+                    self.tfidf_args, {'db_path': self.db_path}, new_ids
+                ),
+                new_ids
+            )
+            self.ranker.save_delta()
+        return True
 
     def save(self, path=None):
         self.rebuild()
@@ -248,31 +330,66 @@ class TfidfRetrieverAgent(Agent):
                     reply['text'] = reply['text_candidates'][0]
                 else:
                     reply['text'] = ''
-            elif len(doc_ids) > 0:
-                # return stored fact
-                # total = sum(doc_scores)
-                # doc_probs = [d / total for d in doc_scores]
-
-                # returned
-                picks = [self.doc2txt(int(did)) for did in doc_ids]
-                pick = self.doc2txt(int(doc_ids[0]))  # select best response
-
-                if self.opt.get('remove_title', False):
-                    picks = ['\n'.join(p.split('\n')[1:]) for p in picks]
-                    pick = '\n'.join(pick.split('\n')[1:])
-                reply['text_candidates'] = picks
-                reply['candidate_scores'] = doc_scores
-
-                # could pick single choice based on probability scores?
-                # pick = int(choice(doc_ids, p=doc_probs))
-                reply['text'] = pick
             else:
-                # no cands and nothing found, return generic response
-                reply['text'] = choice([
-                    'Can you say something more interesting?',
-                    'Why are you being so short with me?',
-                    'What are you really thinking?',
-                    'Can you expand on that?',
-                ])
+                self._reply_with_docs(reply, doc_ids, doc_scores)
 
         return reply
+
+    def batch_act(self, observations):
+        """Reply to a batch of observations, ranking all of them at once."""
+        batch_reply = [{'id': self.getID()} for _ in observations]
+        if any('labels' in obs for obs in observations):
+            for i, obs in enumerate(observations):
+                self.observation = obs
+                batch_reply[i] = self.train_act()
+            return batch_reply
+
+        valid_inds = [i for i, obs in enumerate(observations) if 'text' in obs]
+        if valid_inds:
+            self.rebuild()  # no-op if nothing has been queued to store
+            results = self.ranker.batch_closest_docs(
+                [observations[i]['text'] for i in valid_inds],
+                self.opt.get('retriever_num_retrieved', 5),
+                num_workers=self.opt.get('retriever_numworkers'),
+            )
+            # fetch the docs of the whole batch at once
+            docs = self.docs2txt(
+                [int(did) for doc_ids, _ in results for did in doc_ids]
+            )
+            start = 0
+            for i, (doc_ids, doc_scores) in zip(valid_inds, results):
+                picks = docs[start:start + len(doc_ids)]
+                start += len(doc_ids)
+                self._reply_with_docs(batch_reply[i], doc_ids, doc_scores,
+                                      picks)
+        return batch_reply
+
+    def _reply_with_docs(self, reply, doc_ids, doc_scores, picks=None):
+        """Fill in reply with the retrieved docs."""
+        if len(doc_ids) > 0:
+            # return stored fact
+            # total = sum(doc_scores)
+            # doc_probs = [d / total for d in doc_scores]
+
+            # returned
+            if picks is None:
+                picks = self.docs2txt([int(did) for did in doc_ids])
+            pick = picks[0]  # select best response
+
+            if self.opt.get('remove_title', False):
+                picks = ['\n'.join(p.split('\n')[1:]) for p in picks]
+                pick = picks[0]
+            reply['text_candidates'] = picks
+            reply['candidate_scores'] = doc_scores
+
+            # could pick single choice based on probability scores?
+            # pick = int(choice(doc_ids, p=doc_probs))
+            reply['text'] = pick
+        else:
+            # no cands and nothing found, return generic response
+            reply['text'] = choice([
+                'Can you say something more interesting?',
+                'Why are you being so short with me?',
+                'What are you really thinking?',
+                'Can you expand on that?',
+            ])
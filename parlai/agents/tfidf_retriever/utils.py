@@ -8,10 +8,13 @@
 
 """Various retriever utilities."""
 
+import os
+import pickle
 import regex
 import unicodedata
 import numpy as np
 import scipy.sparse as sp
+from functools import partial
 from sklearn.utils import murmurhash3_32
 try:
     import torch
@@ -46,12 +49,123 @@ def save_sparse_tensor(filename, matrix, metadata=None):
 
 
 def load_sparse_csr(filename):
-    loader = np.load(filename + '.npz')
+    loader = np.load(filename + '.npz', allow_pickle=True)
     matrix = sp.csr_matrix((loader['data'], loader['indices'],
                             loader['indptr']), shape=loader['shape'])
     return matrix, loader['metadata'].item(0) if 'metadata' in loader else None
 
 
+def _replace_file(path, write_fn):
+    """Write path through a temporary file which is then renamed.
+
+    Readers which memory-mapped the old file keep their mapping valid.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        write_fn(f)
+    os.replace(tmp_path, path)
+
+
+_CSR_ARRAYS = ('data', 'indices', 'indptr')
+
+
+def save_sparse_csr_mmap(filename, matrix, metadata=None):
+    """Save a CSR matrix as raw arrays which can be memory-mapped.
+
+    Creates the directory filename.mmap, containing one .npy file each for the
+    data, indices and indptr arrays of the matrix and for every numpy array in
+    the metadata (e.g. doc_freqs), as well as a pickle of the remaining
+    metadata. The indices of each row are sorted before saving.
+    """
+    dirname = filename + '.mmap'
+    os.makedirs(dirname, exist_ok=True)
+    matrix.sort_indices()
+    for name in _CSR_ARRAYS:
+        _replace_file(os.path.join(dirname, name + '.npy'),
+                      partial(np.save, arr=getattr(matrix, name)))
+    _save_mmap_metadata(dirname, matrix.shape, metadata)
+
+
+def open_sparse_csr_mmap(filename, shape, nnz, dtype, idx_dtype=np.int32):
+    """Create an empty CSR matrix in the layout of save_sparse_csr_mmap.
+
+    Returns its (data, indices, indptr) arrays, memory-mapped for writing, so
+    a matrix larger than memory can be filled in place. The indices of each
+    row must be filled in sorted. The arrays are kept in temporary files
+    until close_sparse_csr_mmap is called, so readers of a matrix already
+    saved at filename are not affected.
+    """
+    dirname = filename + '.mmap'
+    os.makedirs(dirname, exist_ok=True)
+    specs = {
+        'data': (nnz, dtype),
+        'indices': (nnz, idx_dtype),
+        'indptr': (shape[0] + 1, idx_dtype),
+    }
+    return tuple(
+        np.lib.format.open_memmap(
+            os.path.join(dirname, name + '.npy.tmp'), mode='w+',
+            dtype=specs[name][1], shape=(specs[name][0],)
+        )
+        for name in _CSR_ARRAYS
+    )
+
+
+def close_sparse_csr_mmap(filename, shape, arrays, metadata=None):
+    """Save a matrix created with open_sparse_csr_mmap and its metadata.
+
+    arrays are the (data, indices, indptr) arrays it returned.
+    """
+    dirname = filename + '.mmap'
+    for name, array in zip(_CSR_ARRAYS, arrays):
+        array.flush()
+        os.replace(os.path.join(dirname, name + '.npy.tmp'),
+                   os.path.join(dirname, name + '.npy'))
+    _save_mmap_metadata(dirname, shape, metadata)
+
+
+def _save_mmap_metadata(dirname, shape, metadata):
+    """Save the numpy arrays in metadata, then the rest of the metadata."""
+    metadata = dict(metadata or {})
+    arrays = list(_CSR_ARRAYS)
+    for key, value in list(metadata.items()):
+        if isinstance(value, np.ndarray):
+            _replace_file(os.path.join(dirname, key + '.npy'),
+                          partial(np.save, arr=metadata.pop(key)))
+            arrays.append(key)
+    metadata['shape'] = shape
+    metadata['arrays'] = sorted(arrays)
+    # metadata is written last, marking the index as complete
+    _replace_file(os.path.join(dirname, 'metadata.pkl'),
+                  partial(pickle.dump, metadata))
+
+
+def has_sparse_csr_mmap(filename):
+    """Return whether filename was saved with save_sparse_csr_mmap."""
+    return os.path.isfile(os.path.join(filename + '.mmap', 'metadata.pkl'))
+
+
+def load_sparse_csr_mmap(filename):
+    """Load a matrix saved with save_sparse_csr_mmap.
+
+    The arrays are memory-mapped read-only, so loading is fast and processes
+    opening the same index share its pages through the OS page cache.
+    """
+    dirname = filename + '.mmap'
+    with open(os.path.join(dirname, 'metadata.pkl'), 'rb') as f:
+        metadata = pickle.load(f)
+    arrays = {
+        name: np.load(os.path.join(dirname, name + '.npy'), mmap_mode='r')
+        for name in metadata.pop('arrays')
+    }
+    matrix = sp.csr_matrix(
+        (arrays.pop('data'), arrays.pop('indices'), arrays.pop('indptr')),
+        shape=metadata.pop('shape'), copy=False
+    )
+    metadata.update(arrays)
+    return matrix, metadata
+
+
 def load_sparse_tensor(filename):
     loader = torch.load(filename)
     matrix = torch.sparse.FloatTensor(
@@ -60,6 +174,18 @@ def load_sparse_tensor(filename):
     return matrix, loader['metadata'] if 'metadata' in loader else None
 
 
+def max_per_row(matrix):
+    """Return the largest value in each row of a CSR matrix (0 if empty)."""
+    maxes = np.zeros(matrix.shape[0], dtype=matrix.dtype)
+    nonempty = np.diff(matrix.indptr) > 0
+    if nonempty.any():
+        # each reduction runs until the start of the next nonempty row
+        maxes[nonempty] = np.maximum.reduceat(
+            matrix.data, matrix.indptr[:-1][nonempty]
+        )
+    return maxes
+
+
 # ------------------------------------------------------------------------------
 # Token hashing.
 # ------------------------------------------------------------------------------
@@ -40,6 +40,7 @@ This module also provides a utility method:
 """
 
 from parlai.core.build_data import modelzoo_path
+from parlai.core.registry import module_defines
 from .metrics import Metrics, aggregate_metrics
 import copy
 import importlib
@@ -326,7 +327,8 @@ def load_agent_module(opt):
             if k not in new_opt:
                 new_opt[k] = v
         new_opt['model_file'] = model_file
-        model_class = get_agent_module(new_opt['model'])
+        model_class = get_agent_module(new_opt['model'],
+                                       new_opt.get('datapath'))
 
         # check for model version
         if hasattr(model_class, 'model_version'):
@@ -351,7 +353,7 @@ def load_agent_module(opt):
         return None
 
 
-def get_agent_module(dir_name):
+def get_agent_module(dir_name, datapath=None):
     """Return the module for an agent specified by ``--model``.
 
     Can be formatted in several different ways:
@@ -373,6 +375,8 @@ def get_agent_module(dir_name):
     e.g. "legacy:seq2seq:0" will translate to ``legacy_agents/seq2seq/seq2seq_v0``.
 
     :param dir_name: path to model class in one of the above formats.
+    :param datapath: data path holding the registry cache used to resolve
+        shorthands, defaults to ``{parlai_dir}/data``.
     """
     repo = 'parlai'
     if dir_name.startswith('internal:'):
@@ -410,10 +414,17 @@ def get_agent_module(dir_name):
         # will check parlai.agents.seq2seq.agents for Seq2seqAgent first
         # then check parlai.agents.seq2seq.seq2seq for Seq2seqAgent second
         class_name = name_to_agent_class(dir_name)
-        try:
-            module_name = "%s.agents.%s.agents" % (repo, dir_name)
-            importlib.import_module(module_name)  # check if it's there
-        except ImportError:
+        module_name = "%s.agents.%s.agents" % (repo, dir_name)
+        # look it up in the registry first, so that only the module holding
+        # the agent gets imported
+        found = module_defines(module_name, class_name, datapath)
+        if found is None:
+            try:
+                importlib.import_module(module_name)  # check if it's there
+                found = True
+            except ImportError:
+                found = False
+        if not found:
             module_name = "%s.agents.%s.%s" % (repo, dir_name, dir_name)
     my_module = importlib.import_module(module_name)
     model_class = getattr(my_module, class_name)
@@ -434,15 +445,10 @@ def create_agent(opt, requireModelExists=False):
     """
     if opt.get('datapath', None) is None:
         # add datapath, it is missing
-        from parlai.core.params import ParlaiParser, get_model_name
-        parser = ParlaiParser(add_parlai_args=False)
-        parser.add_parlai_data_path()
+        from parlai.core.params import get_model_defaults, get_model_name
         # add model args if they are missing
-        model = get_model_name(opt)
-        if model is not None:
-            parser.add_model_subargs(model)
-        opt_parser = parser.parse_args("", print_args=False)
-        for k, v in opt_parser.items():
+        defaults = get_model_defaults(get_model_name(opt))
+        for k, v in defaults.items():
             if k not in opt:
                 opt[k] = v
 
@@ -460,7 +466,7 @@ def create_agent(opt, requireModelExists=False):
             print("[ no model with opt yet at: " + opt.get('model_file') + "(.opt) ]")
 
     if opt.get('model'):
-        model_class = get_agent_module(opt['model'])
+        model_class = get_agent_module(opt['model'], opt.get('datapath'))
         model = model_class(opt)
         if requireModelExists and hasattr(model, 'load') and not opt.get('model_file'):
             # double check that we didn't forget to set model_file on loadable model
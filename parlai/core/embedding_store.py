@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+"""Provides memory-mapped storage for pretrained word embeddings.
+
+Pretrained vectors are converted once into a directory holding:
+
+- ``vectors.f32``: the float32 matrix of vectors, one row per token
+- ``index.npy``: (hash, row) pairs sorted by the hash of each token
+- ``tokens.bin`` and ``offsets.npy``: the utf-8 tokens of each row
+
+Every file is memory mapped, so looking up the vectors of a dictionary only
+reads the rows it needs, and processes loading the same store (e.g. hogwild
+workers) share its pages through the OS page cache.
+
+.. code-block:: python
+
+    if not EmbeddingStore.exists(path):
+        EmbeddingStore.build(path, read_text_vectors('glove.840B.300d.txt'))
+    store = load_store(path)
+    rows = store.rows(['hello', 'world'])
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+
+
+def token_hash(token):
+    """Return a 64-bit hash of the token, stable across processes."""
+    return int.from_bytes(
+        hashlib.md5(token.encode('utf-8')).digest()[:8], 'little'
+    )
+
+
+def read_text_vectors(path, normalize=None):
+    """Yield (token, vector) pairs from a GloVe or fastText text file.
+
+    The header line of fastText files is skipped. If given, normalize is
+    applied to each token.
+    """
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            parsed = line.rstrip().split(' ')
+            if len(parsed) <= 2:
+                continue
+            token = parsed[0] if normalize is None else normalize(parsed[0])
+            yield token, np.array(parsed[1:], dtype=np.float32)
+
+
+class EmbeddingStore(object):
+    """Read-only, memory-mapped matrix of pretrained word vectors."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.dim = meta['dim']
+        self.size = meta['size']
+        if self.size > 0:
+            self.vectors = np.memmap(
+                os.path.join(path, 'vectors.f32'), dtype=np.float32,
+                mode='r', shape=(self.size, self.dim)
+            )
+        else:
+            self.vectors = np.zeros((0, self.dim), dtype=np.float32)
+        index = np.load(os.path.join(path, 'index.npy'), mmap_mode='r')
+        self.hashes = index[:, 0]
+        self.index_rows = index[:, 1]
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'),
+                               mmap_mode='r')
+        with open(os.path.join(path, 'tokens.bin'), 'rb') as f:
+            self.token_bytes = f.read()
+
+    def __len__(self):
+        return self.size
+
+    @staticmethod
+    def exists(path):
+        return os.path.isfile(os.path.join(path, 'meta.json'))
+
+    def token(self, row):
+        """Return the token of a row."""
+        start, end = self.offsets[row], self.offsets[row + 1] - 1
+        return self.token_bytes[start:end].decode('utf-8')
+
+    def tokens(self):
+        """Return the tokens of all rows."""
+        return self.token_bytes.decode('utf-8').split('\n') if self.size else []
+
+    def rows(self, tokens):
+        """Return the row of each token, or -1 for tokens without a vector."""
+        if len(tokens) == 0 or self.size == 0:
+            return np.full(len(tokens), -1, dtype=np.int64)
+        hashes = np.array([token_hash(t) for t in tokens], dtype=np.uint64)
+        pos = np.searchsorted(self.hashes, hashes)
+        pos[pos == self.size] = 0
+        found = self.hashes[pos] == hashes
+        rows = np.where(found, self.index_rows[pos], -1).astype(np.int64)
+        # make sure that hash collisions did not give the row of another token
+        for i in np.flatnonzero(found):
+            if self.token(rows[i]) != tokens[i]:
+                rows[i] = -1
+        return rows
+
+    @staticmethod
+    def build(path, pairs):
+        """Write (token, vector) pairs into a new store at path.
+
+        If a token occurs several times, its last vector is kept. The store
+        is written to a temporary directory which is then renamed, so that
+        concurrent readers never see a partial store.
+        """
+        tmp_path = '{}.tmp{}'.format(path, os.getpid())
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        token_rows = {}
+        replaced = {}
+        dim = 0
+        vectors_path = os.path.join(tmp_path, 'vectors.f32')
+        with open(vectors_path, 'wb') as f:
+            for token, vec in pairs:
+                vec = np.asarray(vec, dtype=np.float32).reshape(-1)
+                if dim == 0:
+                    dim = len(vec)
+                elif len(vec) != dim:
+                    raise ValueError('Vector of {} has dimension {}, '
+                                     'expected {}.'.format(token, len(vec), dim))
+                if token in token_rows:
+                    replaced[token_rows[token]] = vec
+                else:
+                    token_rows[token] = len(token_rows)
+                    f.write(vec.tobytes())
+        if replaced:
+            vectors = np.memmap(vectors_path, dtype=np.float32, mode='r+',
+                                shape=(len(token_rows), dim))
+            for row, vec in replaced.items():
+                vectors[row] = vec
+            vectors.flush()
+            del vectors
+
+        # tokens are separated by newlines, and row i spans
+        # [offsets[i], offsets[i + 1] - 1) of tokens.bin
+        token_bytes = [t.encode('utf-8') for t in token_rows]
+        offsets = np.zeros(len(token_bytes) + 1, dtype=np.int64)
+        np.cumsum([len(b) + 1 for b in token_bytes], out=offsets[1:])
+        with open(os.path.join(tmp_path, 'tokens.bin'), 'wb') as f:
+            f.write(b'\n'.join(token_bytes))
+        np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+
+        hashes = np.array([token_hash(t) for t in token_rows],
+                          dtype=np.uint64)
+        order = np.argsort(hashes, kind='mergesort')
+        np.save(os.path.join(tmp_path, 'index.npy'),
+                np.stack([hashes[order], order.astype(np.uint64)], axis=1))
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'dim': dim, 'size': len(token_rows)}, f)
+
+        if EmbeddingStore.exists(path):
+            # another process finished first
+            shutil.rmtree(tmp_path)
+        else:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            os.rename(tmp_path, path)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def load_store(path):
+    """Return the store at path, loading it only once per process."""
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = EmbeddingStore(path)
+        return _stores[path]
+
+
+def copy_embeddings(weight, dictionary, store, project=None):
+    """Copy the vectors of the dictionary's tokens from store into weight.
+
+    Only the rows of the tokens in the dictionary are read. If the store has
+    another dimension than weight, ``project(vec, dim)`` maps each vector to
+    the dimension of weight.
+
+    Returns the number of tokens that were initialized.
+    """
+    import torch
+
+    tokens = list(dictionary.tok2ind.keys())
+    rows = store.rows(tokens)
+    found = np.flatnonzero(rows >= 0)
+    if len(found) == 0:
+        return 0
+    # read the rows in the order of the file, and keep the dictionary order
+    order = np.argsort(rows[found], kind='mergesort')
+    vecs = np.empty((len(found), store.dim), dtype=np.float32)
+    vecs[order] = store.vectors[rows[found][order]]
+    vecs = torch.from_numpy(vecs)
+    if store.dim != weight.size(1):
+        vecs = torch.cat([project(vec, weight.size(1)).view(1, -1)
+                          for vec in vecs])
+    inds = torch.LongTensor([dictionary.tok2ind[tokens[i]] for i in found])
+    weight.data[inds.to(weight.device)] = vecs.to(weight.device)
+    return len(found)
@@ -14,15 +14,29 @@ from parlai.core.thread_utils import SharedTable
 from parlai.core.utils import round_sigfigs, no_lock
 from collections import Counter
 
+import importlib.util
 import re
 import math
 
-try:
-    from nltk.translate import bleu_score as nltkbleu
-except ImportError:
-    # User doesn't have nltk installed, so we can't use it for bleu
-    # We'll just turn off things, but we might want to warn the user
-    nltkbleu = None
+# If the user doesn't have nltk installed, we can't use it for bleu.
+# We'll just turn off things, but we might want to warn the user.
+_HAS_NLTK = importlib.util.find_spec('nltk') is not None
+nltkbleu = None
+
+
+def _load_nltkbleu():
+    """Import nltk's bleu module, which takes a long time, only once metrics
+    are needed.
+
+    This is done when creating ``Metrics`` rather than on the first bleu
+    computation, so that it happens before hogwild processes are forked:
+    importing nltk in the forked processes can deadlock.
+    """
+    global nltkbleu
+    if nltkbleu is None and _HAS_NLTK:
+        from nltk.translate import bleu_score
+        nltkbleu = bleu_score
+
 
 re_art = re.compile(r'\b(a|an|the)\b')
 re_punc = re.compile(r'[!"#$%&()*+,-./:;<=>?@\[\]\\^`{|}~_\']')
@@ -88,6 +102,7 @@ def _f1_score(guess, answers):
 
 def _bleu(guess, answers):
     """Compute approximate BLEU score between guess and a set of answers."""
+    _load_nltkbleu()
     if nltkbleu is None:
         # bleu library not installed, just return a default value
         return None
@@ -177,6 +192,7 @@ class Metrics(object):
         self.metrics = {}
         self.metrics['cnt'] = 0
         self.metrics_list = ['mean_rank', 'loss', 'correct', 'f1', 'ppl']
+        _load_nltkbleu()
         if nltkbleu is not None:
             # only compute bleu if we can
             self.metrics_list.append('bleu')
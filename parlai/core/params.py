@@ -10,6 +10,7 @@ using the ParlAI package.
 """
 
 import argparse
+import copy
 import importlib
 import os
 import pickle
@@ -19,7 +20,6 @@ import datetime
 from parlai.core.agents import get_agent_module, get_task_module
 from parlai.tasks.tasks import ids_to_tasks
 from parlai.core.build_data import modelzoo_path
-from parlai.core.pytorch_data_teacher import get_dataset_classes
 
 
 def get_model_name(opt):
@@ -43,6 +43,33 @@ def get_model_name(opt):
     return model
 
 
+def _starttime():
+    return datetime.datetime.today().strftime('%b%d_%H-%M')
+
+
+_model_defaults = {}
+
+
+def get_model_defaults(model):
+    """Return the defaults of the data path arguments and of the arguments
+    of a model, e.g. to fill in the opt of an agent created from a dict.
+
+    The defaults are parsed once per agent class, so repeated calls do not
+    build a new ``ParlaiParser`` each time. Returns a copy, which the caller
+    may modify.
+    """
+    agent = None if model is None else get_agent_module(model)
+    if agent not in _model_defaults:
+        parser = ParlaiParser(add_parlai_args=False)
+        parser.add_parlai_data_path()
+        if model is not None:
+            parser.add_model_subargs(model)
+        _model_defaults[agent] = parser.parse_args([], print_args=False)
+    defaults = copy.deepcopy(_model_defaults[agent])
+    defaults['starttime'] = _starttime()
+    return defaults
+
+
 def str2bool(value):
     v = value.lower()
     if v in ('yes', 'true', 't', '1', 'y'):
@@ -124,6 +151,8 @@ class ParlaiParser(argparse.ArgumentParser):
         # remember which args were specified on the command line
         self.cli_args = _sys.argv[1:]
         self.overridable = {}
+        # agent and task classes whose args were added to this parser
+        self.added_args = set()
 
         if add_parlai_args:
             self.add_parlai_args()
@@ -338,6 +367,17 @@ class ParlaiParser(argparse.ArgumentParser):
             help='number of threads. If batchsize set to 1, used for hogwild; '
                  'otherwise, used for number of threads in threadpool loading,'
                  ' e.g. in vqa')
+        parlai.add_argument(
+            '--dialog-data', default='tuples', choices=['tuples', 'compact'],
+            hidden=True,
+            help='how DialogTeachers store their data: "tuples" of python '
+                 'strings, or "compact" flat arrays of utf-8 strings, which '
+                 'use much less memory for large tasks')
+        parlai.add_argument(
+            '--dialog-data-cache', default=False, type='bool',
+            hidden=True,
+            help='with --dialog-data compact, save the arrays next to the '
+                 'datafile on first load, and memory map them afterwards')
         parlai.add_argument(
             '--hide-labels', default=False, type='bool',
             hidden=True,
@@ -405,9 +445,12 @@ class ParlaiParser(argparse.ArgumentParser):
             hidden=True,
             help='the class of the dictionary agent uses')
 
-    def add_model_subargs(self, model):
+    def add_model_subargs(self, model, datapath=None):
         """Add arguments specific to a particular model."""
-        agent = get_agent_module(model)
+        agent = get_agent_module(model, datapath)
+        if agent in self.added_args:
+            return
+        self.added_args.add(agent)
         try:
             if hasattr(agent, 'add_cmdline_args'):
                 agent.add_cmdline_args(self)
@@ -426,6 +469,9 @@ class ParlaiParser(argparse.ArgumentParser):
         """Add arguments specific to the specified task."""
         for t in ids_to_tasks(task).split(','):
             agent = get_task_module(t)
+            if agent in self.added_args:
+                continue
+            self.added_args.add(agent)
             try:
                 if hasattr(agent, 'add_cmdline_args'):
                     agent.add_cmdline_args(self)
@@ -435,6 +481,7 @@ class ParlaiParser(argparse.ArgumentParser):
 
     def add_pyt_dataset_args(self, opt):
         """Add arguments specific to specified pytorch dataset"""
+        from parlai.core.pytorch_data_teacher import get_dataset_classes
         dataset_classes = get_dataset_classes(opt)
         for dataset, _, _ in dataset_classes:
             try:
@@ -486,7 +533,7 @@ class ParlaiParser(argparse.ArgumentParser):
         # find which model specified if any, and add its specific arguments
         model = get_model_name(parsed)
         if model is not None:
-            self.add_model_subargs(model)
+            self.add_model_subargs(model, parsed.get('datapath'))
 
         # reset parser-level defaults over any model-level defaults
         try:
@@ -574,7 +621,7 @@ class ParlaiParser(argparse.ArgumentParser):
                 self.opt.get('datapath'), self.opt['override']['dict_file'])
 
         # add start time of an experiment
-        self.opt['starttime'] = datetime.datetime.today().strftime('%b%d_%H-%M')
+        self.opt['starttime'] = _starttime()
 
         if print_args:
             self.print_args()
@@ -287,7 +287,8 @@ def get_dataset_classes(opt):
         if hasattr(dataset_class, 'collate'):
             collate = dataset_class.collate
         elif opt.get('model', False):
-            agent_class = get_agent_module(opt.get('model'))
+            agent_class = get_agent_module(opt.get('model'),
+                                           opt.get('datapath'))
             if hasattr(agent_class, 'collate'):
                 collate = agent_class.collate
         datasets.append((dataset_class, collate, full_task_name))
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+"""Registry of the names defined by agent and task modules.
+
+Resolving ``--model`` and ``--task`` shorthands means finding which module
+holds a class, e.g. ``parlai.agents.seq2seq.agents`` or
+``parlai.agents.seq2seq.seq2seq`` for ``Seq2seqAgent``, or whether a task has
+a ``worlds`` module with a given world. Importing candidate modules to find
+out pulls in their dependencies (torch, nltk, spacy...), so the registry reads
+the top-level names of a module from its source instead.
+
+The names are cached on disk in ``registry.json`` under the data path, keyed
+by the mtime and size of each source file, so a module is only parsed again
+once it changes.
+"""
+
+import ast
+import atexit
+import importlib.util
+import json
+import os
+import threading
+
+
+# bump when the parsing changes, so that cached entries are parsed again
+_CACHE_VERSION = 2
+
+
+def _cache_path(datapath=None):
+    if datapath is None:
+        parlai_home = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.realpath(__file__))))
+        datapath = os.path.join(parlai_home, 'data')
+    return os.path.join(datapath, 'registry.json')
+
+
+_SCOPES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda,
+           ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
+
+
+def _module_scope(node):
+    """Yield the nodes below node which run in its scope, i.e. without
+    entering nested functions, classes, lambdas or comprehensions.
+    """
+    for child in ast.iter_child_nodes(node):
+        yield child
+        if not isinstance(child, _SCOPES):
+            yield from _module_scope(child)
+
+
+def _top_level_names(source):
+    """Return the names bound at the top level of the module source, and
+    whether they can't be told from it.
+
+    Any binding in the module scope counts (assignments, imports, ``for`` and
+    ``with`` targets...), whichever branch runs, as well as names declared
+    ``global`` anywhere. ``from x import *`` and writes to ``globals()`` make
+    the names unknown.
+    """
+    tree = ast.parse(source)
+    names = set()
+    unknown = False
+    for node in _module_scope(tree):
+        if isinstance(node, (ast.ClassDef, ast.FunctionDef,
+                             ast.AsyncFunctionDef)):
+            names.add(node.name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                if alias.name == '*':
+                    unknown = True
+                else:
+                    names.add(alias.asname or alias.name.split('.')[0])
+        elif isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+            names.add(node.id)
+        elif isinstance(node, ast.ExceptHandler):
+            if node.name:
+                names.add(node.name)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Global):
+            names.update(node.names)
+        elif (isinstance(node, ast.Call) and
+                isinstance(node.func, ast.Name) and
+                node.func.id in ('globals', 'exec')):
+            unknown = True
+    return names, unknown
+
+
+class ModuleRegistry(object):
+    """Top-level names of modules, parsed from source and cached on disk."""
+
+    def __init__(self, cache_path=None):
+        self.cache_path = cache_path or _cache_path()
+        self.entries = None
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def _load(self):
+        self.entries = {}
+        try:
+            with open(self.cache_path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def save(self):
+        """Write the cache to disk if it changed. Failures are ignored."""
+        with self.lock:
+            if not self.dirty:
+                return
+            tmp_path = '{}.tmp{}'.format(self.cache_path, os.getpid())
+            try:
+                os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+                with open(tmp_path, 'w') as f:
+                    json.dump(self.entries, f)
+                os.replace(tmp_path, self.cache_path)
+                self.dirty = False
+            except OSError:
+                pass
+
+    def _entry(self, path):
+        stat = os.stat(path)
+        key = [_CACHE_VERSION, stat.st_mtime_ns, stat.st_size]
+        if self.entries is None:
+            self._load()
+        entry = self.entries.get(path)
+        if entry is None or entry['key'] != key:
+            with open(path, 'rb') as f:
+                names, unknown = _top_level_names(f.read())
+            entry = {'key': key, 'names': sorted(names), 'unknown': unknown}
+            self.entries[path] = entry
+            self.dirty = True
+        return entry
+
+    def defines(self, module_name, name):
+        """Return whether the module binds name at its top level.
+
+        Returns False if the module does not exist, and None if it can't be
+        told from the source, e.g. because the module uses ``import *``.
+        """
+        try:
+            spec = importlib.util.find_spec(module_name)
+        except (ImportError, AttributeError, ValueError):
+            # the parent package does not exist
+            return False
+        if spec is None:
+            return False
+        path = spec.origin
+        if not path or not path.endswith('.py') or not os.path.isfile(path):
+            return None
+        with self.lock:
+            try:
+                entry = self._entry(path)
+            except (OSError, SyntaxError, ValueError):
+                return None
+        if name in entry['names']:
+            return True
+        return None if entry['unknown'] else False
+
+
+_registries = {}
+
+
+def get_registry(datapath=None):
+    """Return the registry of this process caching in datapath (by default
+    ``{parlai_dir}/data``), saving it at exit.
+    """
+    cache_path = _cache_path(datapath)
+    registry = _registries.get(cache_path)
+    if registry is None:
+        registry = ModuleRegistry(cache_path)
+        _registries[cache_path] = registry
+        atexit.register(registry.save)
+    return registry
+
+
+def module_defines(module_name, name, datapath=None):
+    """Return whether the module binds name at its top level, or None if it
+    can't be told without importing it. See ``ModuleRegistry.defines``.
+    """
+    return get_registry(datapath).defines(module_name, name)
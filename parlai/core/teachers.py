@@ -28,26 +28,33 @@
      See the class description for more details.
 
 This module also includes ``DataLoader``, a threadpool data loader for
-``FixedDialogTeacher``, and ``DialogData``/``StreamDialogData``, data
-structures for accessing textual dialog data and utilized by ``DialogTeacher``
+``FixedDialogTeacher``, and ``DialogData``/``CompactDialogData``/
+``StreamDialogData``, data structures for accessing textual dialog data and
+utilized by ``DialogTeacher``
 """
 
 from .agents import Teacher, create_task_agent_from_taskname
 from .image_featurizers import ImageLoader
 from .utils import AttrDict, flatten, sort_data, make_batches, no_lock, str_to_msg
 
+from array import array
 from functools import lru_cache
 
 import concurrent.futures
+import hashlib
+import json
 import multiprocessing
 from multiprocessing import Value, Lock
 from threading import Thread
 import queue
 import random
+import shutil
 import sys
 import time
 import os
 
+import numpy as np
+
 
 class DataLoader(Thread):
     """A worker thread that provides a threadpool for data loading.
@@ -452,7 +459,12 @@ class DialogTeacher(FixedDialogTeacher):
 
         if not self.use_batch_act:
             # first initialize any shared objects
-            data_class = StreamDialogData if self.stream else DialogData
+            if self.stream:
+                data_class = StreamDialogData
+            elif opt.get('dialog_data') == 'compact':
+                data_class = CompactDialogData
+            else:
+                data_class = DialogData
             kwargs = {'cycle': self.training} if self.stream else {}
             if shared and shared.get('data'):
                 self.data = data_class(opt, shared=shared['data'], **kwargs)
@@ -723,6 +735,235 @@ class DialogData(object):
         return table
 
 
+class CompactDialogData(DialogData):
+    """Provides the same data as ``DialogData``, stored in flat arrays instead
+    of tuples of python objects, which uses much less memory for large tasks.
+
+    Every distinct string is stored once, utf-8 encoded in a single pool, and
+    referred to by its index in the pool. Labels and label candidates are
+    lists of string indices delimited by an offset array, and each episode is
+    a range of entries. Entries are only decoded when requested by ``get``.
+
+    If ``opt['dialog_data_cache']`` is set, the arrays are saved next to the
+    datafile when it is first loaded, and are memory mapped from there until
+    the datafile changes. Processes loading the same task then share the
+    pages of the arrays. The cache is keyed by the task name and datafile,
+    so it should not be used by teachers whose data depends on other options.
+    """
+
+    ARRAYS = [
+        'pool', 'str_offsets', 'list_items', 'list_offsets',
+        'episode_offsets', 'text', 'labels', 'reward', 'reward_type',
+        'cands', 'image'
+    ]
+    # rewards are stored as strings, along with the type to convert them to
+    REWARD_TYPES = [str, int, float, bool]
+    # label candidates that are the same as in the previous entry
+    SAME_CANDS = -2
+
+    def __init__(self, opt, data_loader=None, cands=None, shared=None, **kwargs):
+        self.use_cache = opt.get('dialog_data_cache', False)
+        self.task = opt.get('task')
+        super().__init__(opt, data_loader, cands, shared, **kwargs)
+
+    def _cache_path(self, datafile):
+        if not self.use_cache:
+            return None
+        if not isinstance(datafile, str) or not os.path.isfile(datafile):
+            print('[ dialog data cache needs a datafile, not caching ]')
+            return None
+        key = hashlib.sha1(str(self.task).encode('utf-8')).hexdigest()[:10]
+        return '{}.{}.dialog'.format(datafile, key)
+
+    @staticmethod
+    def _source_key(datafile):
+        stat = os.stat(datafile)
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def _load(self, data_loader, datafile):
+        """Loads up data from an iterable over tuples described in the class
+        docs of ``DialogData``, or from the cache if it is up to date.
+        """
+        path = self._cache_path(datafile)
+        if path is not None and self._cache_valid(path, datafile):
+            self.data = self._load_cache(path)
+            return
+        self.data = self._build(data_loader(datafile))
+        if path is not None:
+            self._save_cache(path, datafile)
+            # map the saved arrays, so their memory can be shared
+            self.data = self._load_cache(path)
+
+    def _build(self, episodes):
+        """Convert episodes to the flat arrays."""
+        strings = {}
+        pool = bytearray()
+        str_offsets = array('q', [0])
+        lists = {}
+        # string and list ids fit in 32 bits, offsets may not
+        list_items = array('i')
+        list_offsets = array('q', [0])
+        columns = {
+            k: array('i') for k in ['text', 'labels', 'reward', 'cands', 'image']
+        }
+        reward_type = array('b')
+        episode_offsets = array('q', [0])
+
+        def string_id(s):
+            if s is None:
+                return -1
+            idx = strings.get(s)
+            if idx is None:
+                idx = strings[s] = len(strings)
+                pool.extend(s.encode('utf-8'))
+                str_offsets.append(len(pool))
+            return idx
+
+        def list_id(items):
+            if items is None:
+                return -1
+            key = tuple(string_id(s) for s in items)
+            idx = lists.get(key)
+            if idx is None:
+                idx = lists[key] = len(lists)
+                list_items.extend(key)
+                list_offsets.append(len(list_items))
+            return idx
+
+        for episode in self._read_episode(episodes):
+            for entry in episode:
+                text, labels, reward, cands, image = (
+                    entry + (None,) * (5 - len(entry)))
+                columns['text'].append(string_id(text))
+                columns['labels'].append(list_id(labels))
+                if reward is None:
+                    columns['reward'].append(-1)
+                    reward_type.append(0)
+                elif type(reward) in self.REWARD_TYPES:
+                    columns['reward'].append(string_id(str(reward)))
+                    reward_type.append(self.REWARD_TYPES.index(type(reward)))
+                else:
+                    raise TypeError(
+                        'Rewards of type {} can not be stored in compact '
+                        'dialog data.'.format(type(reward).__name__))
+                if isinstance(cands, str):
+                    # 'same as last time'
+                    columns['cands'].append(self.SAME_CANDS)
+                else:
+                    columns['cands'].append(list_id(cands))
+                columns['image'].append(string_id(image))
+            episode_offsets.append(len(columns['text']))
+
+        data = {
+            'pool': np.frombuffer(pool, dtype=np.uint8),
+            'str_offsets': np.frombuffer(str_offsets, dtype=np.int64),
+            'list_items': np.frombuffer(list_items, dtype=np.int32),
+            'list_offsets': np.frombuffer(list_offsets, dtype=np.int64),
+            'episode_offsets': np.frombuffer(episode_offsets, dtype=np.int64),
+            'reward_type': np.frombuffer(reward_type, dtype=np.int8),
+        }
+        for k, col in columns.items():
+            data[k] = np.frombuffer(col, dtype=np.int32)
+        return data
+
+    def _cache_valid(self, path, datafile):
+        try:
+            with open(os.path.join(path, 'meta.json')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return meta.get('source') == self._source_key(datafile)
+
+    def _load_cache(self, path):
+        return {
+            k: np.load(os.path.join(path, k + '.npy'), mmap_mode='r')
+            for k in self.ARRAYS
+        }
+
+    def _save_cache(self, path, datafile):
+        """Write the arrays to a temporary directory which is then renamed,
+        so that other processes never see a partial cache.
+        """
+        tmp_path = '{}.tmp{}'.format(path, os.getpid())
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for k in self.ARRAYS:
+            np.save(os.path.join(tmp_path, k + '.npy'), self.data[k])
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'source': self._source_key(datafile)}, f)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+
+    def _string(self, idx):
+        if idx < 0:
+            return None
+        start, end = self.data['str_offsets'][idx:idx + 2]
+        return self.data['pool'][start:end].tobytes().decode('utf-8')
+
+    def _list(self, idx):
+        if idx < 0:
+            return None
+        start, end = self.data['list_offsets'][idx:idx + 2]
+        items = self.data['list_items'][start:end]
+        return tuple(self._string(int(i)) for i in items)
+
+    def num_episodes(self):
+        """Return number of episodes in the dataset."""
+        return len(self.data['episode_offsets']) - 1
+
+    def num_examples(self):
+        """Returns total number of entries available."""
+        return len(self.data['text'])
+
+    def get(self, episode_idx, entry_idx=0):
+        """Get the specified episode and the specified entry in that episode.
+
+        :param episode_idx: which episode to return examples from
+        :param entry_idx: which example to return from the episode.
+                          Many datasets have only single-entry episodes,
+                          so this defaults to zero.
+        """
+        data = self.data
+        start = int(data['episode_offsets'][episode_idx])
+        end = int(data['episode_offsets'][episode_idx + 1])
+        if not 0 <= entry_idx < end - start:
+            raise IndexError('entry index out of range')
+        i = start + entry_idx
+
+        reward_id = int(data['reward'][i])
+        reward = self._string(reward_id)
+        if reward is not None:
+            reward_type = self.REWARD_TYPES[data['reward_type'][i]]
+            if reward_type is bool:
+                reward = reward == 'True'
+            else:
+                reward = reward_type(reward)
+        cands_id = int(data['cands'][i])
+        if cands_id == self.SAME_CANDS:
+            cands = sys.intern('same as last time')
+        else:
+            cands = self._list(cands_id)
+        entry = (
+            self._string(int(data['text'][i])),
+            self._list(int(data['labels'][i])),
+            reward,
+            cands,
+            self._string(int(data['image'][i])),
+        )
+
+        episode_done = i == end - 1
+        end_of_data = episode_done and episode_idx == self.num_episodes() - 1
+
+        # now pack it in a action-observation dictionary
+        table = self.build_table(entry)
+
+        # last entry in this episode
+        table['episode_done'] = episode_done
+        return table, end_of_data
+
+
 class StreamDialogData(DialogData):
     """Provides a data structure for streaming textual dialog data.
     This can be used whenever the dialog data follows the format described in
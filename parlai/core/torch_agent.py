@@ -21,6 +21,9 @@ See below for documentation on each specific tool.
 from parlai.core.agents import Agent
 from parlai.core.build_data import modelzoo_path
 from parlai.core.dict import DictionaryAgent
+from parlai.core.embedding_store import (
+    EmbeddingStore, load_store, copy_embeddings
+)
 from parlai.core.utils import set_namedtuple_defaults, argsort, padded_tensor, NEAR_INF
 
 try:
@@ -32,9 +35,12 @@ except ImportError:
 from torch import optim
 from collections import deque, namedtuple, Counter
 from operator import attrgetter
+import io
+import os
 import math
 import json
 import random
+import time
 
 """
 Batch is a namedtuple containing data being sent to an agent.
@@ -73,11 +79,13 @@ parent function to set up these fields as a base.
                        in the batch. these memories are generated by splitting
                        the input text on newlines, with the last line put in the
                        text field and the remaining put in this one.
+:field observations:   list of length bsz containing the valid observations,
+                       in the same order as the rows of the batch.
 """
 Batch = namedtuple('Batch', ['text_vec', 'text_lengths', 'label_vec',
                              'label_lengths', 'labels', 'valid_indices',
                              'candidates', 'candidate_vecs', 'image',
-                             'memory_vecs'])
+                             'memory_vecs', 'observations'])
 set_namedtuple_defaults(Batch, default=None)
 
 
@@ -192,6 +200,19 @@ class TorchAgent(Agent):
                  'input instead of at the beginning of the input. this is '
                  'useful for tasks that include some kind of context before '
                  'the actual utterance (e.g. squad, babi, personachat).')
+        # inference arguments
+        agent.add_argument(
+            '--quantize', type='bool', default=False,
+            help='Apply dynamic int8 quantization to the Linear, LSTM, GRU '
+                 'and Embedding layers of the model before evaluating the '
+                 'first batch. The outputs on that batch are checked against '
+                 'the fp32 model. Only used for CPU inference, and ignored '
+                 'if the agent is trained.')
+        agent.add_argument(
+            '--quantize-tolerance', type=float, default=0.1, hidden=True,
+            help='Maximum relative difference allowed between the outputs of '
+                 'the fp32 and quantized models on the calibration batch. If '
+                 'exceeded, the fp32 model is kept.')
         # GPU arguments
         # these gpu options are all mutually exclusive, and should error if the
         # user tries to present multiple of them
@@ -269,6 +290,20 @@ class TorchAgent(Agent):
         self.rank_candidates = opt['rank_candidates']
         self.add_person_tokens = opt.get('person_tokens', False)
 
+        if shared and 'quantize_state' in shared:
+            self.quantize_state = shared['quantize_state']
+        else:
+            self.quantize_state = {'pending': False}
+            if opt.get('quantize'):
+                if self.use_cuda:
+                    print('| WARNING: --quantize is only supported on CPU, '
+                          'ignoring it. Use --no-cuda to quantize.')
+                elif not hasattr(torch, 'quantization'):
+                    print('| WARNING: --quantize requires a version of PyTorch '
+                          'with torch.quantization, ignoring it.')
+                else:
+                    self.quantize_state['pending'] = True
+
     def init_optim(self, params, optim_states=None, saved_optim_type=None):
         """Initialize optimizer with model parameters.
 
@@ -327,44 +362,54 @@ class TorchAgent(Agent):
         if 'loss' in metrics_dict:
             self.scheduler.step(metrics_dict['loss'])
 
-    def _get_embtype(self, emb_type):
-        # set up preinitialized embeddings
-        try:
-            import torchtext.vocab as vocab
-        except ImportError as ex:
-            print('Please install torch text with `pip install torchtext`')
-            raise ex
-        pretrained_dim = 300
+    def _get_embpath(self, emb_type):
+        """Return the name and the cache directory of the pretrained
+        embeddings of emb_type.
+        """
         if emb_type.startswith('glove'):
-            if 'twitter' in emb_type:
-                init = 'glove-twitter'
-                name = 'twitter.27B'
-                pretrained_dim = 200
-            else:
-                init = 'glove'
-                name = '840B'
-            embs = vocab.GloVe(
-                name=name, dim=pretrained_dim,
-                cache=modelzoo_path(self.opt.get('datapath'),
-                                    'models:glove_vectors'))
+            init = 'glove-twitter' if 'twitter' in emb_type else 'glove'
+            cache = 'models:glove_vectors'
         elif emb_type.startswith('fasttext_cc'):
             init = 'fasttext_cc'
-            embs = vocab.FastText(
-                language='en',
-                cache=modelzoo_path(self.opt.get('datapath'),
-                                    'models:fasttext_cc_vectors'))
+            cache = 'models:fasttext_cc_vectors'
         elif emb_type.startswith('fasttext'):
             init = 'fasttext'
-            embs = vocab.FastText(
-                language='en',
-                cache=modelzoo_path(self.opt.get('datapath'),
-                                    'models:fasttext_vectors'))
+            cache = 'models:fasttext_vectors'
         else:
             raise RuntimeError('embedding type {} not implemented. check arg, '
                                'submit PR to this function, or override it.'
                                ''.format(emb_type))
+        return init, modelzoo_path(self.opt.get('datapath'), cache)
+
+    def _get_embtype(self, emb_type):
+        # set up preinitialized embeddings
+        try:
+            import torchtext.vocab as vocab
+        except ImportError as ex:
+            print('Please install torch text with `pip install torchtext`')
+            raise ex
+        init, cache = self._get_embpath(emb_type)
+        if init == 'glove-twitter':
+            embs = vocab.GloVe(name='twitter.27B', dim=200, cache=cache)
+        elif init == 'glove':
+            embs = vocab.GloVe(name='840B', dim=300, cache=cache)
+        else:
+            embs = vocab.FastText(language='en', cache=cache)
         return embs, init
 
+    def _get_embstore(self, emb_type):
+        """Return the memory-mapped store of the pretrained embeddings.
+
+        The store is converted from the torchtext vectors the first time.
+        """
+        init, cache = self._get_embpath(emb_type)
+        path = os.path.join(cache, init + '.emb')
+        if not EmbeddingStore.exists(path):
+            embs, _ = self._get_embtype(emb_type)
+            print('[ Converting {} embeddings to {} ]'.format(init, path))
+            EmbeddingStore.build(path, zip(embs.itos, embs.vectors.numpy()))
+        return load_store(path), init
+
     def _project_vec(self, vec, target_dim, method='random'):
         """If needed, project vector to target dimensionality.
 
@@ -402,14 +447,8 @@ class TorchAgent(Agent):
         :param weight:   weights of lookup table (nn.Embedding/nn.EmbeddingBag)
         :param emb_type: pretrained embedding type
         """
-        embs, name = self._get_embtype(emb_type)
-        cnt = 0
-        for w, i in self.dict.tok2ind.items():
-            if w in embs.stoi:
-                vec = self._project_vec(embs.vectors[embs.stoi[w]],
-                                        weight.size(1))
-                weight.data[i] = vec
-                cnt += 1
+        store, name = self._get_embstore(emb_type)
+        cnt = copy_embeddings(weight, self.dict, store, self._project_vec)
 
         if log:
             print('Initialized embeddings for {} tokens ({}%) from {}.'
@@ -424,6 +463,7 @@ class TorchAgent(Agent):
         shared['opt'] = self.opt
         shared['dict'] = self.dict
         shared['replies'] = self.replies
+        shared['quantize_state'] = self.quantize_state
         return shared
 
     def _v2t(self, vec):
@@ -649,8 +689,8 @@ class TorchAgent(Agent):
 
             ys, y_lens = padded_tensor(label_vecs, self.NULL_IDX, self.use_cuda)
             if sort and xs is None:
-                ys, valid_inds, label_vecs, labels, y_lens = argsort(
-                    y_lens, ys, valid_inds, label_vecs, labels, y_lens,
+                ys, valid_inds, label_vecs, labels, y_lens, exs = argsort(
+                    y_lens, ys, valid_inds, label_vecs, labels, y_lens, exs,
                     descending=True
                 )
 
@@ -673,7 +713,8 @@ class TorchAgent(Agent):
         return Batch(text_vec=xs, text_lengths=x_lens, label_vec=ys,
                      label_lengths=y_lens, labels=labels,
                      valid_indices=valid_inds, candidates=cands,
-                     candidate_vecs=cand_vecs, image=imgs, memory_vecs=mems)
+                     candidate_vecs=cand_vecs, image=imgs, memory_vecs=mems,
+                     observations=exs)
 
     def match_batch(self, batch_reply, valid_inds, output=None):
         """Match sub-batch of predictions to the original batch indices.
@@ -911,7 +952,11 @@ class TorchAgent(Agent):
         batch = self.batchify(observations)
 
         if is_training:
+            # never quantize a model which is being trained
+            self.quantize_state['pending'] = False
             output = self.train_step(batch)
+        elif self.quantize_state['pending']:
+            output = self._quantize_on_batch(batch)
         else:
             output = self.eval_step(batch)
 
@@ -925,6 +970,148 @@ class TorchAgent(Agent):
 
         return batch_reply
 
+    def _quantize_on_batch(self, batch):
+        """Evaluate a batch, then quantize the model using it for calibration.
+
+        Every call ``eval_step`` makes to ``self.model`` or directly to one of
+        its submodules (e.g. the encoder and decoder during beam search) is
+        recorded, and the recorded calls are replayed on the fp32 and
+        quantized models to compare their outputs, speed and size.
+        """
+        self.quantize_state['pending'] = False
+        calls = []
+        depth = [0]
+
+        def recording(name, forward):
+            def recording_forward(*args, **kwargs):
+                # calls to submodules made by the model itself are replayed
+                # as part of the call to the model
+                if depth[0] == 0:
+                    calls.append((name, args, kwargs))
+                depth[0] += 1
+                try:
+                    return forward(*args, **kwargs)
+                finally:
+                    depth[0] -= 1
+            return recording_forward
+
+        modules = [('', self.model)] + list(self.model.named_children())
+        for name, module in modules:
+            module.forward = recording(name, module.forward)
+        try:
+            output = self.eval_step(batch)
+        finally:
+            for _name, module in modules:
+                del module.forward
+
+        self.quantize_model(calls)
+        return output
+
+    def _quantize_spec(self):
+        """Return the dynamic quantization config to use for each layer type."""
+        quant = torch.quantization
+        spec = {
+            torch.nn.Linear: quant.default_dynamic_qconfig,
+            torch.nn.LSTM: quant.default_dynamic_qconfig,
+            torch.nn.GRU: quant.default_dynamic_qconfig,
+        }
+        if hasattr(quant, 'float_qparams_weight_only_qconfig'):
+            # embeddings only support weight-only quantization
+            spec[torch.nn.Embedding] = quant.float_qparams_weight_only_qconfig
+        return spec
+
+    def _model_size(self):
+        """Return the size of the serialized model parameters in bytes."""
+        buf = io.BytesIO()
+        torch.save(self.model.state_dict(), buf)
+        return buf.tell()
+
+    def _replay(self, calls):
+        """Run the recorded model calls, returning (outputs, seconds taken)."""
+        start = time.time()
+        with torch.no_grad():
+            outputs = []
+            for name, args, kwargs in calls:
+                # look up submodules by name, since quantization may swap them
+                module = getattr(self.model, name) if name else self.model
+                outputs.append(module(*args, **kwargs))
+        return outputs, time.time() - start
+
+    def quantize_model(self, calls):
+        """Apply dynamic int8 quantization to ``self.model`` in place.
+
+        The quantized layers are swapped in place, so copies of this agent
+        sharing the model see them too. If the quantized model fails on the
+        calibration calls or its outputs differ by more than
+        --quantize-tolerance, the original layers are restored.
+
+        :param calls: list of (name, args, kwargs) calls used as the
+            calibration sample, where name is the attribute name of a
+            submodule of ``self.model``, or '' for the model itself.
+
+        :return: True if the model was quantized.
+        """
+        spec = self._quantize_spec()
+        if isinstance(self.model, tuple(spec.keys())):
+            print('| WARNING: cannot quantize a model which is a single layer.')
+            return False
+
+        # remember every layer which may be swapped, so we can restore them
+        originals = []
+        for parent in self.model.modules():
+            for name, child in parent.named_children():
+                if isinstance(child, tuple(spec.keys())):
+                    originals.append((parent, name, child))
+
+        fp32_out, fp32_time = self._replay(calls)
+        fp32_out = _float_tensors(fp32_out)
+        fp32_size = self._model_size()
+        if not fp32_out:
+            print('| WARNING: the calibration batch produced no model outputs '
+                  'to compare, keeping the fp32 model.')
+            return False
+
+        diff = float('inf')
+        try:
+            torch.quantization.quantize_dynamic(
+                self.model, spec, dtype=torch.qint8, inplace=True
+            )
+            q_out, q_time = self._replay(calls)
+            q_out = _float_tensors(q_out)
+            if len(q_out) == len(fp32_out):
+                diff = max(_relative_diff(a, b) for a, b in zip(fp32_out, q_out))
+            else:
+                print('| WARNING: quantized model returned {} outputs instead '
+                      'of {}.'.format(len(q_out), len(fp32_out)))
+        except (RuntimeError, AttributeError, TypeError) as e:
+            print('| WARNING: quantized model failed on the calibration '
+                  'batch: {}'.format(e))
+
+        tolerance = self.opt.get('quantize_tolerance', 0.1)
+        if diff > tolerance:
+            for parent, name, child in originals:
+                setattr(parent, name, child)
+            if diff != float('inf'):
+                print('| WARNING: quantized model outputs differ from fp32 by '
+                      '{:.4g} (tolerance {}), keeping the fp32 model.'
+                      ''.format(diff, tolerance))
+            return False
+
+        num_swapped = sum(
+            getattr(parent, name) is not child
+            for parent, name, child in originals
+        )
+        if num_swapped == 0:
+            print('| WARNING: model has no layers supported by dynamic '
+                  'quantization, keeping the fp32 model.')
+            return False
+        print('[ Quantized {} layers: size {:.2f}MB -> {:.2f}MB, calibration '
+              'batch {:.1f}ms -> {:.1f}ms, max relative output difference '
+              '{:.4g} ]'.format(num_swapped, fp32_size / 2 ** 20,
+                                self._model_size() / 2 ** 20, fp32_time * 1000,
+                                q_time * 1000, diff))
+        return True
+
     def train_step(self, batch):
         """Process one batch with training labels."""
         raise NotImplementedError(
@@ -936,6 +1123,35 @@ class TorchAgent(Agent):
             'Abstract class: user must implement eval_step')
 
 
+def _float_tensors(out):
+    """Return a flat list of the floating point tensors found in out."""
+    if torch.is_tensor(out):
+        return [out] if out.is_floating_point() else []
+    if isinstance(out, dict):
+        out = list(out.values())
+    if isinstance(out, (list, tuple)):
+        return [t for o in out for t in _float_tensors(o)]
+    return []
+
+
+def _relative_diff(ref, other):
+    """Return the max absolute difference of two tensors, relative to ref.
+
+    Only the overlapping region is compared, since e.g. greedy decoding may
+    stop at different lengths. Tensors with a different number of dimensions
+    can't be compared, so their difference is infinite.
+    """
+    if ref.dim() != other.dim():
+        return float('inf')
+    for dim in range(ref.dim()):
+        size = min(ref.size(dim), other.size(dim))
+        ref, other = ref.narrow(dim, 0, size), other.narrow(dim, 0, size)
+    if ref.numel() == 0:
+        return 0.0
+    scale = ref.abs().max().item() + 1e-9
+    return (ref.float() - other.float()).abs().max().item() / scale
+
+
 class Beam(object):
     """Generic beam class. It keeps information about beam_size hypothesis."""
 
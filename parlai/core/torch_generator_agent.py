@@ -24,7 +24,7 @@ Contains the following utilities:
 import os
 import math
 import tempfile
-from collections import defaultdict, Counter, namedtuple
+from collections import defaultdict, Counter, namedtuple, OrderedDict
 from operator import attrgetter
 
 import torch
@@ -92,6 +92,58 @@ class TorchGeneratorModel(nn.Module):
         logits = torch.cat(logits, 1)
         return logits, xs
 
+    def decode_sample(self, encoder_states, bsz, maxlen, topk=0, topp=0.0,
+                      temperature=1.0):
+        """Stochastic decoding, sampling one token per step for every row.
+
+        Each row stops once it samples an end token; the remaining steps of
+        that row are filled with padding. Decoding ends early once every row
+        has finished.
+
+        :param encoder_states: Output of the encoder model.
+        :type encoder_states: model specific
+        :param int bsz: Batch size.
+        :param int maxlen: Maximum decoding length
+        :param int topk: if > 0, only sample from the k most likely tokens
+        :param float topp: if > 0, only sample from the smallest set of tokens
+            whose cumulative probability exceeds topp (nucleus sampling)
+        :param float temperature: softmax temperature applied to the scores
+
+        :return: pair (logits, choices) of the sampled decode
+        :rtype: (FloatTensor[bsz, maxlen, vocab], LongTensor[bsz, maxlen])
+        """
+        xs = self._starts(bsz)
+        incr_state = None
+        logits = []
+        finished = xs.new_zeros(bsz, 1)
+        for i in range(maxlen):
+            scores, incr_state = self.decoder(xs, encoder_states, incr_state)
+            scores = self.output(scores[:, -1:, :])
+            logits.append(scores)
+            probs = F.softmax(scores.squeeze(1).float() / temperature, dim=-1)
+            inds = None
+            if topk > 0:
+                # topk returns sorted values, so nucleus filtering still works
+                probs, inds = probs.topk(min(topk, probs.size(-1)), dim=-1)
+            elif topp > 0:
+                probs, inds = probs.sort(dim=-1, descending=True)
+            if topp > 0:
+                # keep a token if the mass before it is below topp, which
+                # always keeps the most likely one
+                mass_before = probs.cumsum(dim=-1) - probs
+                probs = probs * (mass_before < topp).float()
+            preds = torch.multinomial(probs, 1)
+            if inds is not None:
+                preds = inds.gather(-1, preds)
+            # rows which already finished only produce padding
+            preds = preds * (1 - finished) + self.NULL_IDX * finished
+            finished = (finished + (preds == self.END_IDX).long()).clamp(max=1)
+            xs = torch.cat([xs, preds], dim=1)
+            if finished.sum().item() == bsz:
+                break
+        logits = torch.cat(logits, 1)
+        return logits, xs
+
     def decode_forced(self, encoder_states, ys):
         """Decode with a fixed, true sequence, computing loss. Useful for
         training, or ranking fixed candidates.
@@ -154,6 +206,26 @@ class TorchGeneratorModel(nn.Module):
             "reorder_encoder_states must be implemented by the model"
         )
 
+    def extend_encoder_states(self, encoder_states, xs):
+        """Continue encoding from the encoder states of a prefix of the input.
+
+        Used by TorchGeneratorAgent to cache encoder states across turns of a
+        conversation, so that only the newest tokens of the dialog history need
+        to be encoded. Implementing this method is optional: the default
+        returns None, which falls back to encoding the full input.
+
+        :param encoder_states: output of model.encoder for a single example
+        :type encoder_states: model specific
+        :param xs: the tokens following those already encoded
+        :type xs: LongTensor[1, seqlen]
+
+        :return: encoder states for the concatenation of the previous input
+            and xs, the same as calling model.encoder on it, or None if the
+            model does not support extending encoder states.
+        :rtype: model specific
+        """
+        return None
+
     def reorder_decoder_incremental_state(self, incremental_state, inds):
         """Reorder incremental state for the decoder.
 
@@ -250,9 +322,34 @@ class TorchGeneratorAgent(TorchAgent):
                                 'the beam search')
         agent.add_argument('--beam-block-ngram', type=int, default=0, hidden=True,
                            help='Block all repeating ngrams up to history length n-1')
+        agent.add_argument('--inference', default='beam',
+                           choices=['beam', 'sample'],
+                           help='Generation algorithm. "beam" uses beam search '
+                                '(greedy if --beam-size is 1), "sample" draws '
+                                'each token from the model distribution, '
+                                'optionally restricted by --topk or --topp.')
+        agent.add_argument('--topk', type=int, default=0,
+                           help='When sampling, only sample from the K most '
+                                'likely tokens. 0 samples from all tokens.')
+        agent.add_argument('--topp', type=float, default=0.0,
+                           help='When sampling, only sample from the smallest '
+                                'set of tokens whose probability sums to P '
+                                '(nucleus sampling). 0 disables it.')
+        agent.add_argument('--temperature', type=float, default=1.0,
+                           help='Temperature to apply to the scores when '
+                                'sampling.')
         agent.add_argument('--skip-generation', type='bool', default=False, hidden=True,
                            help='Skip beam search. Useful for speeding up training, '
                                 'if perplexity is the validation metric.')
+        agent.add_argument('--encoder-cache-size', type=int, default=0, hidden=True,
+                           help='Keep encoder states for up to this many '
+                                'conversations, so each new turn only encodes '
+                                'the newest part of the dialog history. Used '
+                                'when evaluating one example at a time (e.g. '
+                                'interactive mode) with models which support '
+                                'it. Observations may set "conversation_id" to '
+                                'share one cache across conversations. '
+                                '0 disables the cache.')
 
         super(TorchGeneratorAgent, cls).add_cmdline_args(argparser)
         return agent
@@ -281,14 +378,22 @@ class TorchGeneratorAgent(TorchAgent):
         self.beam_min_length = opt.get('beam_min_length', 3)
         self.beam_block_ngram = opt.get('beam_block_ngram', 0)
         self.skip_generation = opt.get('skip_generation', False)
+        self.inference = opt.get('inference', 'beam')
+        self.topk = opt.get('topk', 0)
+        self.topp = opt.get('topp', 0.0)
+        self.temperature = opt.get('temperature', 1.0)
+        self.encoder_cache_size = opt.get('encoder_cache_size', 0)
 
         if shared:
             # set up shared properties
             self.model = shared['model']
             self.criterion = shared['criterion']
             self.metrics = shared['metrics']
+            self.encoder_cache = shared.get('encoder_cache', OrderedDict())
             states = shared.get('states', {})
         else:
+            # conversation id => (input vector, encoder states)
+            self.encoder_cache = OrderedDict()
             self.metrics = {
                 'loss': 0.0,
                 'num_tokens': 0,
@@ -410,6 +515,7 @@ class TorchGeneratorAgent(TorchAgent):
                 'optimizer_type': self.opt['optimizer'],
             }
         shared['metrics'] = self.metrics  # do after numthreads check
+        shared['encoder_cache'] = self.encoder_cache
         if self.beam_dot_log is True:
             shared['beam_dot_dir'] = self.beam_dot_dir
         return shared
@@ -437,6 +543,20 @@ class TorchGeneratorAgent(TorchAgent):
             m[k] = round_sigfigs(v, 4)
         return m
 
+    def compute_loss(self, batch):
+        """Compute the training loss of a batch.
+
+        Override this to train with a different objective.
+
+        :return: (loss, preds) pair, where loss is summed over all non-null
+            target tokens and preds is a LongTensor[bsz, labellen] with the
+            model's prediction for each target token.
+        """
+        scores, preds, _ = self.model(batch.text_vec, batch.label_vec)
+        score_view = scores.view(-1, scores.size(-1))
+        loss = self.criterion(score_view, batch.label_vec.view(-1))
+        return loss, preds
+
     def train_step(self, batch):
         """Train on a single batch of examples."""
         batchsize = batch.text_vec.size(0)
@@ -445,11 +565,12 @@ class TorchGeneratorAgent(TorchAgent):
                                self.truncate or 180)
         self.model.train()
         self.zero_grad()
+        if self.encoder_cache:
+            # cached encoder states are stale once the parameters change
+            self.encoder_cache.clear()
 
         try:
-            scores, preds, _ = self.model(batch.text_vec, batch.label_vec)
-            score_view = scores.view(-1, scores.size(-1))
-            loss = self.criterion(score_view, batch.label_vec.view(-1))
+            loss, preds = self.compute_loss(batch)
             # save loss to metrics
             notnull = batch.label_vec.ne(self.NULL_IDX)
             target_tokens = notnull.long().sum().item()
@@ -487,6 +608,62 @@ class TorchGeneratorAgent(TorchAgent):
                 os.path.join(self.beam_dot_dir, "{}.png".format(image_name))
             )
 
+    def _cached_encode(self, xs, key, episode_done=False):
+        """Encode xs, reusing the cached encoder states of this conversation.
+
+        If the input of the previous turn with the same key is a prefix of xs
+        (as it is when the dialog history grows by one turn), only the new
+        tokens are encoded. Entries are evicted least recently used first, and
+        dropped when their conversation ends.
+
+        :param xs: input to the encoder for a single example
+        :type xs: LongTensor[1, seqlen]
+        :param key: conversation id used to look up the cache
+        :param bool episode_done: whether the conversation ends after this turn
+
+        :return: the encoder states for xs
+        """
+        encoder_states = None
+        entry = self.encoder_cache.pop(key, None)
+        if entry is not None:
+            prev_xs, prev_states = entry
+            prev_len = prev_xs.size(1)
+            if (prev_len <= xs.size(1) and
+                    torch.equal(xs[:, :prev_len], prev_xs)):
+                if prev_len == xs.size(1):
+                    encoder_states = prev_states
+                else:
+                    with torch.no_grad():
+                        encoder_states = self.model.extend_encoder_states(
+                            prev_states, xs[:, prev_len:]
+                        )
+        if encoder_states is None:
+            with torch.no_grad():
+                encoder_states = self.model.encoder(xs)
+
+        if not episode_done:
+            self.encoder_cache[key] = (xs, encoder_states)
+            while len(self.encoder_cache) > self.encoder_cache_size:
+                # evict the least recently used conversation
+                self.encoder_cache.popitem(last=False)
+        return encoder_states
+
+    def _batch_encoder_states(self, batch):
+        """Return cached encoder states for the batch, if the cache applies.
+
+        The cache is only used for batches with a single example. Returns None
+        otherwise, in which case the model encodes the input itself.
+        """
+        if (self.encoder_cache_size <= 0 or batch.text_vec.size(0) != 1 or
+                batch.observations is None):
+            return None
+        obs = batch.observations[0]
+        return self._cached_encode(
+            batch.text_vec,
+            obs.get('conversation_id', id(self)),
+            obs.get('episode_done', True),
+        )
+
     def eval_step(self, batch):
         """Evaluate a single batch of examples."""
         if batch.text_vec is None:
@@ -494,16 +671,30 @@ class TorchGeneratorAgent(TorchAgent):
         bsz = batch.text_vec.size(0)
         self.model.eval()
         cand_scores = None
+        encoder_states = self._batch_encoder_states(batch)
 
         if self.skip_generation:
             warn_once(
                 "--skip-generation does not produce accurate metrics beyond ppl",
                 RuntimeWarning
             )
-            logits, preds, _ = self.model(batch.text_vec, batch.label_vec)
+            logits, preds, _ = self.model(
+                batch.text_vec, batch.label_vec, prev_enc=encoder_states
+            )
+        elif self.inference == 'sample':
+            if encoder_states is None:
+                encoder_states = self.model.encoder(batch.text_vec)
+            logits, preds = self.model.decode_sample(
+                encoder_states,
+                bsz,
+                self.model.longest_label,
+                topk=self.topk,
+                topp=self.topp,
+                temperature=self.temperature,
+            )
         elif self.beam_size == 1:
             # greedy decode
-            logits, preds, _ = self.model(batch.text_vec)
+            logits, preds, _ = self.model(batch.text_vec, prev_enc=encoder_states)
         elif self.beam_size > 1:
             out = self.beam_search(
                 self.model,
@@ -514,7 +705,8 @@ class TorchGeneratorAgent(TorchAgent):
                 pad=self.NULL_IDX,
                 min_length=self.beam_min_length,
                 min_n_best=self.beam_min_n_best,
-                block_ngram=self.beam_block_ngram
+                block_ngram=self.beam_block_ngram,
+                encoder_states=encoder_states,
             )
             beam_preds_scores, _, beams = out
             preds, scores = zip(*beam_preds_scores)
@@ -524,7 +716,9 @@ class TorchGeneratorAgent(TorchAgent):
 
         if batch.label_vec is not None:
             # calculate loss on targets with teacher forcing
-            f_scores, f_preds, _ = self.model(batch.text_vec, batch.label_vec)
+            f_scores, f_preds, _ = self.model(
+                batch.text_vec, batch.label_vec, prev_enc=encoder_states
+            )
             score_view = f_scores.view(-1, f_scores.size(-1))
             loss = self.criterion(score_view, batch.label_vec.view(-1))
             # save loss to metrics
@@ -540,7 +734,8 @@ class TorchGeneratorAgent(TorchAgent):
         if self.rank_candidates:
             # compute roughly ppl to rank candidates
             cand_choices = []
-            encoder_states = self.model.encoder(batch.text_vec)
+            if encoder_states is None:
+                encoder_states = self.model.encoder(batch.text_vec)
             for i in range(bsz):
                 num_cands = len(batch.candidate_vecs[i])
                 enc = self.model.reorder_encoder_states(encoder_states, [i] * num_cands)
@@ -563,8 +758,76 @@ class TorchGeneratorAgent(TorchAgent):
         text = [self._v2t(p) for p in preds]
         return Output(text, cand_choices)
 
+    def _ppl_dict_indices(self, dictionary):
+        """Map the evaluation dictionary onto this model's vocabulary.
+
+        Returns a LongTensor with the model index of every evaluation word
+        known to the model, and the number of evaluation words it doesn't know.
+        The result is cached, since the evaluation dictionary never changes.
+        """
+        if getattr(self, '_ppl_dict', None) is not dictionary:
+            inds = [self.dict.tok2ind[w] for w in dictionary.keys()
+                    if w in self.dict.tok2ind]
+            self._ppl_dict = dictionary
+            self._ppl_inds = torch.LongTensor(inds)
+            self._ppl_num_missing = len(dictionary) - len(inds)
+            if self.use_cuda:
+                self._ppl_inds = self._ppl_inds.cuda()
+        return self._ppl_inds, self._ppl_num_missing
+
+    def batch_next_word_probability(self, observations, label_tokens, dictionary):
+        """Return probabilities of every true word, for a batch of examples.
+
+        Unlike `next_word_probability`, this runs a single teacher-forced pass
+        over each label, so scoring a batch costs one forward of the model.
+        The true words are fed to the model one-to-one with their index in the
+        model's dictionary (unknown words are fed as the unknown token).
+        Probabilities are normalized over the evaluation dictionary, using a
+        probability of 1e-7 for words unknown to the model, matching the
+        behavior of `PerplexityEvaluatorAgent.next_word_probability`.
+
+        :param observations: list of observations processed by observe
+        :param label_tokens: list of lists of true words, one per observation
+        :param dictionary: evaluation dictionary to normalize over
+
+        :return: list with one list of probabilities per observation, or None
+            for observations which could not be vectorized.
+        """
+        batch = self.batchify(observations)
+        results = [None] * len(observations)
+        if batch.text_vec is None:
+            return results
+
+        tokens = [label_tokens[i] for i in batch.valid_indices]
+        ys, _ = padded_tensor(
+            [[self.dict[w] for w in toks] for toks in tokens],
+            self.NULL_IDX, self.use_cuda
+        )
+        ppl_inds, num_missing = self._ppl_dict_indices(dictionary)
+
+        self.model.eval()
+        with torch.no_grad():
+            scores, _, _ = self.model(batch.text_vec, ys)
+            probs = F.softmax(scores, dim=-1)
+            # bsz x seqlen mass assigned to words in the evaluation dictionary
+            total = probs.index_select(-1, ppl_inds).sum(-1) + 1e-7 * num_missing
+            true_probs = probs.gather(-1, ys.unsqueeze(-1)).squeeze(-1)
+            # words which the model doesn't know get the default probability
+            known, _ = padded_tensor(
+                [[int(w in self.dict.tok2ind) for w in toks] for toks in tokens],
+                0, self.use_cuda
+            )
+            known = known.float()
+            true_probs = true_probs * known + 1e-7 * (1 - known)
+            true_probs = (true_probs / total).cpu()
+
+        for row, i in enumerate(batch.valid_indices):
+            results[i] = true_probs[row, :len(tokens[row])].tolist()
+        return results
+
     def beam_search(self, model, batch, beam_size, start=1, end=2,
-                    pad=0, min_length=3, min_n_best=5, max_ts=40, block_ngram=0):
+                    pad=0, min_length=3, min_n_best=5, max_ts=40, block_ngram=0,
+                    encoder_states=None):
         """Beam search given the model and Batch
 
 
@@ -581,6 +844,8 @@ class TorchGeneratorAgent(TorchAgent):
         :param int min_n_best: minimum number of completed hypothesis generated
             from each beam
         :param int max_ts: the maximum length of the decoded sequence
+        :param encoder_states: optional output of model.encoder for
+            batch.text_vec, if it was already computed
 
         :return: tuple (beam_pred_scores, n_best_pred_scores, beams)
 
@@ -591,7 +856,8 @@ class TorchGeneratorAgent(TorchAgent):
             - beams :list of Beam instances defined in Beam class, can be used for any
               following postprocessing, e.g. dot logging.
         """
-        encoder_states = model.encoder(batch.text_vec)
+        if encoder_states is None:
+            encoder_states = model.encoder(batch.text_vec)
         dev = batch.text_vec.device
 
         bsz = len(batch.text_lengths)
@@ -717,12 +983,18 @@ class PerplexityEvaluatorAgent(TorchGeneratorAgent):
         self.last_xs = xs
 
         self.model.eval()
+        if self.prev_enc is None and self.encoder_cache_size > 0:
+            # new input: try to extend the encoding of the previous turn
+            self.prev_enc = self._cached_encode(
+                xs, obs.get('conversation_id', id(self)),
+                obs.get('episode_done', True)
+            )
         out = self.model(
             xs,
             ys=(ys if len(partial_out) > 0 else None),
             prev_enc=self.prev_enc,
             maxlen=1)
-        scores, self.prev_enc = out
+        scores, _, self.prev_enc = out
         # scores is bsz x seqlen x num_words, so select probs of current index
         probs = F.softmax(scores.select(1, -1), dim=1).squeeze()
         dist = _mydefaultdict(lambda: 1e-7)  # default probability for any token
@@ -8,18 +8,17 @@
 """File for miscellaneous utility functions and constants."""
 
 from collections import deque
+import importlib.util
 import math
 import os
 import random
+import sys
 import time
 import warnings
 
-# some of the utility methods are helpful for Torch
-try:
-    import torch
-    __TORCH_AVAILABLE = True
-except ImportError:
-    __TORCH_AVAILABLE = False
+# some of the utility methods are helpful for Torch. It is only imported by
+# the methods which use it, since importing it slows down every script.
+__TORCH_AVAILABLE = importlib.util.find_spec('torch') is not None
 
 
 """Near infinity, useful as a large penalty for scoring when inf is bad."""
@@ -961,6 +960,7 @@ def padded_tensor(items, pad_idx=0, use_cuda=False, left_padded=False,
         raise ImportError(
             "Cannot use padded_tensor without torch; go to http://pytorch.org"
         )
+    import torch
 
     # number of items
     n = len(items)
@@ -1007,6 +1007,8 @@ def padded_3d(tensors, pad_idx=0, use_cuda=0):
 
     :returns: 3D tensor with the maximum dimensions of the inputs
     """
+    import torch
+
     a = len(tensors)
     b = max(len(row) for row in tensors)
     c = max(len(item) for row in tensors for item in row)
@@ -1045,8 +1047,9 @@ def argsort(keys, *lists, descending=False):
         ind_sorted = list(reversed(ind_sorted))
     output = []
     for lst in lists:
-        # watch out in case we don't have torch installed
-        if __TORCH_AVAILABLE and isinstance(lst, torch.Tensor):
+        # watch out in case we don't have torch installed (or loaded)
+        torch = sys.modules.get('torch')
+        if torch is not None and isinstance(lst, torch.Tensor):
             output.append(lst[ind_sorted])
         else:
             output.append([lst[i] for i in ind_sorted])
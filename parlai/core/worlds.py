@@ -50,12 +50,10 @@ import time
 
 from functools import lru_cache
 
-try:
-    from torch.multiprocessing import Process, Value, Condition, Semaphore
-except ImportError:
-    from multiprocessing import Process, Value, Semaphore, Condition  # noqa: F401
+from multiprocessing import Process, Value, Semaphore, Condition  # noqa: F401
 from parlai.core.agents import _create_task_agents, create_agents_from_shared
 from parlai.core.metrics import aggregate_metrics, compute_time_metrics
+from parlai.core.registry import module_defines
 from parlai.core.utils import Timer, display_messages
 from parlai.tasks.tasks import ids_to_tasks
 
@@ -541,27 +539,48 @@ class MultiWorld(World):
         self.worlds[0].save_agents()
 
 
-def override_opts_in_shared(table, overrides):
-    """Looks recursively for ``opt`` dictionaries within shared dict and overrides
-    any key-value pairs with pairs from the overrides dict.
+class BatchSlotOpt(dict):
+    """Opt of a single batch slot, i.e. one of the copies of a world, teacher
+    or agent made by ``BatchWorld``.
+
+    It holds its own top-level keys, like the ``batchindex`` of the slot, but
+    shares all nested values with the opt it was copied from. Deep-copying it,
+    as worlds and agents do with the opt they are created with, only copies
+    the top level, so that creating a slot takes the same time no matter how
+    large the opt is.
+    """
+
+    def __deepcopy__(self, memo):
+        return BatchSlotOpt(self)
+
+
+def batch_slot_shared(shared, batchindex):
+    """Return a view of the shared dict of a world or agent for one batch slot.
+
+    The view shares everything with ``shared`` except for the opt dicts,
+    which are replaced by ``BatchSlotOpt`` copies with the given batchindex,
+    and the dicts containing them. ``batchindex`` is also set in the view and
+    in the shared dicts of its agents. ``shared`` itself is not modified, so
+    the same shared dict can be used to create every slot.
     """
-    if 'opt' in table:
-        # change values if an 'opt' dict is available
-        for k, v in overrides.items():
-            table['opt'][k] = v
-    for k, v in table.items():
+    slot = dict(shared)
+    if 'opt' in slot:
+        slot['opt'] = BatchSlotOpt(slot['opt'], batchindex=batchindex)
+    for k, v in slot.items():
         # look for sub-dictionaries which also might contain an 'opt' dict
-        if type(v) == dict and k != 'opt' and 'opt' in v:
-            override_opts_in_shared(v, overrides)
-        elif type(v) == list:
-            for item in v:
-                if type(item) == dict and 'opt' in item:
-                    # if this is a list of agent shared dicts, we want to iterate
-                    override_opts_in_shared(item, overrides)
-                else:
-                    # if this is e.g. list of candidate strings, stop right away
-                    break
-    return table
+        if isinstance(v, dict) and k != 'opt' and 'opt' in v:
+            slot[k] = batch_slot_shared(v, batchindex)
+        elif (isinstance(v, list) and v and isinstance(v[0], dict) and
+                'opt' in v[0]):
+            # a list of agent or world shared dicts, rather than e.g. a list
+            # of candidate strings
+            slot[k] = [
+                batch_slot_shared(item, batchindex)
+                if isinstance(item, dict) and 'opt' in item else item
+                for item in v
+            ]
+    slot['batchindex'] = batchindex
+    return slot
 
 
 class BatchWorld(World):
@@ -578,17 +597,16 @@ class BatchWorld(World):
         self.random = opt.get('datatype', None) == 'train'
         self.world = world
         self.worlds = []
+        shared = world.share()
+        slot_opt = BatchSlotOpt(opt)
         for i in range(opt['batchsize']):
             # make sure that any opt dicts in shared have batchindex set to i
             # this lets all shared agents know which batchindex they have,
             # which is needed for ordered data (esp valid/test sets)
-            shared = world.share()
-            shared['batchindex'] = i
-            for agent_shared in shared.get('agents', ''):
-                agent_shared['batchindex'] = i
-            # TODO: deprecate override_opts
-            override_opts_in_shared(shared, {'batchindex': i})
-            self.worlds.append(shared['world_class'](opt, None, shared))
+            slot_shared = batch_slot_shared(shared, i)
+            self.worlds.append(
+                shared['world_class'](slot_opt, None, slot_shared)
+            )
         self.batch_observations = [None] * len(self.world.get_agents())
         self.first_batch = None
 
@@ -809,6 +827,13 @@ class HogwildWorld(World):
         self.inner_world = world
         self.numthreads = opt['numthreads']
 
+        try:
+            # lets the processes share tensors; only loaded here since
+            # importing torch slows down every script using worlds
+            import torch.multiprocessing  # noqa: F401
+        except ImportError:
+            pass
+
         self.sync = {  # syncronization primitives
             # semaphores for counting queued examples
             'queued_sem': Semaphore(0),  # counts num exs to be processed
@@ -955,6 +980,10 @@ def _get_task_world(opt, user_agents, default_world=None):
             world_name = "DefaultWorld"
         module_name = "parlai.tasks.%s.worlds" % (task)
         try:
+            if module_defines(module_name, world_name,
+                              opt.get('datapath')) is False:
+                # skip importing a worlds module without this world
+                raise AttributeError(world_name)
             my_module = importlib.import_module(module_name)
             world_class = getattr(my_module, world_name)
         except Exception:
@@ -33,13 +33,36 @@ def next_word_probability(self, partial_out):
     (previous observation: {'text': 'Run test program.'})
     [] => {'hello': 1.0}
     ['hello'] => {'world': 1.0}
+
+Agents may instead implement the following batched function. If present, it is
+used in place of `next_word_probability`, every token of a label is scored in a
+single call, and the evaluation can be run with --batchsize > 1:
+
+def batch_next_word_probability(self, observations, label_tokens, dictionary):
+    Return probabilities of each true word given all previous true words.
+
+    Arguments:
+    observations -- list of observations already passed to `observe`
+    label_tokens -- list (one per observation) of lists of true words
+    dictionary -- the evaluation dictionary, which the probabilities should be
+        normalized over (the sum of scores over `dictionary.keys()` is one)
+
+    Returns a list with one entry per observation: either a list of
+    probabilities, one per word in the corresponding `label_tokens`, or None if
+    the agent could not score that example.
+
+    e.g.
+    ([{'text': 'Run test program.'}], [['hello', 'world']]) => [[0.9, 0.8]]
 """
 
 from parlai.core.agents import create_agent, create_agents_from_shared
 from parlai.core.params import ParlaiParser
 from parlai.core.utils import Timer, round_sigfigs, no_lock
 from parlai.core.thread_utils import SharedTable
-from parlai.core.worlds import create_task, World
+from parlai.core.worlds import (
+    batch_slot_shared, create_task, create_task_world, World
+)
+from parlai.tasks.tasks import ids_to_tasks
 
 import copy
 import math
@@ -69,6 +92,11 @@ class PerplexityWorld(World):
 
     The API of the next_word_probability function which agents must implement
     is mentioned in the documentation for this file.
+
+    If the agent implements `batch_next_word_probability`, the whole label is
+    scored in one call instead. In that case this world also does its own
+    batching: with --batchsize > 1 it keeps one copy of the teacher and agent
+    per batch row and scores the labels of all rows together.
     """
     def __init__(self, opt, agents, shared=None):
         super().__init__(opt)
@@ -81,18 +109,44 @@ class PerplexityWorld(World):
         else:
             if len(agents) != 3:
                 raise RuntimeError('There must be exactly three agents.')
-            if opt.get('batchsize', 1) > 1:
-                raise RuntimeError('This world only works with bs=1. Try '
-                                   'using multiple threads instead, nt>1.')
             self.task, self.agent, self.dict = agents
-            if not hasattr(self.agent, 'next_word_probability'):
+            if not (hasattr(self.agent, 'next_word_probability') or
+                    hasattr(self.agent, 'batch_next_word_probability')):
                 raise RuntimeError('Agent must implement function '
                                    '`next_word_probability`.')
+            if (opt.get('batchsize', 1) > 1 and
+                    not hasattr(self.agent, 'batch_next_word_probability')):
+                raise RuntimeError('This world only works with bs=1 unless the '
+                                   'agent implements `batch_next_word_'
+                                   'probability`. Try using multiple threads '
+                                   'instead, nt>1.')
             self.metrics = {'exs': 0, 'loss': 0.0, 'num_tokens': 0, 'num_unk': 0}
             if opt.get('numthreads', 1) > 1:
                 self.metrics = SharedTable(self.metrics)
         self.agents = [self.task, self.agent, self.dict]
         self.acts = [None, None]
+        self.use_batch = hasattr(self.agent, 'batch_next_word_probability')
+        if self.use_batch and opt.get('batchsize', 1) > 1:
+            self.tasks, self.batch_agents = self._create_batch_copies(
+                opt['batchsize'])
+        else:
+            self.tasks, self.batch_agents = [self.task], [self.agent]
+
+    def _create_batch_copies(self, batchsize):
+        """Create one shared copy of the teacher and the agent per batch row.
+
+        This mirrors what BatchWorld does for regular worlds: every copy knows
+        its batchindex, so ordered teachers hand out distinct examples.
+        """
+        tasks, agents = [], []
+        shared = [self.task.share(), self.agent.share()]
+        for i in range(batchsize):
+            task, agent = create_agents_from_shared(
+                [batch_slot_shared(s, i) for s in shared]
+            )
+            tasks.append(task)
+            agents.append(agent)
+        return tasks, agents
 
     def _lock(self):
         if hasattr(self.metrics, 'get_lock'):
@@ -103,6 +157,8 @@ class PerplexityWorld(World):
             return no_lock()
 
     def parley(self):
+        if self.use_batch:
+            return self.batch_parley()
         action = self.task.act()
         self.acts[0] = action.copy()
 
@@ -139,7 +195,52 @@ class PerplexityWorld(World):
             self.metrics['num_tokens'] += num_tokens
             self.metrics['num_unk'] += num_unk
 
+    def batch_parley(self):
+        """Score the labels of a whole batch of examples in one agent call."""
+        observations = []
+        label_tokens = []
+        for i, (task, agent) in enumerate(zip(self.tasks, self.batch_agents)):
+            action = task.act()
+            if i == 0:
+                self.acts[0] = action.copy()
+            labels = action.get('eval_labels', action.get('labels', None))
+            if labels is None:
+                # empty example (e.g. padding at the end of the epoch)
+                continue
+            # hide labels from model
+            action.pop('label_candidates', None)
+            label_tokens.append(self.dict.tokenize(labels[0]))
+            observations.append(agent.observe(action))
+
+        if not observations:
+            return
+
+        batch_probs = self.agent.batch_next_word_probability(
+            observations, label_tokens, self.dict
+        )
+        exs, loss, num_tokens, num_unk = 0, 0, 0, 0
+        for parsed, probs in zip(label_tokens, batch_probs):
+            if probs is None:
+                continue
+            exs += 1
+            for word, prob_true in zip(parsed, probs):
+                if word not in self.dict:
+                    num_unk += 1
+                    continue
+                if prob_true > 0:
+                    loss -= math.log(prob_true)
+                else:
+                    loss = float('inf')
+                num_tokens += 1
+        with self._lock():
+            self.metrics['exs'] += exs
+            self.metrics['loss'] += loss
+            self.metrics['num_tokens'] += num_tokens
+            self.metrics['num_unk'] += num_unk
+
     def epoch_done(self):
+        if len(self.tasks) > 1:
+            return all(task.epoch_done() for task in self.tasks)
         return self.task.epoch_done()
 
     def num_examples(self):
@@ -214,7 +315,21 @@ def eval_ppl(opt, build_dict=None, dict_file=None):
 
     # create agents
     agent = create_agent(opt)
-    world = create_task(opt, [agent, dict_agent], default_world=PerplexityWorld)
+    if opt.get('batchsize', 1) > 1:
+        if opt.get('numthreads', 1) > 1:
+            raise RuntimeError('eval_ppl does not support using both '
+                               '--batchsize and --numthreads.')
+        # PerplexityWorld does its own batching, so don't wrap it in a
+        # BatchWorld the way create_task would
+        task_opt = copy.deepcopy(opt)
+        task_opt['task'] = ids_to_tasks(task_opt['task'])
+        world = create_task_world(
+            task_opt, [agent, dict_agent], default_world=PerplexityWorld
+        )
+    else:
+        world = create_task(
+            opt, [agent, dict_agent], default_world=PerplexityWorld
+        )
 
     # set up logging
     log_time = Timer()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import unittest
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from parlai.core.agents import create_task_agent_from_taskname
+from parlai.core.params import ParlaiParser
+from parlai.core.teachers import DialogData, CompactDialogData
+
+
+def _loader(datafile):
+    """Yield entries using every optional field, with a fixed seed."""
+    rng = random.Random(0)
+    cands = ['a', 'sa', 'last tü']
+    for ep in range(50):
+        for j in range(rng.randint(1, 4)):
+            text = 'text {} {} é'.format(ep, j) if rng.random() < 0.9 else None
+            labels = [rng.choice(cands)] if rng.random() < 0.8 else None
+            reward = rng.choice([None, '1', 2, 0.5, True])
+            if j == 0 or rng.random() < 0.5:
+                cands = list(cands)  # new candidates
+            size = rng.randint(0, 2)
+            entry = (text, labels, reward, cands)[:2 + size]
+            yield entry, j == 0
+
+
+def _all_examples(data):
+    examples = []
+    for ep in range(data.num_episodes()):
+        entry_idx = 0
+        while True:
+            try:
+                examples.append(data.get(ep, entry_idx))
+            except IndexError:
+                break
+            entry_idx += 1
+    return examples
+
+
+class TestCompactDialogData(unittest.TestCase):
+    """Checks that compact dialog data returns the same examples."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        parser = ParlaiParser()
+        self.opt = parser.parse_args(['-im', 'none'], print_args=False)
+        self.opt['datafile'] = os.path.join(self.tmpdir, 'data.txt')
+        with open(self.opt['datafile'], 'w') as f:
+            f.write('data')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_same_examples(self):
+        expected = _all_examples(DialogData(self.opt, _loader))
+        data = CompactDialogData(self.opt, _loader)
+        self.assertEqual(data.num_episodes(), 50)
+        self.assertEqual(data.num_examples(), len(expected))
+        self.assertEqual(_all_examples(data), expected)
+        shared = CompactDialogData(self.opt, shared=data.share())
+        self.assertEqual(_all_examples(shared), expected)
+
+    def test_cache(self):
+        self.opt['dialog_data_cache'] = True
+        self.opt['task'] = 'test'
+        expected = _all_examples(DialogData(self.opt, _loader))
+        self.assertEqual(
+            _all_examples(CompactDialogData(self.opt, _loader)), expected
+        )
+        self.assertEqual(len(os.listdir(self.tmpdir)), 2)
+
+        def fail(datafile):
+            raise AssertionError('should be loaded from the cache')
+            yield
+
+        self.assertEqual(
+            _all_examples(CompactDialogData(self.opt, fail)), expected
+        )
+
+        # changing the datafile invalidates the cache
+        time.sleep(0.01)
+        with open(self.opt['datafile'], 'w') as f:
+            f.write('new data')
+        with self.assertRaises(AssertionError):
+            CompactDialogData(self.opt, fail)
+
+    def test_teacher(self):
+        for task in ['integration_tests:MultiturnCandidate',
+                     'integration_tests:Nocandidate']:
+            examples = []
+            for dialog_data in ['tuples', 'compact']:
+                opt = dict(self.opt, task=task, datatype='valid',
+                           dialog_data=dialog_data)
+                teacher = create_task_agent_from_taskname(opt)[0]
+                self.assertEqual(isinstance(teacher.data, CompactDialogData),
+                                 dialog_data == 'compact')
+                acts = []
+                while not teacher.epoch_done():
+                    acts.append(teacher.act())
+                examples.append(acts)
+            self.assertGreater(len(examples[0]), 0)
+            self.assertEqual(examples[0], examples[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
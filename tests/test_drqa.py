@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import unittest
+import random
+import os
+import shutil
+import tempfile
+
+import torch
+
+from parlai.core.params import ParlaiParser
+from parlai.core.dict import DictionaryAgent
+from parlai.agents.drqa.utils import (
+    build_feature_dict, vectorize, decode_spans, TokenCache
+)
+
+
+class TestDrqaUtils(unittest.TestCase):
+    """Checks the feature extraction and span decoding of DrQA."""
+
+    def test_vectorize(self):
+        opt = {'use_in_question': True, 'use_tf': True, 'use_time': 3}
+        feature_dict = build_feature_dict(opt)
+        word_dict = {w: i for i, w in enumerate(['a', 'B', 'b', 'c', '.'])}
+        document = ['a', 'B', '.', 'b', 'c', '?', 'a', 'd', '.', 'b']
+        question = ['b', 'd', 'e']
+        ex = {'document': document, 'question': question, 'target': None}
+        _, features, _ = vectorize(
+            opt, ex, {w: word_dict.get(w, 0) for w in document + question},
+            feature_dict
+        )
+        self.assertEqual(features.size(), (len(document), len(feature_dict)))
+
+        def col(name):
+            return features[:, feature_dict[name]].tolist()
+
+        self.assertEqual(col('in_question'), [0, 0, 0, 1, 0, 0, 0, 1, 0, 1])
+        self.assertEqual(col('in_question_uncased'),
+                         [0, 1, 0, 1, 0, 0, 0, 1, 0, 1])
+        self.assertTrue(torch.allclose(
+            features[:, feature_dict['tf']],
+            torch.Tensor([2, 3, 2, 3, 1, 1, 2, 1, 2, 3]) / 10
+        ))
+        # sentences are counted from the end of the document
+        self.assertEqual(col('time=T1'), [0, 0, 0, 0, 0, 0, 0, 0, 0, 1])
+        self.assertEqual(col('time=T2'), [0, 0, 0, 0, 0, 0, 1, 1, 1, 0])
+        self.assertEqual(col('time>=T3'), [1, 1, 1, 1, 1, 1, 0, 0, 0, 0])
+
+    def test_decode_spans(self):
+        rng = random.Random(0)
+        for max_len in [1, 3, 15, 0]:
+            score_s = torch.Tensor(4, 12).uniform_()
+            score_e = torch.Tensor(4, 12).uniform_()
+            score_s[rng.randrange(4), 9:] = 0
+            s_idx, e_idx, scores = decode_spans(score_s, score_e, max_len)
+            for i in range(4):
+                expected = max(
+                    (score_s[i, s] * score_e[i, e], s, e)
+                    for s in range(12)
+                    for e in range(s, min(12, s + (max_len or 12)))
+                )
+                self.assertAlmostEqual(scores[i].item(), expected[0].item())
+                self.assertEqual((s_idx[i].item(), e_idx[i].item()),
+                                 expected[1:])
+
+    def test_token_cache(self):
+        parser = ParlaiParser()
+        DictionaryAgent.add_cmdline_args(parser)
+        opt = parser.parse_args([], print_args=False)
+        word_dict = DictionaryAgent(opt)
+        texts = ['Who wrote "Hamlet"?', 'It was  Shakespeare, in 1600.', '']
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'tokens.db')
+            cache = TokenCache(path, word_dict)
+            for _ in range(2):
+                for text in texts:
+                    self.assertEqual(cache.tokenize(text),
+                                     word_dict.tokenize(text))
+                    tokens, spans = cache.span_tokenize(text)
+                    expected = word_dict.span_tokenize(text)
+                    self.assertEqual(tokens, expected[0])
+                    self.assertEqual([tuple(s) for s in spans], expected[1])
+            self.assertEqual(cache.num_pending, 2 * len(texts))
+            cache.close()
+
+            # a new cache reads everything from disk
+            cache = TokenCache(path, word_dict)
+            for text in texts:
+                self.assertEqual(cache.tokenize(text),
+                                 word_dict.tokenize(text))
+                tokens, spans = cache.span_tokenize(text)
+                self.assertEqual(tokens, word_dict.span_tokenize(text)[0])
+            self.assertEqual(cache.num_pending, 0)
+            cache.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import unittest
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+
+from parlai.core.embedding_store import (
+    EmbeddingStore, read_text_vectors, copy_embeddings
+)
+
+
+class _Dict(object):
+    def __init__(self, tokens):
+        self.tok2ind = {t: i for i, t in enumerate(tokens)}
+
+
+class TestEmbeddingStore(unittest.TestCase):
+    """Checks that the store returns the vectors of the text file."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_build_and_copy(self):
+        rng = np.random.RandomState(0)
+        words = ['w{}'.format(i) for i in range(50)] + ['é', 'w3']
+        vecs = rng.randn(len(words), 4).astype(np.float32)
+        text_path = os.path.join(self.tmpdir, 'vecs.txt')
+        with open(text_path, 'w', encoding='utf-8') as f:
+            f.write('{} 4\n'.format(len(words)))
+            for w, v in zip(words, vecs):
+                f.write(w + ' ' + ' '.join(str(x) for x in v) + '\n')
+
+        path = os.path.join(self.tmpdir, 'vecs.emb')
+        EmbeddingStore.build(path, read_text_vectors(text_path))
+        self.assertTrue(EmbeddingStore.exists(path))
+        store = EmbeddingStore(path)
+        self.assertEqual(store.dim, 4)
+        self.assertEqual(len(store), 51)
+        self.assertEqual(store.tokens(), words[:-1])
+
+        rows = store.rows(['w7', 'missing', 'é', 'w3'])
+        self.assertEqual(rows.tolist(), [7, -1, 50, 3])
+        self.assertTrue(np.allclose(store.vectors[7], vecs[7], atol=1e-5))
+        # the last vector of a repeated token is kept
+        self.assertTrue(np.allclose(store.vectors[3], vecs[-1], atol=1e-5))
+
+        dictionary = _Dict(['__null__', 'é', 'missing', 'w10'])
+        weight = torch.zeros(4, 4)
+        self.assertEqual(copy_embeddings(weight, dictionary, store), 2)
+        self.assertTrue(torch.allclose(weight[1], torch.from_numpy(vecs[50]),
+                                       atol=1e-5))
+        self.assertTrue(torch.allclose(weight[3], torch.from_numpy(vecs[10]),
+                                       atol=1e-5))
+        self.assertEqual(weight[2].abs().sum().item(), 0)
+
+        weight = torch.zeros(4, 2)
+        copy_embeddings(weight, dictionary, store,
+                        project=lambda vec, dim: vec[:dim])
+        self.assertTrue(torch.allclose(weight[3],
+                                       torch.from_numpy(vecs[10][:2]),
+                                       atol=1e-5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import unittest
+import random
+
+from parlai.core.params import ParlaiParser
+from parlai.core.dict import DictionaryAgent
+from parlai.agents.ir_baseline.ir_baseline import (
+    CandidateIndex, IrBaselineAgent, rank_candidates, score_match
+)
+
+
+class TestIrBaseline(unittest.TestCase):
+    """Checks the candidate index of the IR baseline."""
+
+    def test_candidate_index(self):
+        parser = ParlaiParser()
+        IrBaselineAgent.add_cmdline_args(parser)
+        DictionaryAgent.add_cmdline_args(parser)
+        opt = parser.parse_args([], print_args=False)
+        dictionary = DictionaryAgent(opt)
+
+        rng = random.Random(0)
+        words = ['w{}'.format(i) for i in range(30)]
+        cands = [' '.join(rng.choice(words) for _ in range(rng.randint(0, 8)))
+                 for _ in range(500)]
+        index = CandidateIndex(cands, dictionary)
+        for _ in range(20):
+            query = ' '.join(rng.choice(words) for _ in range(5))
+            rep = {'words': {w: 1 for w in query.split()},
+                   'norm': 5 ** 0.5}
+            for lp in [0, 0.5]:
+                ranked = index.rank(rep, lp)
+                expected = rank_candidates(rep, cands, lp, dictionary)
+                # candidates with equal scores may come in another order
+                self.assertEqual(
+                    [score_match(rep, c, lp, dictionary) for c in ranked],
+                    [score_match(rep, c, lp, dictionary) for c in expected]
+                )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import unittest
+import os
+import random
+import shutil
+import tempfile
+
+import torch
+
+from parlai.core.params import ParlaiParser
+from parlai.agents.language_model.language_model import LanguageModelAgent
+from parlai.agents.language_model.token_stream import (
+    TokenStream, PretokenizedCorpus
+)
+
+
+class TestTokenStream(unittest.TestCase):
+    """Checks the token buffers of the language model."""
+
+    def test_token_stream(self):
+        rng = random.Random(0)
+        for width in [None, 3]:
+            stream = TokenStream(width=width, capacity=4)
+            expected = []
+            for _ in range(200):
+                n = rng.randint(0, 10)
+                items = [rng.randint(0, 100) for _ in range(n * (width or 1))]
+                stream.append(items)
+                expected.extend(items)
+                n = rng.randint(0, len(stream))
+                popped = stream.pop(n)
+                self.assertEqual(popped.view(-1).tolist(),
+                                 expected[:n * (width or 1)])
+                expected = expected[n * (width or 1):]
+                self.assertEqual(len(stream) * (width or 1), len(expected))
+            with self.assertRaises(IndexError):
+                stream.pop(len(stream) + 1)
+
+    def test_pretokenized_corpus(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'corpus.npy')
+            PretokenizedCorpus.write(path, [[1, 2, 3], [4, 5]] * 10,
+                                     end_idx=0)
+            corpus = PretokenizedCorpus(path)
+            self.assertEqual(len(corpus), 70)
+            tokens = torch.LongTensor(corpus.tokens.tolist())
+            streams = tokens.view(2, 35)
+            batches = list(corpus.batches(bsz=2, seq_len=8))
+            self.assertEqual(len(batches), 5)
+            for i, (data, targets) in enumerate(batches):
+                self.assertEqual(data.size(1), 2)
+                self.assertTrue(data.is_contiguous())
+                self.assertTrue(torch.equal(
+                    data, streams[:, i * 8:i * 8 + data.size(0)].t()))
+                self.assertTrue(torch.equal(
+                    targets, streams[:, i * 8 + 1:i * 8 + 1 + data.size(0)].t()))
+            self.assertEqual(batches[-1][0].size(0), 2)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestLanguageModelEval(unittest.TestCase):
+    """Checks the bucketed evaluation of the language model."""
+
+    def test_bucketed_loss(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            parser = ParlaiParser()
+            LanguageModelAgent.add_cmdline_args(parser)
+            opt = parser.parse_args([
+                '--batchsize', '8', '--hiddensize', '16',
+                '--embeddingsize', '16', '--dropout', '0', '--no-cuda',
+                '--truncate-pred', '5', '--report-freq', '0',
+                '--dict-file', os.path.join(tmpdir, 'dict'),
+            ], print_args=False)
+            torch.manual_seed(0)
+            agent = LanguageModelAgent(opt)
+            rng = random.Random(0)
+            words = ['w{}'.format(i) for i in range(20)]
+            agent.dict.add_to_dict(words)
+            agent.model = agent.model.__class__(agent.opt, len(agent.dict))
+            agent.is_training = False
+            obs = [{'text': ' '.join(rng.choice(words)
+                                     for _ in range(rng.randint(1, 30))),
+                    'eval_labels': [' '.join(rng.choice(words)
+                                             for _ in range(rng.randint(1, 9)))],
+                    'episode_done': True}
+                   for _ in range(7)]
+
+            losses = []
+            for o in obs:
+                agent.reset_metrics()
+                agent.batch_act([agent.observe(o)])
+                losses.append(float(agent.metrics['loss']))
+                self.assertTrue(agent.metrics['num_tokens'] > 0)
+            # padding must not change the loss, however the batch is bucketed
+            for ratio in [0, 0.5, 1]:
+                agent.opt['eval_bucket_ratio'] = ratio
+                agent.reset_metrics()
+                replies = agent.batch_act([agent.observe(o) for o in obs])
+                self.assertAlmostEqual(
+                    float(agent.metrics['loss']), sum(losses), places=2
+                )
+                self.assertTrue(all('text' in r for r in replies))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -96,6 +96,45 @@ class TestMemnn(unittest.TestCase):
             "test hits@1 = {}\nLOG:\n{}".format(test['hits@1'], stdout)
         )
 
+    def test_embed(self):
+        """Embedding bags match dense embeddings with position encoding."""
+        import torch
+        from parlai.agents.memnn.modules import Embed, MemNN
+
+        torch.manual_seed(0)
+        for pe in [False, True]:
+            embed = Embed(50, 16, position_encoding=pe, padding_idx=0)
+            mems = torch.randint(1, 50, (4, 3, 7))
+            mems[:, :, 5:] = 0
+            embs = torch.nn.functional.embedding(mems, embed.weight)
+            if pe:
+                # l_kj = (1 - j / J) - (k / d) (1 - 2j / J), section 4.1 of
+                # https://papers.nips.cc/paper/5846-end-to-end-memory-networks
+                pe_matrix = torch.Tensor(7, 16)
+                for j in range(1, 8):
+                    for k in range(1, 17):
+                        pe_matrix[j - 1, k - 1] = (
+                            (1 - j / 7) - (k / 16) * (1 - 2 * j / 7)
+                        )
+                embs = embs * pe_matrix
+            expected = embs.sum(-2) / mems.ne(0).sum(-1, keepdim=True).float()
+            self.assertTrue(torch.allclose(embed(mems), expected, atol=1e-6))
+
+        model = MemNN(50, 16, hops=2, position_encoding=True,
+                      mem_cache_size=5)
+        model.eval()
+        xs = torch.randint(1, 50, (4, 6))
+        cands = torch.randint(1, 50, (10, 4))
+        with torch.no_grad():
+            model.mem_cache_size = 0
+            expected = model(xs, mems, cands)
+            model.mem_cache_size = 5
+            for _ in range(2):
+                # the second pass reads the most recent memories from the cache
+                scores = model(xs, mems, cands)
+                self.assertTrue(torch.allclose(scores, expected, atol=1e-6))
+                self.assertEqual(len(model.mem_cache), 5)
+
 
 if __name__ == '__main__':
     unittest.main()
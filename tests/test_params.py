@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import unittest
+
+from parlai.core.agents import create_agent
+from parlai.core.params import ParlaiParser, get_model_defaults
+from parlai.agents.ir_baseline.ir_baseline import IrBaselineAgent
+
+
+class TestParams(unittest.TestCase):
+    """Checks the cached model defaults and repeated parsing."""
+
+    def test_model_defaults(self):
+        defaults = get_model_defaults('ir_baseline')
+        self.assertIn('datapath', defaults)
+        self.assertEqual(defaults['length_penalty'], 0.5)
+        # callers get their own copy
+        defaults['length_penalty'] = 2
+        defaults['override']['foo'] = 1
+        again = get_model_defaults('ir_baseline')
+        self.assertEqual(again['length_penalty'], 0.5)
+        self.assertNotIn('foo', again['override'])
+
+        agent = create_agent({'model': 'repeat_label'})
+        self.assertIn('datapath', agent.opt)
+        agent = create_agent({'model': 'ir_baseline'})
+        self.assertEqual(agent.opt['length_penalty'], 0.5)
+
+    def test_reparse(self):
+        parser = ParlaiParser(add_model_args=True)
+        parser.set_params(length_penalty=0.25)
+        args = ['-t', 'integration_tests', '-m', 'ir_baseline']
+        opt = parser.parse_args(args, print_args=False)
+        self.assertEqual(opt['length_penalty'], 0.25)
+        self.assertIn(IrBaselineAgent, parser.added_args)
+        # the args of the model are not added again
+        num_actions = len(parser._actions)
+        opt = parser.parse_args(args + ['-lp', '0.75'], print_args=False)
+        self.assertEqual(opt['length_penalty'], 0.75)
+        self.assertEqual(len(parser._actions), num_actions)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+from parlai.core.agents import Agent, create_agent
+from parlai.core.params import ParlaiParser
+
+import contextlib
+import io
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+SKIP_TESTS = False
+try:
+    from parlai.agents.tfidf_retriever.tfidf_retriever import (  # noqa: F401
+        TfidfRetrieverAgent
+    )
+    from parlai.agents.drqa.drqa import SimpleDictionaryAgent
+except ImportError:
+    SKIP_TESTS = True
+
+DOCS = [
+    'Paris is the capital of France.\n\nThe Seine flows through Paris.',
+    'Berlin is the capital of Germany.\nIt is a large city.',
+    'Tokyo is the capital of Japan.\n\nMount Fuji is near Tokyo.\n'
+    'Japan has many islands.',
+    'The Rhine flows through Germany and France.\nIt is a long river.',
+] + [
+    'Document {} is about topic {}.\nIt has nothing else.'.format(i, i)
+    for i in range(10)
+]
+QUESTIONS = [
+    'What is the capital of France?',
+    'Which river flows through Paris?',
+    'What is near Tokyo?',
+    'Which city is the capital of Germany?',
+]
+
+
+class _SingleRetriever(Agent):
+    """Retriever which only implements observe and act."""
+
+    def __init__(self, retriever):
+        super().__init__({})
+        self.retriever = retriever
+
+    def observe(self, obs):
+        self.retriever.observe(obs)
+
+    def act(self):
+        return self.retriever.act()
+
+
+def _build_models(tmpdir):
+    """Save a small tfidf retriever and an untrained DrQA reader in tmpdir."""
+    logger = logging.getLogger('parlai.agents.tfidf_retriever.build_tfidf')
+    logger.setLevel(logging.ERROR)
+    retriever_file = os.path.join(tmpdir, 'retriever')
+    parser = ParlaiParser(True, True)
+    opt = parser.parse_args([
+        '-m', 'tfidf_retriever', '-mf', retriever_file,
+        '--retriever-hashsize', '256', '--retriever-numworkers', '1',
+        '--retriever-num-retrieved', '2', '--retriever-mode', 'keys',
+    ], print_args=False)
+    retriever = create_agent(opt)
+    retriever.triples_to_add.extend((None, doc, doc) for doc in DOCS)
+    retriever.save()
+
+    reader_file = os.path.join(tmpdir, 'reader')
+    parser = ParlaiParser(True, True)
+    opt = parser.parse_args([
+        '-m', 'drqa', '-mf', reader_file, '--no_cuda', 'true',
+        '--dict-file', reader_file + '.dict', '--dict-tokenizer', 're',
+        '--embedding_dim', '8', '--hidden_size', '8', '--doc_layers', '1',
+        '--question_layers', '1',
+    ], print_args=False)
+    word_dict = SimpleDictionaryAgent(opt)
+    for text in DOCS + QUESTIONS:
+        word_dict.add_to_dict(word_dict.tokenize(text))
+    word_dict.save(opt['dict_file'])
+    create_agent(opt).save()
+    return retriever_file, reader_file
+
+
+class TestRetrieverReader(unittest.TestCase):
+    """Checks the batched reading of RetrieverReaderAgent."""
+
+    @unittest.skipIf(SKIP_TESTS, "Missing Tfidf or DrQA dependencies.")
+    def test_batch_act(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                retriever_file, reader_file = _build_models(tmpdir)
+                parser = ParlaiParser(True, True)
+                opt = parser.parse_args([
+                    '-m', 'retriever_reader',
+                    '--retriever-model-file', retriever_file,
+                    '--reader-model-file', reader_file,
+                    '--num-retrieved', '2', '--reader-batchsize', '3',
+                ], print_args=False)
+                agent = create_agent(opt)
+
+            observations = [
+                {'text': q, 'episode_done': True} for q in QUESTIONS
+            ]
+            expected = []
+            for obs in observations:
+                agent.observe(obs)
+                expected.append(agent.act())
+
+            for reply, obs in zip(expected, observations):
+                # the best span of all the paragraphs retrieved for obs
+                agent.retriever.observe(obs)
+                paragraphs = agent._paragraphs(agent.retriever.act())
+                self.assertGreater(len(paragraphs), 1)
+                scores = {}
+                for para in paragraphs:
+                    agent.reader.observe(dict(
+                        obs, text=para + '\n' + obs['text']
+                    ))
+                    scores[para] = agent.reader.act()['candidate_scores'][0]
+                best = max(paragraphs, key=lambda p: scores[p])
+                self.assertEqual(reply['paragraph'], best)
+                self.assertAlmostEqual(reply['candidate_scores'][0],
+                                       scores[best], places=5)
+
+            batch = observations[:2] + [{'episode_done': True}] + \
+                observations[2:]
+            for retriever in [agent.retriever,
+                              _SingleRetriever(agent.retriever)]:
+                agent.retriever = retriever
+                replies = agent.batch_act(batch)
+                self.assertEqual(len(replies), len(batch))
+                self.assertEqual(replies[2], {'id': agent.getID()})
+                del replies[2]
+                for reply, exp in zip(replies, expected):
+                    self.assertEqual(reply['text'], exp['text'])
+                    self.assertEqual(reply['paragraph'], exp['paragraph'])
+                    self.assertAlmostEqual(reply['candidate_scores'][0],
+                                           exp['candidate_scores'][0],
+                                           places=5)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
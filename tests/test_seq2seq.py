@@ -13,7 +13,14 @@ import tempfile
 import os
 import shutil
 
+import torch
+
+from parlai.agents.seq2seq.modules import Seq2seq
+from parlai.core.agents import create_agent
+from parlai.core.dict import DictionaryAgent
+from parlai.core.params import ParlaiParser
 from parlai.scripts.train_model import TrainLoop, setup_args
+from parlai.scripts.eval_ppl import eval_ppl, setup_args as ppl_setup_args
 
 BATCH_SIZE = 16
 NUM_EPOCHS = 10
@@ -90,6 +97,31 @@ class TestSeq2Seq(unittest.TestCase):
             "test ppl = {}\nLOG:\n{}".format(test['ppl'], stdout)
         )
 
+    def test_sampled_softmax(self):
+        """Train with a sampled softmax and evaluate with the full softmax."""
+        stdout, valid, test = _mock_train(
+            task='integration_tests:NocandidateTeacher',
+            model='seq2seq',
+            lr=LR,
+            batchsize=BATCH_SIZE,
+            num_epochs=NUM_EPOCHS,
+            numthreads=1,
+            no_cuda=True,
+            embeddingsize=16,
+            hiddensize=16,
+            rnn_class='gru',
+            attention='none',
+            gradient_clip=1.0,
+            dropout=0.0,
+            lookuptable='all',
+            sampled_softmax=20,
+        )
+
+        self.assertTrue(
+            valid['ppl'] < 1.3,
+            "valid ppl = {}\nLOG:\n{}".format(valid['ppl'], stdout)
+        )
+
 
 class TestHogwildSeq2seq(unittest.TestCase):
     def test_generation_multi(self):
@@ -121,5 +153,174 @@ class TestHogwildSeq2seq(unittest.TestCase):
         )
 
 
+class TestSeq2SeqPerplexity(unittest.TestCase):
+    """Checks the batched perplexity evaluation path."""
+
+    def test_eval_ppl_batched(self):
+        outdir = tempfile.mkdtemp()
+        model_file = os.path.join(outdir, "model")
+        try:
+            parser = setup_args()
+            parser.set_defaults(
+                task='integration_tests:NocandidateTeacher',
+                model='seq2seq',
+                model_file=model_file,
+                batchsize=BATCH_SIZE,
+                num_epochs=1,
+                no_cuda=True,
+                embeddingsize=16,
+                hiddensize=16,
+                rnn_class='gru',
+                dropout=0.0,
+                skip_generation=True,
+            )
+            with contextlib.redirect_stdout(io.StringIO()):
+                TrainLoop(parser.parse_args(print_args=False)).train()
+
+            ppls = []
+            for bsz in [1, BATCH_SIZE]:
+                parser = ppl_setup_args()
+                parser.set_defaults(
+                    task='integration_tests:NocandidateTeacher',
+                    model='seq2seq',
+                    model_file=model_file,
+                    batchsize=bsz,
+                    no_cuda=True,
+                )
+                stdout = io.StringIO()
+                with contextlib.redirect_stdout(stdout):
+                    eval_ppl(
+                        parser.parse_args(print_args=False),
+                        build_dict=lambda: DictionaryAgent(
+                            {'dict_file': model_file + '.dict'}
+                        ),
+                    )
+                ppls.append(stdout.getvalue().split('FINAL PPL: ')[1].strip())
+        finally:
+            shutil.rmtree(outdir)
+
+        self.assertEqual(ppls[0], ppls[1])
+
+
+class TestSeq2SeqSampling(unittest.TestCase):
+    """Checks the batched sampling decoder."""
+
+    def _model(self):
+        torch.manual_seed(0)
+        model = Seq2seq(20, 8, 8, numlayers=1, rnn_class='gru', end_idx=2)
+        model.eval()
+        return model
+
+    def test_topk_one_is_greedy(self):
+        model = self._model()
+        xs = torch.LongTensor([[4, 5, 6], [7, 8, 9], [10, 11, 0]])
+        with torch.no_grad():
+            enc = model.encoder(xs)
+            _, greedy = model.decode_greedy(enc, 3, 10)
+            _, sampled = model.decode_sample(enc, 3, 10, topk=1)
+        for g, s in zip(greedy.tolist(), sampled.tolist()):
+            if 2 in g:
+                g = g[:g.index(2) + 1]
+            self.assertEqual(g, s[:len(g)])
+
+    def test_per_row_stopping(self):
+        model = self._model()
+        xs = torch.LongTensor([[4, 5, 6]] * 8)
+        with torch.no_grad():
+            enc = model.encoder(xs)
+            _, sampled = model.decode_sample(
+                enc, 8, 30, topp=0.9, temperature=2.0
+            )
+        for row in sampled.tolist():
+            if 2 in row:
+                tail = row[row.index(2) + 1:]
+                self.assertEqual(tail, [0] * len(tail))
+
+
+class TestSeq2SeqEncoderCache(unittest.TestCase):
+    """Checks the encoder state cache of TorchGeneratorAgent."""
+
+    def _agent(self, cache_size=2):
+        torch.manual_seed(0)
+        parser = ParlaiParser(True, True)
+        opt = parser.parse_args([
+            '-m', 'seq2seq', '--no-cuda', '-esz', '8', '--hiddensize', '8',
+            '-nl', '1', '-rnn', 'gru', '--beam-size', '1',
+            '--encoder-cache-size', str(cache_size),
+        ], print_args=False)
+        agent = create_agent(opt)
+        agent.model.eval()
+        return agent
+
+    def _assert_states_equal(self, states, expected):
+        for x, y in zip(states, expected):
+            self.assertEqual(x.shape, y.shape)
+            if x.is_floating_point():
+                self.assertTrue(torch.allclose(x, y, atol=1e-6))
+            else:
+                self.assertTrue(torch.equal(x, y))
+
+    def test_extend_matches_full_encode(self):
+        model = self._agent().model
+        xs = torch.LongTensor([[3, 1, 2, 3, 3, 2, 1]])
+        with torch.no_grad():
+            expected = model.encoder(xs)
+            states = model.encoder(xs[:, :3])
+            states = model.extend_encoder_states(states, xs[:, 3:5])
+            states = model.extend_encoder_states(states, xs[:, 5:])
+        self._assert_states_equal(states, expected)
+
+    def test_cache_hits_and_eviction(self):
+        agent = self._agent(cache_size=2)
+        encoded = []
+        agent.model.encoder.register_forward_hook(
+            lambda m, inputs, out: encoded.append(inputs[0].size(1))
+        )
+        xs = torch.LongTensor([[3, 1, 2, 3, 3, 2, 1]])
+
+        states = agent._cached_encode(xs[:, :3], 'a')
+        self.assertEqual(encoded, [3])
+        # the next turn only encodes the new tokens
+        states = agent._cached_encode(xs, 'a')
+        self.assertEqual(encoded, [3, 4])
+        with torch.no_grad():
+            self._assert_states_equal(states, agent.model.encoder(xs))
+        del encoded[:]
+        # the same input is not encoded again
+        agent._cached_encode(xs, 'a')
+        self.assertEqual(encoded, [])
+        # a different history is encoded in full
+        agent._cached_encode(xs[:, 1:], 'a')
+        self.assertEqual(encoded, [6])
+
+        # the least recently used conversation is evicted
+        agent._cached_encode(xs, 'b')
+        agent._cached_encode(xs, 'a')
+        agent._cached_encode(xs, 'c')
+        self.assertEqual(list(agent.encoder_cache), ['a', 'c'])
+
+    def test_episode_done(self):
+        agent = self._agent()
+        extended = []
+        extend = agent.model.extend_encoder_states
+
+        def count_extend(states, xs):
+            extended.append(xs.size(1))
+            return extend(states, xs)
+
+        agent.model.extend_encoder_states = count_extend
+        agent.observe({'text': 'hello there', 'conversation_id': 'a',
+                       'episode_done': False})
+        agent.act()
+        self.assertIn('a', agent.encoder_cache)
+        # the second turn of the conversation hits the cache
+        agent.observe({'text': 'more words', 'conversation_id': 'a',
+                       'episode_done': True})
+        agent.act()
+        self.assertEqual(len(extended), 1)
+        # the entry is dropped once the conversation ends
+        self.assertNotIn('a', agent.encoder_cache)
+
+
 if __name__ == '__main__':
     unittest.main()
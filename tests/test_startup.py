@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import unittest
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from parlai.core.registry import ModuleRegistry, get_registry
+
+PARLAI_HOME = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# entry points which should start without loading heavy dependencies
+ENTRY_POINTS = [
+    'parlai.core.params',
+    'parlai.core.worlds',
+    'parlai.scripts.build_dict',
+    'parlai.scripts.display_data',
+    'parlai.scripts.display_model',
+    'parlai.scripts.eval_model',
+    'parlai.scripts.interactive',
+    'parlai.scripts.train_model',
+    'parlai.scripts.verify_data',
+]
+HEAVY_MODULES = ['torch', 'nltk', 'spacy']
+
+_IMPORT_CODE = """
+import sys, time
+start = time.time()
+import {module}
+print(time.time() - start)
+print(' '.join(m for m in {heavy!r} if m in sys.modules))
+"""
+
+
+def _import_time(module):
+    """Import module in a fresh interpreter and return the seconds it took
+    and the heavy modules it loaded.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [PARLAI_HOME] + [p for p in [env.get('PYTHONPATH')] if p])
+    out = subprocess.check_output(
+        [sys.executable, '-c',
+         _IMPORT_CODE.format(module=module, heavy=HEAVY_MODULES)],
+        cwd=PARLAI_HOME, env=env, universal_newlines=True
+    ).split('\n')
+    return float(out[0]), out[1].split()
+
+
+class TestStartup(unittest.TestCase):
+    """Checks that the scripts start without importing torch or nltk."""
+
+    def test_entry_points(self):
+        report = []
+        for module in ENTRY_POINTS:
+            secs, heavy = _import_time(module)
+            report.append('{:<32} {:6.2f}s'.format(module, secs))
+            self.assertEqual(
+                heavy, [], '{} imports {}'.format(module, ', '.join(heavy))
+            )
+        print('\n[ import time per entry point ]\n' + '\n'.join(report))
+
+
+class TestRegistry(unittest.TestCase):
+    """Checks the names found by the registry and its disk cache."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.tmpdir, 'registry.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_defines(self):
+        registry = ModuleRegistry(self.cache_path)
+        self.assertTrue(registry.defines(
+            'parlai.agents.seq2seq.seq2seq', 'Seq2seqAgent'))
+        self.assertFalse(registry.defines(
+            'parlai.agents.seq2seq.agents', 'Seq2seqAgent'))
+        self.assertTrue(registry.defines(
+            'parlai.tasks.babi.agents', 'Task1kTeacher'))
+        self.assertFalse(registry.defines(
+            'parlai.tasks.no_such_task.agents', 'DefaultTeacher'))
+        registry.save()
+        self.assertTrue(os.path.isfile(self.cache_path))
+
+    def test_cache_invalidation(self):
+        sys.path.insert(0, self.tmpdir)
+        try:
+            path = os.path.join(self.tmpdir, 'registry_test_module.py')
+            with open(path, 'w') as f:
+                f.write('try:\n    import foo as bar\nexcept ImportError:\n'
+                        '    bar = None\n\n\nclass FooAgent(object):\n'
+                        '    x = 1\n')
+            registry = ModuleRegistry(self.cache_path)
+            self.assertTrue(registry.defines('registry_test_module', 'bar'))
+            self.assertTrue(registry.defines('registry_test_module',
+                                             'FooAgent'))
+            self.assertFalse(registry.defines('registry_test_module', 'x'))
+            registry.save()
+
+            # a new registry reads the names from the cache
+            registry = ModuleRegistry(self.cache_path)
+            self.assertTrue(registry.defines('registry_test_module',
+                                             'FooAgent'))
+            self.assertFalse(registry.dirty)
+
+            time.sleep(0.01)
+            with open(path, 'w') as f:
+                f.write('from foo import *\n')
+            self.assertIsNone(registry.defines('registry_test_module',
+                                               'FooAgent'))
+            self.assertTrue(registry.dirty)
+        finally:
+            sys.path.remove(self.tmpdir)
+
+    def test_module_scope(self):
+        sys.path.insert(0, self.tmpdir)
+        try:
+            path = os.path.join(self.tmpdir, 'registry_scope_module.py')
+            with open(path, 'w') as f:
+                f.write(
+                    'for LoopAgent in [1]:\n    pass\n'
+                    'with open(__file__) as WithAgent:\n    pass\n'
+                    'try:\n    pass\nexcept Exception as ExcAgent:\n'
+                    '    pass\n'
+                    'squares = [LocalAgent for LocalAgent in range(3)]\n\n\n'
+                    'def setup():\n    global GlobalAgent\n'
+                    '    GlobalAgent = 1\n    FuncAgent = 2\n'
+                )
+            registry = ModuleRegistry(self.cache_path)
+            for name in ['LoopAgent', 'WithAgent', 'ExcAgent', 'GlobalAgent',
+                         'squares', 'setup']:
+                self.assertTrue(registry.defines('registry_scope_module',
+                                                 name), name)
+            for name in ['LocalAgent', 'FuncAgent']:
+                self.assertFalse(registry.defines('registry_scope_module',
+                                                  name), name)
+
+            with open(path, 'w') as f:
+                f.write('globals()["DynamicAgent"] = 1\n')
+            os.utime(path, ns=(0, 0))
+            self.assertIsNone(registry.defines('registry_scope_module',
+                                               'DynamicAgent'))
+        finally:
+            sys.path.remove(self.tmpdir)
+
+    def test_datapath(self):
+        registry = get_registry(self.tmpdir)
+        self.assertIs(get_registry(self.tmpdir), registry)
+        self.assertEqual(registry.cache_path, self.cache_path)
+        self.assertTrue(registry.defines(
+            'parlai.agents.seq2seq.seq2seq', 'Seq2seqAgent'))
+        registry.save()
+        self.assertTrue(os.path.isfile(self.cache_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,6 +11,8 @@ from parlai.core.agents import create_agent
 from parlai.core.worlds import create_task
 
 import os
+import shutil
+import tempfile
 import unittest
 import contextlib
 import io
@@ -89,6 +91,282 @@ class TestTfidfRetriever(unittest.TestCase):
             if os.path.exists(TFIDF_PATH + '.npz'):
                 os.remove(TFIDF_PATH + '.npz')
 
+    @unittest.skipIf(SKIP_TESTS, "Missing  Tfidf dependencies.")
+    def test_mmap_index(self):
+        import numpy as np
+        import scipy.sparse as sp
+        from parlai.agents.tfidf_retriever import utils
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'index')
+            matrix = sp.random(64, 10, density=0.2, format='csr')
+            doc_freqs = np.arange(64)
+            utils.save_sparse_csr_mmap(
+                filename, matrix, {'doc_freqs': doc_freqs, 'ngram': 2}
+            )
+            self.assertTrue(utils.has_sparse_csr_mmap(filename))
+            loaded, metadata = utils.load_sparse_csr_mmap(filename)
+            self.assertEqual((loaded != matrix).nnz, 0)
+            self.assertFalse(loaded.data.flags.writeable)
+            self.assertEqual(metadata['ngram'], 2)
+            self.assertEqual(list(metadata['doc_freqs']), list(doc_freqs))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipIf(SKIP_TESTS, "Missing  Tfidf dependencies.")
+    def test_max_score_top_k(self):
+        import numpy as np
+        import scipy.sparse as sp
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            ranker = _random_ranker(tmpdir)
+            rng = np.random.RandomState(0)
+            for _ in range(20):
+                terms = np.unique(rng.randint(0, 256, size=8))
+                spvec = sp.csr_matrix(
+                    (rng.rand(len(terms)), terms, [0, len(terms)]),
+                    shape=(1, 256)
+                )
+                scores = (spvec * ranker.doc_mat).toarray().ravel()
+                for k in [1, 5, 50]:
+                    doc_ids, doc_scores = ranker.max_score_top_k(spvec, k)
+                    expected = np.sort(scores[scores > 0])[::-1][:k]
+                    self.assertTrue(np.allclose(doc_scores, expected))
+                    self.assertTrue(np.allclose(scores[doc_ids], doc_scores))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipIf(SKIP_TESTS, "Missing  Tfidf dependencies.")
+    def test_batch_closest_docs(self):
+        import numpy as np
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            ranker = _random_ranker(tmpdir)
+            ranker.strict = False
+            rng = np.random.RandomState(0)
+            queries = [
+                ' '.join('word{}'.format(w) for w in rng.randint(0, 100, n))
+                for n in rng.randint(0, 10, size=50)
+            ]
+            for k in [1, 5, 50]:
+                # small limits so both the padded and per-row paths are used
+                batch = ranker.batch_closest_docs(
+                    queries, k, chunk_size=16, max_padded_width=20,
+                    max_elements=100
+                )
+                for query, (doc_ids, doc_scores) in zip(queries, batch):
+                    _, expected = ranker.closest_docs(query, k)
+                    self.assertTrue(np.allclose(doc_scores, expected))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipIf(SKIP_TESTS, "Missing  Tfidf dependencies.")
+    def test_delta_segment(self):
+        import numpy as np
+        from parlai.agents.tfidf_retriever.build_tfidf import (
+            run as build_tfidf, get_delta_count_matrix
+        )
+        from parlai.agents.tfidf_retriever.doc_db import DocDB
+        from parlai.agents.tfidf_retriever.tfidf_doc_ranker import (
+            TfidfDocRanker
+        )
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            rng = np.random.RandomState(0)
+            texts = [
+                ' '.join('word{}'.format(w) for w in rng.randint(0, 1000, 8))
+                for _ in range(300)
+            ]
+            args = _empty_db(tmpdir)
+            db_path = args.db_path
+
+            with DocDB(db_path=db_path) as db:
+                db.add([(None, t, t) for t in texts[:250]])
+                args.out_dir = os.path.join(tmpdir, 'base')
+                build_tfidf(args)
+                ranker = TfidfDocRanker(args.out_dir, strict=False)
+                db.add([(None, t, t) for t in texts[250:]])
+                new_ids = db.get_doc_ids_after(ranker.max_doc_id())
+            self.assertEqual(len(new_ids), 50)
+            ranker.add_delta(
+                get_delta_count_matrix(args, {'db_path': db_path}, new_ids),
+                new_ids
+            )
+            ranker.save_delta()
+            args.out_dir = os.path.join(tmpdir, 'full')
+            build_tfidf(args)
+            full = TfidfDocRanker(args.out_dir, strict=False)
+
+            queries = texts[240:260] + ['word1 word2 word3', 'nothing']
+            for reloaded in [False, True]:
+                if reloaded:
+                    ranker = TfidfDocRanker(
+                        os.path.join(tmpdir, 'base'), strict=False
+                    )
+                    self.assertEqual(ranker.num_delta_docs(), 50)
+                batch = ranker.batch_closest_docs(queries, 5)
+                for query, (_, doc_scores) in zip(queries, batch):
+                    _, expected = full.closest_docs(query, 5)
+                    _, scores = ranker.closest_docs(query, 5)
+                    self.assertTrue(np.allclose(scores, expected))
+                    self.assertTrue(np.allclose(doc_scores, expected))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipIf(SKIP_TESTS, "Missing  Tfidf dependencies.")
+    def test_count_matrix_chunks(self):
+        from parlai.agents.tfidf_retriever.build_tfidf import (
+            get_count_matrix, live_count_matrix
+        )
+        from parlai.agents.tfidf_retriever.doc_db import DocDB
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            args = _empty_db(tmpdir)
+            texts = ['doc {} has words {}'.format(i, ' and '.join(
+                'word{}'.format(i * j % 37) for j in range(i % 11)))
+                for i in range(100)]
+            with DocDB(db_path=args.db_path) as db:
+                db.add([(None, t, t) for t in texts])
+            args.num_workers = 2
+            counts = get_count_matrix(
+                args, {'db_path': args.db_path}, chunk_size=7
+            )
+            self.assertTrue(counts.has_sorted_indices)
+            self.assertEqual(counts.shape, (args.hash_size, 101))
+            self.assertEqual(counts[:, 0].nnz, 0)
+            expected = live_count_matrix(args, texts)
+            self.assertEqual((counts[:, 1:] != expected).nnz, 0)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipIf(SKIP_TESTS, "Missing  Tfidf dependencies.")
+    def test_build_mmap_index(self):
+        import numpy as np
+        from parlai.agents.tfidf_retriever.build_tfidf import run as build_tfidf
+        from parlai.agents.tfidf_retriever.doc_db import DocDB
+        from parlai.agents.tfidf_retriever import utils
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            args = _empty_db(tmpdir)
+            texts = ['doc {} has words {}'.format(i, ' and '.join(
+                'word{}'.format(i * j % 37) for j in range(i % 11)))
+                for i in range(100)]
+            with DocDB(db_path=args.db_path) as db:
+                db.add([(None, t, t) for t in texts])
+            args.num_workers = 2
+            args.out_dir = os.path.join(tmpdir, 'memory')
+            build_tfidf(args)
+            args.mmap = True
+            args.tmp_dir = os.path.join(tmpdir, 'spill')
+            os.mkdir(args.tmp_dir)
+            args.out_dir = os.path.join(tmpdir, 'mmap')
+            build_tfidf(args)
+            self.assertEqual(os.listdir(args.tmp_dir), [])
+
+            expected, expected_meta = utils.load_sparse_csr(
+                os.path.join(tmpdir, 'memory')
+            )
+            matrix, metadata = utils.load_sparse_csr_mmap(args.out_dir)
+            self.assertTrue(matrix.has_sorted_indices)
+            self.assertEqual(matrix.shape, expected.shape)
+            self.assertEqual(matrix.nnz, expected.nnz)
+            self.assertEqual((matrix != expected).nnz, 0)
+            self.assertEqual(set(metadata), set(expected_meta))
+            for key in ['doc_freqs', 'term_max']:
+                self.assertTrue(np.array_equal(metadata[key],
+                                               expected_meta[key]))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipIf(SKIP_TESTS, "Missing  Tfidf dependencies.")
+    def test_torch_tfidf_matrix(self):
+        import numpy as np
+        from parlai.agents.tfidf_retriever.build_tfidf import (
+            live_count_matrix, live_count_matrix_t, get_tfidf_matrix,
+            get_tfidf_matrix_t
+        )
+        from parlai.core.utils import AttrDict
+
+        args = AttrDict({
+            'ngram': 2, 'hash_size': 2 ** 10, 'tokenizer': 'simple',
+        })
+        texts = ['the cat sat on the mat', 'the dog sat', 'cats and dogs',
+                 'a mat for the cat', 'the the the']
+        tfidf = get_tfidf_matrix(live_count_matrix(args, texts)).toarray()
+        tfidf_t = get_tfidf_matrix_t(live_count_matrix_t(args, texts))
+        self.assertTrue(np.allclose(tfidf, tfidf_t.to_dense().numpy()))
+
+    @unittest.skipIf(SKIP_TESTS, "Missing  Tfidf dependencies.")
+    def test_doc_db_get_docs(self):
+        import sqlite3
+        from parlai.agents.tfidf_retriever.doc_db import DocDB
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            args = _empty_db(tmpdir)
+            with DocDB(db_path=args.db_path, wal=True) as db:
+                db.add([(None, 'text{}'.format(i), 'value{}'.format(i))
+                        for i in range(1, 1501)])
+            with DocDB(db_path=args.db_path, cache_size=2,
+                       read_only=True) as db:
+                self.assertEqual(
+                    db.get_docs([3, 1, 3, 2000]),
+                    ['text3', 'text1', 'text3', None]
+                )
+                self.assertEqual(db.get_doc_value(1), 'value1')
+                self.assertEqual(len(db.cache), 2)
+                ids = list(range(1500, 0, -1))
+                self.assertEqual(db.get_docs(ids, 'value'),
+                                 ['value{}'.format(i) for i in ids])
+                with self.assertRaises(sqlite3.OperationalError):
+                    db.add([(None, 'text', 'value')])
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+def _empty_db(tmpdir):
+    """Create an empty doc db in tmpdir and return build args for it."""
+    import sqlite3
+    from parlai.core.utils import AttrDict
+
+    db_path = os.path.join(tmpdir, 'docs.db')
+    conn = sqlite3.connect(db_path)
+    conn.execute('CREATE TABLE documents '
+                 '(id INTEGER PRIMARY KEY, text, value);')
+    conn.commit()
+    conn.close()
+    logger = logging.getLogger('parlai.agents.tfidf_retriever.build_tfidf')
+    logger.setLevel(logging.ERROR)
+    return AttrDict({
+        'db_path': db_path, 'ngram': 1, 'hash_size': 2 ** 12,
+        'tokenizer': 'simple', 'num_workers': 1,
+    })
+
+
+def _random_ranker(tmpdir):
+    """Save a random memory-mapped index in tmpdir and load a ranker on it."""
+    import numpy as np
+    import scipy.sparse as sp
+    from parlai.agents.tfidf_retriever import utils
+    from parlai.agents.tfidf_retriever.tfidf_doc_ranker import TfidfDocRanker
+
+    filename = os.path.join(tmpdir, 'index')
+    matrix = sp.random(256, 500, density=0.05, format='csr', random_state=0)
+    metadata = {
+        'doc_freqs': np.diff(matrix.indptr),
+        'tokenizer': 'simple',
+        'hash_size': 256,
+        'ngram': 1,
+    }
+    utils.save_sparse_csr_mmap(filename, matrix, metadata)
+    return TfidfDocRanker(filename, mmap=True)
+
 
 if __name__ == '__main__':
     unittest.main()
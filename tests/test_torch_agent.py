@@ -11,7 +11,7 @@ from parlai.core.agents import Agent
 
 SKIP_TESTS = False
 try:
-    from parlai.core.torch_agent import TorchAgent, Output
+    from parlai.core.torch_agent import TorchAgent, Output, _relative_diff
     import torch
 except ImportError:
     SKIP_TESTS = True
@@ -402,6 +402,8 @@ class TestTorchAgent(unittest.TestCase):
             labs = [o[lab_key][0] for o in obs_batch]
             self.assertEqual(batch.labels, [labs[i] for i in [1, 0, 2]])
             self.assertEqual(list(batch.valid_indices), [1, 0, 2])
+            self.assertEqual(list(batch.observations),
+                             [obs_vecs[i] for i in [1, 0, 2]])
 
             # now sort just on ys
             new_vecs = [vecs.copy() for vecs in obs_vecs]
@@ -423,6 +425,8 @@ class TestTorchAgent(unittest.TestCase):
             labs = [o[lab_key][0] for o in new_vecs]
             self.assertEqual(batch.labels, [labs[i] for i in [1, 2, 0]])
             self.assertEqual(list(batch.valid_indices), [1, 2, 0])
+            self.assertEqual(list(batch.observations),
+                             [new_vecs[i] for i in [1, 2, 0]])
 
             # test lambda
             batch = agent.batchify(obs_vecs, is_valid=(
@@ -747,6 +751,59 @@ class TestTorchAgent(unittest.TestCase):
         for i in range(len(obs_elabs)):
             self.assertEqual(reply[i]['text'], f'Evaluating {i}!')
 
+    @unittest.skipIf(SKIP_TESTS, "Torch not installed.")
+    def test_quantize_model(self):
+        """Make sure quantization swaps layers and respects the tolerance."""
+        agent = get_agent(quantize=True)
+        self.assertTrue(agent.quantize_state['pending'])
+        torch.manual_seed(0)
+        agent.model = torch.nn.Sequential(
+            torch.nn.Embedding(10, 8), torch.nn.Linear(8, 4)
+        )
+        agent.model.eval()
+        calls = [('', (torch.LongTensor([[1, 2, 3]]),), {})]
+
+        agent.opt['quantize_tolerance'] = -1
+        self.assertFalse(agent.quantize_model(calls))
+        self.assertTrue(isinstance(agent.model[1], torch.nn.Linear))
+
+        agent.opt['quantize_tolerance'] = 0.1
+        self.assertTrue(agent.quantize_model(calls))
+        self.assertFalse(isinstance(agent.model[1], torch.nn.Linear))
+        self.assertEqual(agent.model(*calls[0][1]).size(), (1, 3, 4))
+
+        # without any outputs to compare, the model is not quantized
+        agent.model = torch.nn.Sequential(torch.nn.Linear(8, 4))
+        self.assertFalse(agent.quantize_model([]))
+        self.assertTrue(isinstance(agent.model[0], torch.nn.Linear))
+        self.assertEqual(
+            _relative_diff(torch.zeros(2, 3), torch.zeros(2)), float('inf')
+        )
+
+    @unittest.skipIf(SKIP_TESTS, "Torch not installed.")
+    def test_quantize_submodule_calls(self):
+        """Make sure calls made directly to submodules are compared."""
+        for tolerance in [-1, 0.1]:
+            agent = get_agent(quantize=True, quantize_tolerance=tolerance)
+            torch.manual_seed(0)
+            agent.model = torch.nn.Module()
+            agent.model.encoder = torch.nn.Sequential(torch.nn.Linear(8, 8))
+            agent.model.decoder = torch.nn.Linear(8, 4)
+            agent.model.eval()
+
+            def eval_step(batch):
+                # like beam search, skip the forward of the model
+                return agent.model.decoder(agent.model.encoder(batch))
+
+            agent.eval_step = eval_step
+            agent._quantize_on_batch(torch.ones(2, 8))
+            self.assertFalse(agent.quantize_state['pending'])
+            self.assertNotIn('forward', agent.model.decoder.__dict__)
+            self.assertEqual(
+                isinstance(agent.model.decoder, torch.nn.Linear),
+                tolerance < 0,
+            )
+
 
 if __name__ == '__main__':
     unittest.main()
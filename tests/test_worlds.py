@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import copy
+import unittest
+
+from parlai.core.agents import create_agent
+from parlai.core.params import ParlaiParser
+from parlai.core.worlds import (
+    BatchSlotOpt, BatchWorld, batch_slot_shared, create_task
+)
+
+
+class TestBatchWorld(unittest.TestCase):
+    """Checks the batch slots created by BatchWorld."""
+
+    def test_batch_slot_shared(self):
+        opt = {'task': 'x', 'override': {'a': 1}}
+        shared = {
+            'opt': opt,
+            'agents': [{'opt': opt, 'data': [1, 2]}, {'opt': opt}],
+            'cands': ['a', 'b'],
+        }
+        slot = batch_slot_shared(shared, 3)
+        self.assertEqual(slot['batchindex'], 3)
+        self.assertNotIn('batchindex', shared)
+        self.assertNotIn('batchindex', opt)
+        for s in [slot] + slot['agents']:
+            self.assertIsInstance(s['opt'], BatchSlotOpt)
+            self.assertEqual(s['opt']['batchindex'], 3)
+            # nested values are shared with the parent
+            self.assertIs(s['opt']['override'], opt['override'])
+        self.assertEqual(slot['agents'][0]['batchindex'], 3)
+        self.assertIs(slot['agents'][0]['data'], shared['agents'][0]['data'])
+        self.assertIs(slot['cands'], shared['cands'])
+
+        slot_opt = copy.deepcopy(slot['opt'])
+        self.assertIsInstance(slot_opt, BatchSlotOpt)
+        slot_opt['task'] = 'y'
+        self.assertEqual(slot['opt']['task'], 'x')
+
+    def test_ordered_slots(self):
+        parser = ParlaiParser(True, True)
+        opt = parser.parse_args([
+            '-t', 'integration_tests', '-m', 'repeat_label',
+            '-dt', 'valid', '-bs', '4'
+        ], print_args=False)
+        world = create_task(opt, create_agent(opt))
+        self.assertIsInstance(world, BatchWorld)
+        teachers = [w.get_agents()[0] for w in world.worlds]
+        self.assertEqual([t.opt['batchindex'] for t in teachers],
+                         [0, 1, 2, 3])
+        texts = []
+        while not world.epoch_done():
+            world.parley()
+            for w in world.worlds:
+                act = w.get_acts()[0]
+                if 'text' in act:
+                    texts.append(act['text'])
+        # every example is seen exactly once across the slots
+        self.assertEqual(len(texts), len(set(texts)))
+        self.assertEqual(len(texts), world.num_examples())
+
+
+if __name__ == '__main__':
+    unittest.main()